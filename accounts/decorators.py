@@ -0,0 +1,19 @@
+from functools import wraps
+
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.shortcuts import redirect
+
+
+def author_required(message='You need author privileges to access this page.'):
+    """Let signed-in authors and admins through; send everyone else home with ``message``"""
+    def decorator(view_func):
+        @login_required
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            if not request.user.profile.is_author:
+                messages.error(request, message)
+                return redirect('blog:home')
+            return view_func(request, *args, **kwargs)
+        return wrapped
+    return decorator
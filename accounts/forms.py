@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
+from django.db import transaction
 from .models import UserProfile
 
 
@@ -31,12 +32,12 @@ class UserRegistrationForm(UserCreationForm):
         user.email = self.cleaned_data['email']
         user.first_name = self.cleaned_data['first_name']
         user.last_name = self.cleaned_data['last_name']
+        # The profile is created with this role when the user is first saved
+        user.profile_role = self.cleaned_data['role']
         
         if commit:
-            user.save()
-            # Set the role in user profile
-            user.profile.role = self.cleaned_data['role']
-            user.profile.save()
+            with transaction.atomic():
+                user.save()
         
         return user
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Published posts'),
+        ),
+    ]
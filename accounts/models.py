@@ -2,9 +2,10 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from blog.counters import CounterFieldsMixin
 
 
-class UserProfile(models.Model):
+class UserProfile(CounterFieldsMixin, models.Model):
     """Extended user profile with role management"""
     ROLE_CHOICES = (
         ('admin', 'Admin'),
@@ -16,9 +17,14 @@ class UserProfile(models.Model):
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='reader')
     bio = models.TextField(blank=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)
     website = models.URLField(blank=True)
+    post_count = models.PositiveIntegerField(default=0, editable=False, help_text='Published posts')
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    counter_fields = ('post_count', 'comment_count')
+    
     def __str__(self):
         return f'{self.user.username} - {self.role}'
     
@@ -37,12 +43,12 @@ class UserProfile(models.Model):
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
-    """Automatically create UserProfile when a User is created"""
-    if created:
-        UserProfile.objects.create(user=instance)
-
+    """Automatically create UserProfile when a User is created
 
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    """Save UserProfile when User is saved"""
-    instance.profile.save()
+    A ``profile_role`` set on the user before its first save becomes the
+    role of the profile, so registration writes the profile only once.
+    Later saves of the user (like ``login()`` updating ``last_login``) leave
+    the profile alone; code changing a profile saves it itself.
+    """
+    if created:
+        UserProfile.objects.create(user=instance, role=getattr(instance, 'profile_role', 'reader'))
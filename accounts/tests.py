@@ -1,3 +1,66 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+
+class ProfileLoadingTests(TestCase):
+    """Tests for loading the profile with the signed-in user and for author_required"""
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user('reader', password='secret123')
+
+    def test_profile_is_joined_to_the_session_user(self):
+        self.client.force_login(self.reader)
+        with self.assertNumQueries(2):
+            # The session, and the user with their profile
+            response = self.client.get(reverse('accounts:profile'))
+        self.assertContains(response, 'reader')
+
+    def test_author_required(self):
+        dashboard = reverse('blog:dashboard')
+        response = self.client.get(dashboard)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={dashboard}")
+
+        self.client.force_login(self.reader)
+        response = self.client.get(dashboard, follow=True)
+        self.assertRedirects(response, reverse('blog:home'))
+        self.assertContains(response, 'You need author privileges to access the dashboard.')
+
+        self.reader.profile.role = 'author'
+        self.reader.profile.save()
+        self.assertEqual(self.client.get(dashboard).status_code, 200)
+
+
+class ProfileWriteTests(TestCase):
+    """Tests for the writes registering and signing in cause"""
+
+    def setUp(self):
+        cache.clear()
+
+    def profile_writes(self, queries):
+        return [
+            query['sql'] for query in queries.captured_queries
+            if 'accounts_userprofile' in query['sql'] and not query['sql'].startswith('SELECT')
+        ]
+
+    def test_register_creates_profile_with_role_once(self):
+        # Two username checks, the user and its profile in one transaction, then
+        # login(): the session, last_login and the session again
+        with self.assertNumQueries(14) as queries:
+            response = self.client.post(reverse('accounts:register'), {
+                'username': 'newauthor', 'email': 'new@example.com', 'role': 'author',
+                'password1': 'Complex-pass-123', 'password2': 'Complex-pass-123',
+            })
+        self.assertRedirects(response, reverse('blog:home'), fetch_redirect_response=False)
+        self.assertEqual(len(self.profile_writes(queries)), 1)
+        self.assertEqual(User.objects.get(username='newauthor').profile.role, 'author')
+
+    def test_login_does_not_write_profile(self):
+        User.objects.create_user('reader', password='secret123')
+        # The user, then login(): the session, last_login and the session again
+        with self.assertNumQueries(9) as queries:
+            response = self.client.post(reverse('accounts:login'), {'username': 'reader', 'password': 'secret123'})
+        self.assertRedirects(response, reverse('blog:home'), fetch_redirect_response=False)
+        self.assertEqual(self.profile_writes(queries), [])
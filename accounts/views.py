@@ -14,7 +14,8 @@ def register(request):
         form = UserRegistrationForm(request.POST)
         if form.is_valid():
             user = form.save()
-            login(request, user)
+            # Several backends are configured, so login() has to be told which one
+            login(request, user, backend='accounts.backends.ProfileModelBackend')
             messages.success(request, f'Welcome {user.username}! Your account has been created.')
             return redirect('blog:home')
     else:
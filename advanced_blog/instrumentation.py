@@ -0,0 +1,213 @@
+"""
+Per-request timing and SQL instrumentation.
+
+``RequestMetricsMiddleware`` measures requests: total time, template render
+time, number of queries and time spent in them. Queries are counted by a
+``connection.execute_wrapper`` hook installed on every connection. Every request feeds the histograms served at
+``/metrics/`` (see ``advanced_blog.metrics``). A sample of requests also
+tracks its SQL, where the same statement running several times in one
+request is reported as an N+1 candidate, and produces one JSON log line on
+the ``advanced_blog.requests`` logger and a ``Server-Timing`` header that
+browser dev tools display.
+
+Render time comes from ``InstrumentedDjangoTemplates``, the template backend
+configured in ``TEMPLATES``. It includes queries run lazily from templates.
+
+Settings:
+
+``REQUEST_METRICS_SAMPLE_RATE``
+    Share of requests logged in detail, from 0 (off) to 1 (every request).
+``REQUEST_METRICS_DUPLICATE_THRESHOLD``
+    Executions of the same SQL in one request from which it is reported.
+"""
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates
+
+from . import metrics as registry
+
+logger = logging.getLogger('advanced_blog.requests')
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Measurements collected while one request is handled"""
+
+    def __init__(self, track_statements=True):
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_depth = 0
+        self.track_statements = track_statements
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        """``execute_wrapper`` hook: time the query and remember its SQL shape"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - start
+            self.query_count += 1
+            if self.track_statements:
+                # Parameters are still placeholders here, so one loop over rows shares one key
+                self.statements[sql] += 1
+
+    def duplicates(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+def current_metrics():
+    """Metrics of the request being measured on this thread, or ``None``"""
+    return _current.get()
+
+
+class TimedTemplate:
+    """Wrap a backend template so its top-level render is timed"""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return self.template.render(context, request)
+        # Templates rendered from inside another render are already being timed
+        metrics.render_depth += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics.render_depth -= 1
+            if not metrics.render_depth:
+                metrics.render_seconds += time.perf_counter() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with render times reported to ``RequestMetrics``"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def _summary(sql, limit=200):
+    return sql if len(sql) <= limit else sql[:limit] + '...'
+
+
+def _record_query(execute, sql, params, many, context):
+    """Execute wrapper installed on every connection; reports to the current request's metrics"""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+def instrument_connection(connection):
+    if _record_query not in connection.execute_wrappers:
+        # First, so the pop() of a temporary connection.execute_wrapper() never removes it
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+@receiver(connection_created)
+def _instrument_new_connection(sender, connection, **kwargs):
+    # Covers the worker threads async views run their queries in
+    instrument_connection(connection)
+
+
+class RequestMetricsMiddleware:
+    """Measure requests for the metrics endpoint and report a sample of them in detail
+
+    Every request updates the counters and histograms in ``metrics``; only
+    sampled requests also track their SQL statements and produce a log line
+    and a Server-Timing header. Works for sync and async requests: the
+    metrics travel in a context variable, which is copied into the threads
+    that run the ORM for async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'REQUEST_METRICS_SAMPLE_RATE', 1.0)
+        self.duplicate_threshold = getattr(settings, 'REQUEST_METRICS_DUPLICATE_THRESHOLD', 3)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        for connection in connections.all():
+            instrument_connection(connection)
+        metrics = self.start()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = self.start()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - start)
+
+    def start(self):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        return RequestMetrics(track_statements=sampled)
+
+    def finish(self, request, response, metrics, total_seconds):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else None
+        self.record(request, response, view or 'unresolved', total_seconds, metrics)
+        if not metrics.track_statements:
+            return response
+
+        duplicates = metrics.duplicates(self.duplicate_threshold)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'total_ms': round(total_seconds * 1000, 2),
+            'render_ms': round(metrics.render_seconds * 1000, 2),
+            'db_ms': round(metrics.query_seconds * 1000, 2),
+            'queries': metrics.query_count,
+            'duplicate_queries': [{'sql': _summary(sql), 'count': count} for sql, count in duplicates],
+        }))
+
+        response.headers['Server-Timing'] = ', '.join([
+            f'total;dur={total_seconds * 1000:.2f}',
+            f'db;dur={metrics.query_seconds * 1000:.2f};desc="{metrics.query_count} queries"',
+            f'render;dur={metrics.render_seconds * 1000:.2f}',
+        ])
+        return response
+
+    def record(self, request, response, view, total_seconds, metrics):
+        """Update the process-shared counters and histograms"""
+        registry.REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        registry.REQUEST_LATENCY.observe(total_seconds, view=view)
+        registry.REQUEST_QUERIES.observe(metrics.query_count, view=view)
+        registry.REQUEST_DB_TIME.observe(metrics.query_seconds, view=view)
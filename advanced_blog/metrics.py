@@ -0,0 +1,270 @@
+"""
+Prometheus-style metrics shared by all worker processes.
+
+Every process writes its samples to its own memory-mapped file in
+``METRICS_DIR``, so recording a sample never takes a lock across processes.
+The ``/metrics/`` view sums the files of all processes, past and present,
+and renders them in the Prometheus text format. Clear ``METRICS_DIR`` when
+the application is deployed, or it keeps counting from the last release.
+
+Define metrics at module level and record samples with keyword labels::
+
+    COMMENTS = Counter('blog_comments_posted_total', 'Comments posted')
+    COMMENTS.inc()
+    LATENCY = Histogram('request_seconds', 'Latency', ['view'], buckets=(0.1, 1))
+    LATENCY.observe(0.25, view='blog:home')
+"""
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 250, 1000)
+
+REGISTRY = {}
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'advanced_blog_metrics')
+
+
+class MmapValues:
+    """Float values keyed by string, in a memory-mapped file written by one process
+
+    Layout: a little-endian ``uint32`` with the number of used bytes, padded
+    to 8, then entries of ``uint32`` key length, the UTF-8 key padded so the
+    value is 8-byte aligned, and the ``float64`` value. An entry is complete
+    before the used size covering it is written, so readers in other
+    processes never see half of one.
+    """
+    HEADER = 8
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from('<I', self._map, 0)[0] or self.HEADER
+        self._positions = {key: position for key, _, position in self._entries(self._map, self._used)}
+
+    @staticmethod
+    def _entries(data, used):
+        offset = MmapValues.HEADER
+        while offset < used:
+            length = struct.unpack_from('<I', data, offset)[0]
+            key_end = offset + 4 + length
+            key = bytes(data[offset + 4:key_end]).decode()
+            position = key_end + (-key_end % 8)
+            yield key, struct.unpack_from('<d', data, position)[0], position
+            offset = position + 8
+
+    @classmethod
+    def read(cls, path):
+        """All ``(key, value)`` pairs of a file, as written so far"""
+        with open(path, 'rb') as handle:
+            data = handle.read()
+        if len(data) < cls.HEADER:
+            return []
+        used = struct.unpack_from('<I', data, 0)[0]
+        return [(key, value) for key, value, _ in cls._entries(data, used)]
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            encoded = key.encode()
+            key_end = self._used + 4 + len(encoded)
+            padding = -key_end % 8
+            size = 4 + len(encoded) + padding + 8
+            while self._used + size > self._capacity:
+                self._grow()
+            struct.pack_into(f'<I{len(encoded) + padding}sd', self._map, self._used,
+                             len(encoded), encoded, 0.0)
+            position = key_end + padding
+            self._used += size
+            struct.pack_into('<I', self._map, 0, self._used)
+            self._positions[key] = position
+        return position
+
+    def _grow(self):
+        self._map.close()
+        self._capacity *= 2
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def add(self, key, amount):
+        position = self._position(key)
+        value = struct.unpack_from('<d', self._map, position)[0]
+        struct.pack_into('<d', self._map, position, value + amount)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+_lock = threading.Lock()
+_store = None
+
+
+def _values():
+    """The store of the current process, reopened after a fork or a METRICS_DIR change"""
+    global _store
+    directory = metrics_dir()
+    path = os.path.join(directory, f'metrics_{os.getpid()}.db')
+    if _store is None or _store.path != path:
+        os.makedirs(directory, exist_ok=True)
+        _store = MmapValues(path)
+    return _store
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _increment(name, labels, amount):
+    with _lock:
+        _values().add(_key(name, labels), amount)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY[name] = self
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return {name: str(value) for name, value in labels.items()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        _increment(self.name, self._labels(labels), amount)
+
+
+class Histogram(Metric):
+    """Observations counted per bucket; buckets are made cumulative on export"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        labels = self._labels(labels)
+        bound = next((bucket for bucket in self.buckets if value <= bucket), math.inf)
+        with _lock:
+            values = _values()
+            values.add(_key(f'{self.name}_bucket', {**labels, 'le': _format(bound)}), 1)
+            values.add(_key(f'{self.name}_sum', labels), value)
+            values.add(_key(f'{self.name}_count', labels), 1)
+
+
+def _format(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def collect():
+    """Samples of every process summed, as ``{(name, labels tuple): value}``"""
+    totals = defaultdict(float)
+    for path in glob.glob(os.path.join(metrics_dir(), 'metrics_*.db')):
+        for key, value in MmapValues.read(path):
+            name, labels = json.loads(key)
+            totals[name, tuple(map(tuple, labels))] += value
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample_line(name, labels, value):
+    if labels:
+        rendered = ','.join(f'{label}="{_escape(text)}"' for label, text in labels)
+        name = f'{name}{{{rendered}}}'
+    return f'{name} {_format(value)}'
+
+
+def _cumulative_buckets(metric, samples):
+    """Turn per-bucket counts into the cumulative ``le`` series Prometheus expects"""
+    series = defaultdict(dict)
+    for (name, labels), value in samples.items():
+        if name == f'{metric.name}_bucket':
+            labels = dict(labels)
+            series[tuple(sorted((k, v) for k, v in labels.items() if k != 'le'))][labels['le']] = value
+    lines = []
+    for labels, counts in sorted(series.items()):
+        running = 0
+        for bound in (*metric.buckets, math.inf):
+            running += counts.get(_format(bound), 0)
+            lines.append(_sample_line(f'{metric.name}_bucket', (*labels, ('le', _format(bound))), running))
+    return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    samples = collect()
+    by_metric = defaultdict(dict)
+    for (name, labels), value in samples.items():
+        base = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in REGISTRY:
+                base = name[:-len(suffix)]
+        by_metric[base][name, labels] = value
+
+    lines = []
+    for base in sorted(by_metric):
+        metric = REGISTRY.get(base)
+        metric_samples = by_metric[base]
+        if metric:
+            lines.append(f'# HELP {base} {metric.documentation}')
+            lines.append(f'# TYPE {base} {metric.kind}')
+        if isinstance(metric, Histogram):
+            lines.extend(_cumulative_buckets(metric, metric_samples))
+            metric_samples = {key: value for key, value in metric_samples.items() if key[0] != f'{base}_bucket'}
+        lines.extend(_sample_line(name, labels, value) for (name, labels), value in sorted(metric_samples.items()))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Expose the metrics to ``Authorization: Bearer <METRICS_TOKEN>``
+
+    Without a token the endpoint is closed, unless ``METRICS_PUBLIC`` opens it
+    (the development settings do).
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        if not getattr(settings, 'METRICS_PUBLIC', False):
+            return HttpResponseForbidden()
+    elif not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
+REQUESTS = Counter('http_requests_total', 'Requests handled, by view, method and status',
+                   ['view', 'method', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Request handling time', ['view'])
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'SQL queries per request', ['view'],
+                            buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram('http_request_db_duration_seconds', 'Time spent in SQL per request', ['view'])
@@ -0,0 +1,114 @@
+"""
+Primary/replica database routing.
+
+Writes always go to ``default``, the primary. Reads go to one of the
+``DATABASE_REPLICAS`` aliases only inside a request that
+``PrimaryReplicaMiddleware`` found safe for it: a GET or HEAD from a client
+that has not written in the last ``DATABASE_STICKY_SECONDS``. Everything else
+reads from the primary: requests that write, the rest of a request after its
+first write, and code running outside a request (management commands,
+workers), which tends to read what it is about to update.
+
+The sticky window covers replication lag. A POST, PUT, PATCH or DELETE sets a
+short-lived cookie on its response, and the client reads from the primary
+until the cookie expires, so an author sees their edit on the page edit_post
+redirects to, and a fresh login finds its session.
+
+Each request sticks to one randomly picked replica, so its queries see one
+consistent snapshot.
+"""
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = 'db_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+_current = ContextVar('database_reads', default=None)
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+class RequestReads:
+    """The alias the current request reads from; moves to the primary on its first write"""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+
+class PrimaryReplicaRouter:
+    """Send writes to the primary and the reads of safe requests to a replica"""
+
+    def db_for_read(self, model, **hints):
+        reads = _current.get()
+        return reads.alias if reads is not None else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        reads = _current.get()
+        if reads is not None:
+            # Later reads in this request must see what it wrote
+            reads.alias = DEFAULT_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema from the primary
+        return False if db in replicas() else None
+
+
+class PrimaryReplicaMiddleware:
+    """Route the reads of safe requests to a replica and keep writers on the primary for a while
+
+    Works for sync and async requests: the routing state travels in a
+    context variable, which is copied into the threads that run the ORM for
+    async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _current.set(self.start(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = _current.set(self.start(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response)
+
+    def start(self, request):
+        aliases = replicas()
+        if aliases and request.method in ('GET', 'HEAD') and STICKY_COOKIE not in request.COOKIES:
+            return RequestReads(random.choice(aliases))
+        return None
+
+    def finish(self, request, response):
+        if request.method not in SAFE_METHODS and replicas():
+            response.set_cookie(
+                STICKY_COOKIE, '1', max_age=getattr(settings, 'DATABASE_STICKY_SECONDS', 15),
+                secure=request.is_secure(), httponly=True, samesite='Lax',
+            )
+        return response
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .sqlite import performance_settings
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,6 +51,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the middleware too
+    'advanced_blog.instrumentation.RequestMetricsMiddleware',
+    # Before anything that may read the session or the user
+    'advanced_blog.routers.PrimaryReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -61,7 +68,8 @@ ROOT_URLCONF = 'advanced_blog.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates, with render times reported to the request metrics
+        'BACKEND': 'advanced_blog.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -88,6 +96,119 @@ DATABASES = {
     }
 }
 
+# WAL, relaxed syncing, a bigger cache, IMMEDIATE write transactions and
+# persistent connections, for several gunicorn workers sharing db.sqlite3
+# (see advanced_blog/sqlite.py)
+if os.environ.get('SQLITE_PERFORMANCE_MODE') == '1':
+    DATABASES['default'].update(performance_settings())
+
+# Reads of anonymous and other safe requests can go to read replicas, listed
+# here by alias; writes and the requests of recent writers stay on `default`
+# (see advanced_blog/routers.py). To try it locally, point SQLITE_REPLICA at
+# a copy of db.sqlite3.
+if os.environ.get('SQLITE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['SQLITE_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['advanced_blog.routers.PrimaryReplicaRouter']
+
+# Seconds a client keeps reading from the primary after a POST, so it sees its own writes
+DATABASE_STICKY_SECONDS = 15
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    }
+}
+
+# Share of requests (0 to 1) logged with their timings and SQL statistics,
+# see advanced_blog/instrumentation.py
+REQUEST_METRICS_SAMPLE_RATE = 1.0
+
+# Executions of the same SQL in one request from which it is logged as an N+1 candidate
+REQUEST_METRICS_DUPLICATE_THRESHOLD = 3
+
+# Per-process files behind the /metrics/ endpoint (defaults to a directory in
+# the system temp dir); METRICS_TOKEN, when set, is required as a bearer token.
+# Without a token the endpoint is only served with METRICS_PUBLIC, for development
+METRICS_DIR = None
+METRICS_TOKEN = None
+METRICS_PUBLIC = True
+
+# Serve home, post, category, tag and search pages from blog/async_views.py;
+# only worth it under an ASGI server
+BLOG_ASYNC_VIEWS = False
+
+# Posts per page on the home, category, tag and search listings
+BLOG_POSTS_PER_PAGE = 6
+
+# Comments inlined on a post page and returned per request by post_comments
+BLOG_COMMENTS_PER_PAGE = 20
+
+# Comment rate limit per user and per client IP: bursts of BLOG_COMMENT_BURST,
+# then BLOG_COMMENT_RATE per minute (see blog/comments.py)
+BLOG_COMMENT_BURST = 5
+BLOG_COMMENT_RATE = 6
+
+# Reverse proxies in front of the app that append to X-Forwarded-For; the
+# client IP is read from that header behind them, else from REMOTE_ADDR
+BLOG_TRUSTED_PROXIES = 0
+
+# With a buffer size, comments are queued per process and saved in one
+# transaction once that many are queued or BLOG_COMMENT_FLUSH_INTERVAL
+# seconds after the first; 0 saves every comment in its request
+BLOG_COMMENT_BUFFER_SIZE = 0
+BLOG_COMMENT_FLUSH_INTERVAL = 2
+
+# Spam rules for comments (see blog/moderation.py): comments scoring
+# BLOG_SPAM_THRESHOLD or more are held back for a moderator
+BLOG_SPAM_KEYWORDS = [
+    'viagra', 'cialis', 'casino', 'payday loan', 'crypto giveaway', 'free money', 'work from home',
+    'make money fast', 'click here', 'buy now', 'cheap followers', 'seo services',
+]
+BLOG_SPAM_MAX_LINKS = 2
+BLOG_SPAM_THRESHOLD = 1.0
+
+# Entries in the related-posts list under each post (see blog/related.py)
+BLOG_RELATED_POSTS = 4
+
+# Post views are buffered per process and written once this many are pending
+# or this many seconds have passed (see blog/trending.py)
+BLOG_VIEW_FLUSH_THRESHOLD = 500
+BLOG_VIEW_FLUSH_INTERVAL = 30
+
+# Trending ranking: views of the last BLOG_TRENDING_WINDOW_DAYS, their weight
+# halving every BLOG_TRENDING_HALF_LIFE hours; the top BLOG_TRENDING_SIZE are listed
+BLOG_TRENDING_WINDOW_DAYS = 7
+BLOG_TRENDING_HALF_LIFE = 24
+BLOG_TRENDING_SIZE = 24
+
+# Threads making resized variants of uploaded images (see blog/images.py);
+# 0 makes them in the thread that saved the image
+BLOG_IMAGE_WORKERS = 2
+
+# Seconds a rendered public page is served to anonymous visitors from the cache
+BLOG_PAGE_CACHE_TIMEOUT = 300
+
+# Seconds a shared cache (CDN) may serve a public page without revalidating
+BLOG_CDN_MAX_AGE = 60
+
+# Publish notifications are queued in the database outbox and sent by
+# `python manage.py process_notifications`
+BLOG_PUBLISH_NOTIFICATION_RECIPIENTS = ['admin@example.com']
+
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -137,11 +258,23 @@ CKEDITOR_IMAGE_BACKEND = "pillow"
 CKEDITOR_CONFIGS = {
     'default': {
         'toolbar': 'full',
+        # blog/rendering.py drops Flash objects and form controls from post bodies
+        'removeButtons': 'Flash,Form,Checkbox,Radio,TextField,Textarea,Select,Button,ImageButton,HiddenField',
         'height': 300,
         'width': '100%',
     },
 }
 
+# Hosts whose https pages post bodies may embed in an iframe
+BLOG_EMBED_HOSTS = ['www.youtube.com', 'www.youtube-nocookie.com', 'player.vimeo.com']
+
+# Sessions load the user together with their profile (see accounts/backends.py);
+# ModelBackend stays listed so sessions it signed in remain valid
+AUTHENTICATION_BACKENDS = [
+    'accounts.backends.ProfileModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
 # Login settings
 LOGIN_URL = 'accounts:login'
 LOGIN_REDIRECT_URL = 'blog:home'
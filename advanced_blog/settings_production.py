@@ -7,6 +7,7 @@ from pathlib import Path
 
 # Import base settings
 from .settings import *
+from .sqlite import performance_settings
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = False
@@ -17,11 +18,79 @@ ALLOWED_HOSTS = ['your-app-name.herokuapp.com', 'localhost', '127.0.0.1']
 DATABASES = {
     'default': dj_database_url.config(
         default=os.environ.get('DATABASE_URL'),
-        conn_max_age=600,
+        # Set DB_CONN_MAX_AGE=0 under ASGI, where requests do not keep to one thread
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', 600)),
         conn_health_checks=True,
     )
 }
 
+# Small deployments run on SQLite on purpose; tune it for concurrent workers
+if DATABASES['default'].get('ENGINE') == 'django.db.backends.sqlite3':
+    DATABASES['default'].update(performance_settings(conn_max_age=DATABASES['default']['CONN_MAX_AGE']))
+
+# Read replicas, as space-separated database URLs (see advanced_blog/routers.py)
+for number, url in enumerate(os.environ.get('DATABASE_REPLICA_URLS', '').split(), start=1):
+    DATABASES[f'replica{number}'] = {
+        **dj_database_url.parse(url, conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+                                conn_health_checks=True),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+# Async read-only views, for the ASGI deployment (see README)
+BLOG_ASYNC_VIEWS = os.environ.get('BLOG_ASYNC_VIEWS', '') == '1'
+
+# gunicorn runs behind the platform's router, which appends the client IP to X-Forwarded-For
+BLOG_TRUSTED_PROXIES = int(os.environ.get('BLOG_TRUSTED_PROXIES', '1'))
+
+# Batch comment writes under load (see blog/comments.py)
+BLOG_COMMENT_BUFFER_SIZE = int(os.environ.get('BLOG_COMMENT_BUFFER_SIZE', '0'))
+
+# Compile each template once per process instead of on every render
+TEMPLATES = [{
+    **TEMPLATES[0],
+    'APP_DIRS': False,
+    'OPTIONS': {
+        **TEMPLATES[0]['OPTIONS'],
+        'loaders': [
+            ('django.template.loaders.cached.Loader', [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ]),
+        ],
+    },
+}]
+
+# File-based cache shared by all gunicorn workers on the node
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', '/var/tmp/advanced_blog_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    }
+}
+
+# Outgoing mail for the notification worker
+EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 25))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', '') == '1'
+EMAIL_TIMEOUT = 10
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'webmaster@localhost')
+
+# Measure a tenth of the requests by default
+REQUEST_METRICS_SAMPLE_RATE = float(os.environ.get('REQUEST_METRICS_SAMPLE_RATE', '0.1'))
+
+# Metrics files shared by the gunicorn workers; scrape /metrics/ with the token
+METRICS_DIR = os.environ.get('METRICS_DIR', '/var/tmp/advanced_blog_metrics')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Request paths and timings are not for everyone: no token, no metrics
+METRICS_PUBLIC = False
+
 # Static files (CSS, JavaScript, Images)
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATIC_URL = '/static/'
@@ -51,4 +120,12 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
+    'loggers': {
+        # One JSON line per measured request
+        'advanced_blog.requests': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
 }
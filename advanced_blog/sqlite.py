@@ -0,0 +1,112 @@
+"""
+SQLite tuned for several worker processes sharing one database file.
+
+With the default rollback journal a writer locks readers out while it
+commits, and each commit syncs the journal and the database to disk, so
+gunicorn workers that read while comments are posted run into "database is
+locked". ``performance_settings()`` returns the ``DATABASES`` entries that
+avoid it:
+
+* ``journal_mode=WAL``: readers keep reading the last committed state while
+  one writer appends to the write-ahead log.
+* ``synchronous=NORMAL``: the log is synced at checkpoints rather than on
+  every commit. A power loss may drop the last transactions but never
+  corrupts the database.
+* ``busy_timeout``: a writer waits for the lock instead of failing at once.
+* ``cache_size`` and ``mmap_size``: more of the database stays in memory.
+* ``transaction_mode=IMMEDIATE``: ``atomic()`` takes the write lock when it
+  begins. A deferred transaction that reads before it writes would fail
+  with "database is locked" on the upgrade, whatever the busy timeout.
+* ``CONN_MAX_AGE``: a connection is reused by the requests of a worker
+  instead of being opened (and running these pragmas) for every request.
+
+This module is imported by the settings, so it does not import Django.
+``load_worker`` is the process that ``blog.benchmarks.run_sqlite_benchmark``
+starts to compare both configurations.
+"""
+import random
+import sqlite3
+import time
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    # Negative sizes are in KiB: 64 MiB of page cache per connection
+    'PRAGMA cache_size = -65536',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+
+
+def performance_settings(conn_max_age=600):
+    """``DATABASES`` entries to merge into a SQLite database's settings"""
+    return {
+        'OPTIONS': {
+            'init_command': ';'.join(PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'CONN_MAX_AGE': conn_max_age,
+        'CONN_HEALTH_CHECKS': True,
+    }
+
+
+def _connect(path, tuned):
+    # Autocommit with explicit transactions, as Django runs its connections
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('PRAGMA foreign_keys = ON')
+    if tuned:
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+    return connection
+
+
+def _read(connection, statements, post_id):
+    for sql, params in statements['read']:
+        connection.execute(sql, [post_id if param is None else param for param in params]).fetchall()
+
+
+def _write(connection, statements, post_id, user_id, tuned, now):
+    connection.execute('BEGIN IMMEDIATE' if tuned else 'BEGIN')
+    try:
+        connection.execute(statements['insert'], [post_id, user_id, 'Load test comment', now])
+        connection.execute(statements['recount'], [post_id, post_id])
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def load_worker(path, tuned, statements, post_ids, user_ids, write_share, start_at, seconds, seed):
+    """Read post pages and post comments until ``seconds`` after ``start_at``
+
+    Tuned workers keep one connection; the others open one per operation, as
+    Django does with ``CONN_MAX_AGE = 0``. Returns latencies in seconds per
+    kind of operation and the number of operations that failed.
+    """
+    rng = random.Random(seed)
+    result = {'read': [], 'write': [], 'errors': 0}
+    connection = _connect(path, tuned) if tuned else None
+    time.sleep(max(0.0, start_at - time.time()))
+    while time.time() < start_at + seconds:
+        kind = 'write' if rng.random() < write_share else 'read'
+        post_id = rng.choice(post_ids)
+        start = time.perf_counter()
+        current = connection or _connect(path, tuned)
+        try:
+            if kind == 'read':
+                _read(current, statements, post_id)
+            else:
+                _write(current, statements, post_id, rng.choice(user_ids), tuned,
+                       time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+        except sqlite3.OperationalError:
+            # "database is locked": the request would have failed with a 500
+            result['errors'] += 1
+            continue
+        finally:
+            if connection is None:
+                current.close()
+        result[kind].append(time.perf_counter() - start)
+    if connection is not None:
+        connection.close()
+    return result
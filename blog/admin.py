@@ -1,11 +1,13 @@
 from django.contrib import admin
-from .models import Category, Tag, Post, Comment
+from .models import Category, Tag, Post, Comment, Notification
+from .caching import invalidate, post_namespace
+from .counters import refresh_post_comment_counts
 
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     """Admin configuration for Category model"""
-    list_display = ['name', 'slug', 'created_at']
+    list_display = ['name', 'slug', 'post_count', 'created_at']
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ['name']
 
@@ -13,7 +15,7 @@ class CategoryAdmin(admin.ModelAdmin):
 @admin.register(Tag)
 class TagAdmin(admin.ModelAdmin):
     """Admin configuration for Tag model"""
-    list_display = ['name', 'slug', 'created_at']
+    list_display = ['name', 'slug', 'post_count', 'created_at']
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ['name']
 
@@ -21,7 +23,7 @@ class TagAdmin(admin.ModelAdmin):
 @admin.register(Post)
 class PostAdmin(admin.ModelAdmin):
     """Admin configuration for Post model"""
-    list_display = ['title', 'author', 'category', 'status', 'created_at', 'updated_at']
+    list_display = ['title', 'author', 'category', 'status', 'comment_count', 'created_at', 'updated_at']
     list_filter = ['status', 'category', 'created_at', 'author']
     search_fields = ['title', 'content']
     prepopulated_fields = {'slug': ('title',)}
@@ -49,15 +51,33 @@ class PostAdmin(admin.ModelAdmin):
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
     """Admin configuration for Comment model"""
-    list_display = ['user', 'post', 'is_approved', 'created_at']
-    list_filter = ['is_approved', 'created_at']
+    list_display = ['user', 'post', 'is_approved', 'spam_score', 'reviewed', 'created_at']
+    list_filter = ['is_approved', 'reviewed', 'created_at']
     search_fields = ['content', 'user__username', 'post__title']
     actions = ['approve_comments', 'disapprove_comments']
     
     def approve_comments(self, request, queryset):
-        queryset.update(is_approved=True)
+        self._set_approval(queryset, True)
     approve_comments.short_description = "Approve selected comments"
     
     def disapprove_comments(self, request, queryset):
-        queryset.update(is_approved=False)
+        self._set_approval(queryset, False)
     disapprove_comments.short_description = "Disapprove selected comments"
+    
+    def _set_approval(self, queryset, approved):
+        # Bulk updates skip model signals, so recount and purge the affected posts here
+        post_ids = set(queryset.values_list('post_id', flat=True))
+        # A moderator's decision stands when the spam rules run again
+        queryset.update(is_approved=approved, reviewed=True)
+        refresh_post_comment_counts(post_ids)
+        invalidate(*(post_namespace(slug) for slug in
+                     Post.objects.filter(pk__in=post_ids).values_list('slug', flat=True)))
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    """Admin configuration for the notification outbox"""
+    list_display = ['recipient', 'subject', 'status', 'attempts', 'next_attempt_at', 'locked_until', 'sent_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['recipient', 'subject']
+    readonly_fields = ['created_at', 'sent_at', 'last_error']
@@ -0,0 +1,227 @@
+"""
+Async versions of the read-only blog views, for running under an ASGI server.
+
+Enabled with ``BLOG_ASYNC_VIEWS = True`` (see ``blog/urls.py``); they return
+the same pages as their counterparts in ``views.py``. Templates render
+synchronously, so everything a template touches is loaded up front: the
+viewer and their profile, the rows with their prefetches, and counts.
+
+Queries that do not depend on each other are awaited together with
+``asyncio.gather``. Django runs the async ORM calls of one request on one
+thread and connection, so they do not execute in parallel; what async buys
+is that a worker keeps serving other clients while a request waits on the
+database or on a slow client.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.http import Http404, JsonResponse
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from accounts.models import UserProfile
+from . import comments
+from .caching import aresolve_user, cache_public_page, conditional_page
+from .forms import CommentForm, SearchForm
+from .models import Post, Category, Tag, Comment, RelatedPost
+from .pagination import CursorPaginator, SequencePaginator
+from .search import search_post_ids, posts_in_order
+from .trending import count_views
+from .views import (
+    COMMENT_ADDED, COMMENT_HELD, COMMENT_QUEUED, COMMENT_RATE_LIMITED, _comment_fragment, _comment_paginator,
+    _listing_last_modified, _per_page, _post_last_modified,
+)
+
+
+async def _load_viewer(request):
+    """Resolve the user and their profile, which the navbar reads while rendering"""
+    user = await aresolve_user(request)
+    # accounts.backends.ProfileModelBackend loads it with the user already
+    if user.is_authenticated and not type(user).profile.is_cached(user):
+        profile = await UserProfile.objects.filter(user=user).afirst()
+        if profile is not None:
+            user.profile = profile
+    return user
+
+
+def _listing(**filters):
+    return Post.objects.filter(status='published', **filters).select_related(
+        'author', 'category'
+    ).prefetch_related('tags').defer(*Post.BODY_FIELDS)
+
+
+@conditional_page('home', _listing_last_modified)
+@cache_public_page('home')
+async def home(request):
+    """Display list of published posts with pagination"""
+    paginator = CursorPaginator(_listing(), _per_page(), count_cache_key='blog:count:home')
+    page_obj, _, _ = await asyncio.gather(
+        paginator.aget_page(request.GET.get('cursor')),
+        paginator.aapproximate_count(),
+        _load_viewer(request),
+    )
+
+    context = {
+        'page_obj': page_obj,
+        'title': 'Home'
+    }
+    return render(request, 'blog/home.html', context)
+
+
+@count_views
+@conditional_page('post', _post_last_modified)
+@cache_public_page('post')
+async def post_detail(request, slug):
+    """Display single post with comments"""
+    post_query = Post.objects.select_related('author__profile', 'category').prefetch_related('tags').defer(
+        'content', 'content_images'
+    )
+    comment_paginator = _comment_paginator(Comment.objects.filter(post__slug=slug, is_approved=True))
+
+    related_query = RelatedPost.objects.filter(post__slug=slug).select_related('related').defer(
+        *(f'related__{name}' for name in Post.BODY_FIELDS)
+    )
+
+    async def related_list():
+        return [entry async for entry in related_query]
+
+    try:
+        post, comment_page, related_posts, user = await asyncio.gather(
+            post_query.aget(slug=slug), comment_paginator.aget_page(), related_list(), _load_viewer(request)
+        )
+    except Post.DoesNotExist:
+        raise Http404('No Post matches the given query.')
+
+    # Check if user can view the post
+    if post.status == 'draft' and (not user.is_authenticated or
+                                   (user != post.author and not user.is_staff)):
+        messages.error(request, 'This post is not available.')
+        return redirect('blog:home')
+
+    comment_form = CommentForm()
+    status = 200
+
+    # Handle comment submission
+    if request.method == 'POST' and user.is_authenticated:
+        comment_form = CommentForm(request.POST)
+        if comment_form.is_valid():
+            if not await sync_to_async(comments.allow)(request):
+                messages.error(request, COMMENT_RATE_LIMITED)
+                status = 429
+            else:
+                comment = comment_form.save(commit=False)
+                comment.post = post
+                comment.user = user
+                saved = await sync_to_async(comments.submit)(comment)
+                if not saved:
+                    messages.success(request, COMMENT_QUEUED)
+                elif comment.is_approved:
+                    messages.success(request, COMMENT_ADDED)
+                else:
+                    messages.info(request, COMMENT_HELD)
+                return redirect('blog:post_detail', slug=slug)
+
+    context = {
+        'post': post,
+        'comments': comment_page,
+        'related_posts': related_posts,
+        'comment_form': comment_form,
+        'title': post.title
+    }
+    return render(request, 'blog/post_detail.html', context, status=status)
+
+
+@conditional_page('post', _post_last_modified)
+async def post_comments(request, slug):
+    """Return the page of a post's approved comments after ``cursor``, for the post page to append"""
+    post, user = await asyncio.gather(
+        aget_object_or_404(Post.objects.only('slug', 'status', 'author'), slug=slug), aresolve_user(request)
+    )
+    if post.status == 'draft' and (not user.is_authenticated or
+                                   (user.pk != post.author_id and not user.is_staff)):
+        raise Http404('No Post matches the given query.')
+
+    page_obj = await _comment_paginator(post.approved_comments).aget_page(request.GET.get('cursor'))
+    return JsonResponse(_comment_fragment(request, post, page_obj))
+
+
+@cache_public_page('trending')
+async def trending(request):
+    """Display the most viewed posts of recent days, as last materialized by refresh_trending"""
+    posts = _listing(trending__isnull=False).order_by('trending__rank')
+
+    async def post_list():
+        return [post async for post in posts]
+
+    posts, _ = await asyncio.gather(post_list(), _load_viewer(request))
+
+    context = {
+        'posts': posts,
+        'title': 'Trending'
+    }
+    return render(request, 'blog/trending.html', context)
+
+
+@conditional_page('category', lambda slug: _listing_last_modified(category__slug=slug))
+@cache_public_page('category')
+async def category_posts(request, slug):
+    """Display posts by category"""
+    paginator = CursorPaginator(_listing(category__slug=slug), _per_page())
+    category, page_obj, _ = await asyncio.gather(
+        aget_object_or_404(Category, slug=slug),
+        paginator.aget_page(request.GET.get('cursor')),
+        _load_viewer(request),
+    )
+
+    context = {
+        'page_obj': page_obj,
+        'category': category,
+        'title': f'Category: {category.name}'
+    }
+    return render(request, 'blog/category_posts.html', context)
+
+
+@conditional_page('tag', lambda slug: _listing_last_modified(tags__slug=slug))
+@cache_public_page('tag')
+async def tag_posts(request, slug):
+    """Display posts by tag"""
+    paginator = CursorPaginator(_listing(tags__slug=slug), _per_page())
+    tag, page_obj, _ = await asyncio.gather(
+        aget_object_or_404(Tag, slug=slug),
+        paginator.aget_page(request.GET.get('cursor')),
+        _load_viewer(request),
+    )
+
+    context = {
+        'page_obj': page_obj,
+        'tag': tag,
+        'title': f'Tag: {tag.name}'
+    }
+    return render(request, 'blog/tag_posts.html', context)
+
+
+async def search(request):
+    """Search published posts through the full-text index, best match first"""
+    form = SearchForm(request.GET)
+    post_ids = []
+    query = ''
+
+    if form.is_valid():
+        query = form.cleaned_data['query']
+        if query:
+            # Raw index queries go through a cursor, which has no async API
+            post_ids = await sync_to_async(search_post_ids)(query)
+
+    page_obj = SequencePaginator(post_ids, _per_page()).get_page(request.GET.get('cursor'))
+    page_obj.object_list, _ = await asyncio.gather(
+        sync_to_async(posts_in_order)(page_obj.object_list),
+        _load_viewer(request),
+    )
+
+    context = {
+        'page_obj': page_obj,
+        'form': form,
+        'query': query,
+        'title': f'Search: {query}' if query else 'Search'
+    }
+    return render(request, 'blog/search.html', context)
@@ -0,0 +1,487 @@
+"""
+Benchmark harness for every blog and accounts view.
+
+Each ``Scenario`` requests one URL with the Django test client, as an
+anonymous visitor, a reader or an author, and records the wall time, the
+number of SQL queries and the time spent in them. A scenario fails when it
+runs more queries than its budget. Budgets are absolute, so a view that
+issues a query per row fails on a large data set (see ``generate_fixture``).
+
+Listing views are additionally requested with two page sizes: their query
+count must not depend on how many posts a page shows.
+
+``run_index_benchmark`` times the queries behind the listing indexes of
+``Post`` and ``Comment`` and records their query plans, with the indexes and
+after dropping them.
+
+``run_sqlite_benchmark`` compares SQLite with its default settings and in the
+tuned mode of ``advanced_blog.sqlite``: worker processes read post pages and
+post comments on two copies of the database.
+"""
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import ExitStack, closing
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+
+from accounts.models import UserProfile
+from advanced_blog.sqlite import load_worker
+from .models import Post, Category, Tag, Comment, RelatedPost
+from .pagination import FORWARD, CursorPaginator, encode_cursor
+from .trending import refresh_trending, write_views
+from .utils import text_hash
+
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+URL_NAMESPACES = ('blog', 'accounts')
+LISTING_SCENARIOS = ('blog:home', 'blog:category_posts', 'blog:tag_posts', 'blog:search')
+
+
+class Scenario:
+    """One request to benchmark
+
+    ``kwargs`` and ``query`` are callables receiving the benchmark targets and
+    returning the URL kwargs and query string; they run before every request,
+    outside the timed section.
+    """
+
+    def __init__(self, url_name, budget, user=None, kwargs=None, query=None, label=None):
+        self.url_name = url_name
+        self.budget = budget
+        self.user = user
+        self.kwargs = kwargs or (lambda targets: {})
+        self.query = query or (lambda targets: '')
+        self.label = label or url_name
+
+    def url(self, targets):
+        url = reverse(self.url_name, kwargs=self.kwargs(targets))
+        query = self.query(targets)
+        return f'{url}?{query}' if query else url
+
+
+def _fresh_comment(targets):
+    comment = Comment.objects.create(post=targets['post'], user=targets['reader'], content='Benchmark')
+    return {'comment_id': comment.pk}
+
+
+SCENARIOS = [
+    Scenario('blog:home', 4),
+    Scenario('blog:home', 4, query=lambda t: f"cursor={t['home_cursor']}", label='blog:home (page 2)'),
+    Scenario('blog:search', 3, query=lambda t: f"query={t['search']}"),
+    Scenario('blog:trending', 3),
+    Scenario('blog:post_detail', 5, kwargs=lambda t: {'slug': t['post'].slug}),
+    Scenario('blog:post_comments', 3, kwargs=lambda t: {'slug': t['post'].slug},
+             query=lambda t: f"cursor={t['comments_cursor']}"),
+    Scenario('blog:category_posts', 4, kwargs=lambda t: {'slug': t['category'].slug}),
+    Scenario('blog:tag_posts', 4, kwargs=lambda t: {'slug': t['tag'].slug}),
+    Scenario('blog:dashboard', 3, user='author'),
+    Scenario('blog:create_post', 4, user='author'),
+    Scenario('blog:edit_post', 7, user='author', kwargs=lambda t: {'slug': t['post'].slug}),
+    Scenario('blog:delete_post', 4, user='author', kwargs=lambda t: {'slug': t['post'].slug}),
+    Scenario('blog:delete_comment', 7, user='reader', kwargs=_fresh_comment),
+    Scenario('blog:manage_categories', 3, user='author'),
+    Scenario('blog:edit_category', 3, user='author', kwargs=lambda t: {'pk': t['category'].pk}),
+    Scenario('blog:delete_category', 4, user='author', kwargs=lambda t: {'pk': t['category'].pk}),
+    Scenario('blog:manage_tags', 3, user='author'),
+    Scenario('blog:delete_tag', 4, user='author', kwargs=lambda t: {'pk': t['tag'].pk}),
+    Scenario('accounts:register', 0),
+    Scenario('accounts:login', 0),
+    Scenario('accounts:logout', 4, user='reader'),
+    Scenario('accounts:profile', 2, user='reader'),
+]
+
+
+def url_names(namespaces=URL_NAMESPACES):
+    """Every named URL in the given namespaces, as ``namespace:name``"""
+    resolver = get_resolver()
+    names = set()
+    for namespace in namespaces:
+        _, sub_resolver = resolver.namespace_dict[namespace]
+        names.update(
+            f'{namespace}:{name}' for name in sub_resolver.reverse_dict if isinstance(name, str)
+        )
+    return names
+
+
+def uncovered_urls(scenarios=SCENARIOS):
+    return sorted(url_names() - {scenario.url_name for scenario in scenarios})
+
+
+def prepare_targets():
+    """Pick the heaviest objects of the current data set and create the benchmark users
+
+    Call inside a transaction that is rolled back afterwards.
+    """
+    post = Post.objects.filter(status='published').order_by('-comment_count', '-pk').first()
+    category = Category.objects.order_by('-post_count', 'pk').first()
+    tag = Tag.objects.order_by('-post_count', 'pk').first()
+    if post is None or category is None or tag is None:
+        raise ValueError('The benchmark needs published posts, categories and tags; run generate_fixture first.')
+
+    # The author of the most discussed post gets author rights, so edit and delete pages render
+    UserProfile.objects.filter(user=post.author_id).update(role='author')
+    reader = User.objects.create_user('benchmark-reader')
+    # Views are not part of the fixture; give the trending page a full ranking to render
+    popular = Post.objects.filter(status='published').order_by('-comment_count', '-pk')[:50]
+    write_views({slug: count + 1 for slug, count in popular.values_list('slug', 'comment_count')})
+    refresh_trending()
+
+    home = Post.objects.filter(status='published')
+    return {
+        'post': post,
+        'category': category,
+        'tag': tag,
+        'author': post.author,
+        'reader': reader,
+        'search': post.title.split()[0],
+        'home_cursor': CursorPaginator(home, getattr(settings, 'BLOG_POSTS_PER_PAGE', 6)).get_page().next_cursor or '',
+        'comments_cursor': CursorPaginator(
+            post.approved_comments, getattr(settings, 'BLOG_COMMENTS_PER_PAGE', 20)
+        ).get_page().next_cursor or '',
+    }
+
+
+class QueryRecorder:
+    """Database execute wrapper counting and timing every query
+
+    Unlike ``CaptureQueriesContext`` it keeps no query log, so views running
+    thousands of queries are still counted correctly.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+
+
+def _request(scenario, targets):
+    """Make one request and return ``(status, wall_ms, queries, query_ms)``"""
+    client = Client()
+    if scenario.user:
+        client.force_login(targets[scenario.user])
+    url = scenario.url(targets)
+
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        start = time.perf_counter()
+        response = client.get(url)
+        wall_ms = (time.perf_counter() - start) * 1000
+    return response.status_code, wall_ms, recorder.count, recorder.seconds * 1000
+
+
+def run_scenario(scenario, targets, iterations=10, warmup=1):
+    for _ in range(warmup):
+        _request(scenario, targets)
+    samples = [_request(scenario, targets) for _ in range(iterations)]
+    statuses = sorted({sample[0] for sample in samples})
+    wall = [sample[1] for sample in samples]
+    queries = max(sample[2] for sample in samples)
+    return {
+        'name': scenario.label,
+        'url': scenario.url(targets),
+        'user': scenario.user or 'anonymous',
+        'status': statuses,
+        'iterations': iterations,
+        'wall_ms': {
+            'min': round(min(wall), 3),
+            'median': round(statistics.median(wall), 3),
+            'max': round(max(wall), 3),
+        },
+        'queries': queries,
+        'query_ms': round(statistics.median(sample[3] for sample in samples), 3),
+        'budget': scenario.budget,
+        'over_budget': queries > scenario.budget,
+        'failed': any(status >= 400 for status in statuses),
+    }
+
+
+def check_page_sizes(targets, page_sizes=(6, 30), scenarios=SCENARIOS):
+    """Query counts of the listing views at each page size; they must all be equal"""
+    checks = []
+    for scenario in scenarios:
+        if scenario.label not in LISTING_SCENARIOS:
+            continue
+        counts = {}
+        for page_size in page_sizes:
+            with override_settings(BLOG_POSTS_PER_PAGE=page_size):
+                counts[page_size] = _request(scenario, targets)[2]
+        checks.append({
+            'name': scenario.label,
+            'queries': counts,
+            'constant': len(set(counts.values())) == 1,
+        })
+    return checks
+
+
+def run_benchmarks(iterations=10, warmup=1, use_cache=False, scenarios=SCENARIOS):
+    """Run every scenario and return the report as a dict
+
+    Unless ``use_cache`` is set, caching is disabled so the numbers describe
+    the full render path. Call inside a transaction that is rolled back.
+    """
+    with ExitStack() as stack:
+        # The test client's default host, as the test runner allows it
+        stack.enter_context(override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']))
+        if not use_cache:
+            stack.enter_context(override_settings(CACHES=NO_CACHE))
+        targets = prepare_targets()
+        results = [run_scenario(scenario, targets, iterations, warmup) for scenario in scenarios]
+        page_sizes = check_page_sizes(targets, scenarios=scenarios)
+
+    return {
+        'created_at': timezone.now().isoformat(),
+        'commit': current_commit(),
+        'database': connections['default'].vendor,
+        'cache': use_cache,
+        'dataset': {
+            'users': User.objects.count(),
+            'posts': Post.objects.count(),
+            'comments': Comment.objects.count(),
+        },
+        'uncovered_urls': uncovered_urls(scenarios),
+        'results': results,
+        'page_size_check': page_sizes,
+    }
+
+
+def current_commit():
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=settings.BASE_DIR, timeout=5,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.stdout.strip() or None
+
+
+def failures(report):
+    """Human-readable problems in a report; empty when everything passed"""
+    problems = [f'No benchmark scenario for {name}' for name in report['uncovered_urls']]
+    for result in report['results']:
+        if result['over_budget']:
+            problems.append(f"{result['name']}: {result['queries']} queries, budget {result['budget']}")
+        if result['failed']:
+            problems.append(f"{result['name']}: HTTP {result['status']}")
+    for check in report['page_size_check']:
+        if not check['constant']:
+            problems.append(f"{check['name']}: query count depends on page size {check['queries']}")
+    return problems
+
+
+def index_queries(targets):
+    """The queries served by the listing indexes, as ``{label: queryset}``"""
+    per_page = getattr(settings, 'BLOG_POSTS_PER_PAGE', 6)
+    listing = Post.objects.filter(status='published').select_related('author', 'category').defer(*Post.BODY_FIELDS)
+    middle = listing.order_by('-created_at', '-id')[listing.count() // 2]
+
+    comments = targets['post'].approved_comments.select_related('user__profile')
+
+    def page(queryset, cursor=None):
+        return CursorPaginator(queryset, per_page)._window(cursor)[0]
+
+    def comment_page(queryset, cursor=None):
+        return CursorPaginator(queryset, getattr(settings, 'BLOG_COMMENTS_PER_PAGE', 20))._window(cursor)[0]
+
+    def last_modified(queryset):
+        # The plan of the conditional GETs' MAX(updated_at)
+        return queryset.order_by('-updated_at').values('updated_at')[:1]
+
+    return {
+        'home': page(listing),
+        'home (last modified)': last_modified(listing),
+        'category (last modified)': last_modified(listing.filter(category=targets['category'])),
+        'home (middle page)': page(listing, encode_cursor(FORWARD, middle.created_at, middle.pk)),
+        'category': page(listing.filter(category=targets['category'])),
+        'tag': page(listing.filter(tags=targets['tag'])),
+        'dashboard': Post.objects.filter(author=targets['author']).select_related('category').defer(*Post.BODY_FIELDS),
+        'comments': comment_page(comments),
+        'comments (next page)': comment_page(comments, targets['comments_cursor']),
+    }
+
+
+def _explain(queryset, variant):
+    sql, params = queryset.query.sql_with_params()
+    # The comment gives each variant its own SQL text: SQLite's statement cache
+    # would otherwise return the plan prepared before the indexes were dropped
+    with connection.cursor() as cursor:
+        cursor.execute(f'{connection.ops.explain_query_prefix()} {sql} /* {variant} */', params)
+        return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+
+def _time_queries(queries, iterations, variant):
+    timings = {}
+    for label, queryset in queries.items():
+        samples = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            list(queryset.all())
+            samples.append((time.perf_counter() - start) * 1000)
+        timings[label] = {'plan': _explain(queryset, variant), 'median_ms': round(statistics.median(samples), 3)}
+    return timings
+
+
+def run_index_benchmark(iterations=20, models=(Post, Comment)):
+    """Time the index-backed queries with and without the listing indexes
+
+    The indexes are dropped for the second run. Call inside a transaction
+    that is rolled back, which brings them back; PostgreSQL locks the tables
+    meanwhile, so use a benchmark database.
+    """
+    indexes = [(model, index) for model in models for index in model._meta.indexes]
+    queries = index_queries(prepare_targets())
+    with_indexes = _time_queries(queries, iterations, 'with indexes')
+    with connection.cursor() as cursor:
+        for _, index in indexes:
+            cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+    without_indexes = _time_queries(queries, iterations, 'without indexes')
+
+    results = []
+    for label in queries:
+        before, after = without_indexes[label], with_indexes[label]
+        results.append({
+            'name': label,
+            'plan_without': before['plan'],
+            'plan_with': after['plan'],
+            'ms_without': before['median_ms'],
+            'ms_with': after['median_ms'],
+            'speedup': round(before['median_ms'] / after['median_ms'], 2) if after['median_ms'] else None,
+        })
+    return {
+        'created_at': timezone.now().isoformat(),
+        'commit': current_commit(),
+        'database': connection.vendor,
+        'indexes': [index.name for _, index in indexes],
+        'dataset': {'posts': Post.objects.count(), 'comments': Comment.objects.count()},
+        'iterations': iterations,
+        'results': results,
+    }
+
+
+# Stands in for the post id in the SQL handed to the load workers
+LOAD_POST_ID = -1
+
+
+def _load_statement(queryset):
+    sql, params = queryset.query.sql_with_params()
+    return sql.replace('%s', '?'), [None if param == LOAD_POST_ID else param for param in params]
+
+
+def load_statements():
+    """The SQL of a post page read and of a comment post, for ``advanced_blog.sqlite.load_worker``"""
+    comments = connection.ops.quote_name(Comment._meta.db_table)
+    posts = connection.ops.quote_name(Post._meta.db_table)
+    return {
+        'read': [
+            _load_statement(Post.objects.filter(pk=LOAD_POST_ID).select_related('author__profile', 'category')),
+            _load_statement(CursorPaginator(
+                Comment.objects.filter(post_id=LOAD_POST_ID, is_approved=True).select_related('user__profile'),
+                getattr(settings, 'BLOG_COMMENTS_PER_PAGE', 20),
+            )._window(None)[0]),
+            _load_statement(RelatedPost.objects.filter(post_id=LOAD_POST_ID).select_related('related').defer(
+                *(f'related__{name}' for name in Post.BODY_FIELDS)
+            )),
+        ],
+        # load_worker always posts the same text
+        'insert': (
+            f'INSERT INTO {comments} (post_id, user_id, content, content_hash, is_approved, reviewed, created_at) '
+            f"VALUES (?, ?, ?, '{text_hash('Load test comment')}', 1, 0, ?)"
+        ),
+        # The comment_count recount the counter refresh runs after a comment
+        'recount': (
+            f'UPDATE {posts} SET comment_count = (SELECT COUNT(*) FROM {comments} '
+            f'WHERE post_id = ? AND is_approved) WHERE id = ?'
+        ),
+    }
+
+
+def _copy_database(path):
+    """Copy the current database to ``path`` in the default rollback-journal mode"""
+    connection.ensure_connection()
+    with closing(sqlite3.connect(path)) as target:
+        connection.connection.backup(target)
+        target.execute('PRAGMA journal_mode = DELETE')
+
+
+def _percentile_ms(samples, share):
+    if not samples:
+        return None
+    return round(sorted(samples)[min(len(samples) - 1, int(len(samples) * share))] * 1000, 2)
+
+
+def _run_load(path, tuned, processes, seconds, write_share, statements, post_ids, user_ids):
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        # Leaves the workers time to start, so they all load the database at once
+        start_at = time.time() + 1
+        results = pool.starmap(load_worker, [
+            (path, tuned, statements, post_ids, user_ids, write_share, start_at, seconds, seed)
+            for seed in range(processes)
+        ])
+    reads = [sample for result in results for sample in result['read']]
+    writes = [sample for result in results for sample in result['write']]
+    return {
+        'mode': 'tuned' if tuned else 'default',
+        'reads': len(reads),
+        'writes': len(writes),
+        'errors': sum(result['errors'] for result in results),
+        'ops_per_second': round((len(reads) + len(writes)) / seconds, 1),
+        'read_p50_ms': _percentile_ms(reads, 0.5),
+        'read_p95_ms': _percentile_ms(reads, 0.95),
+        'write_p50_ms': _percentile_ms(writes, 0.5),
+        'write_p95_ms': _percentile_ms(writes, 0.95),
+    }
+
+
+def run_sqlite_benchmark(processes=4, seconds=5.0, write_share=0.2):
+    """Load copies of the database from ``processes`` workers, with default and tuned SQLite settings
+
+    Each worker reads post pages and, for ``write_share`` of its operations,
+    posts a comment, for ``seconds``. The copies are deleted afterwards.
+    """
+    if connection.vendor != 'sqlite':
+        raise ValueError('The SQLite benchmark needs a SQLite database.')
+    if connection.in_atomic_block:
+        # The backup API would wait for the transaction to end
+        raise ValueError('The SQLite benchmark copies the database and cannot run inside a transaction.')
+    post_ids = list(Post.objects.filter(status='published').order_by('-pk').values_list('id', flat=True)[:1000])
+    user_ids = list(User.objects.order_by('-pk').values_list('id', flat=True)[:200])
+    if not post_ids or not user_ids:
+        raise ValueError('The benchmark needs users and published posts; run generate_fixture first.')
+
+    statements = load_statements()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for tuned in (False, True):
+            path = os.path.join(directory, f"{'tuned' if tuned else 'default'}.sqlite3")
+            _copy_database(path)
+            results.append(_run_load(path, tuned, processes, seconds, write_share, statements, post_ids, user_ids))
+
+    default, tuned = results
+    return {
+        'created_at': timezone.now().isoformat(),
+        'commit': current_commit(),
+        'dataset': {'posts': Post.objects.count(), 'comments': Comment.objects.count()},
+        'processes': processes,
+        'seconds': seconds,
+        'write_share': write_share,
+        'results': results,
+        'speedup': round(tuned['ops_per_second'] / default['ops_per_second'], 2) if default['ops_per_second'] else None,
+    }
@@ -0,0 +1,246 @@
+"""
+Rendered-response cache and HTTP validators for the public blog pages.
+
+Every cached page belongs to a namespace: ``home``, ``post:<slug>``,
+``category:<slug>`` or ``tag:<slug>``. Each namespace has a version token that
+is folded into its page keys (together with the page cursor), so invalidating
+a namespace is a single write that makes all of its pages miss, without
+having to enumerate every cursor that was ever cached. Any Django cache
+backend works, including the local-memory and file-based ones.
+
+The same version token drives conditional GETs: the ETag and Last-Modified
+of a page are derived from the namespace version and the newest content
+timestamp, which is looked up once per version and then memoized. Cached
+template fragments of a post (its card) are keyed on the version of its
+``post:<slug>`` namespace as well, so they are retired together with its pages.
+"""
+import hashlib
+import uuid
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from advanced_blog import metrics
+
+KEY_PREFIX = 'blog:page'
+
+PAGE_CACHE_REQUESTS = metrics.Counter(
+    'blog_page_cache_requests_total', 'Anonymous page cache lookups, by result', ['result']
+)
+
+
+def page_cache_timeout():
+    return getattr(settings, 'BLOG_PAGE_CACHE_TIMEOUT', 300)
+
+
+def _version_key(namespace):
+    return f'{KEY_PREFIX}:version:{namespace}'
+
+
+def namespace_version(namespace):
+    """The current version token of a namespace; it changes whenever the namespace is invalidated"""
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # A fresh random token (rather than a counter restarting at 1) can never
+        # collide with pages cached under a version that was evicted
+        version = uuid.uuid4().hex
+        cache.add(_version_key(namespace), version, None)
+        version = cache.get(_version_key(namespace), version)
+    return version
+
+
+def page_key(namespace, cursor=''):
+    digest = hashlib.md5(cursor.encode(), usedforsecurity=False).hexdigest()
+    return f'{KEY_PREFIX}:{namespace}:{namespace_version(namespace)}:{digest}'
+
+
+def invalidate(*namespaces):
+    """Drop every cached page of the given namespaces"""
+    namespaces = {namespace for namespace in namespaces if namespace}
+    if namespaces:
+        cache.set_many({_version_key(namespace): uuid.uuid4().hex for namespace in namespaces}, None)
+
+
+def post_namespace(slug):
+    return f'post:{slug}' if slug else None
+
+
+def category_namespace(slug):
+    return f'category:{slug}' if slug else None
+
+
+def tag_namespace(slug):
+    return f'tag:{slug}' if slug else None
+
+
+def is_cacheable(request):
+    """Only anonymous GETs without pending flash messages share a rendered page"""
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and not len(messages.get_messages(request))
+    )
+
+
+def request_namespace(name, kwargs):
+    return f"{name}:{kwargs['slug']}" if 'slug' in kwargs else name
+
+
+async def aresolve_user(request):
+    """Load ``request.user`` without blocking, so sync code can then read it from async views"""
+    request.user = await request.auser()
+    return request.user
+
+
+def _cached_response(key):
+    cached = cache.get(key)
+    PAGE_CACHE_REQUESTS.inc(result='miss' if cached is None else 'hit')
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+
+
+def _store_response(request, key, response):
+    if (response.status_code == 200 and not response.streaming and not response.cookies
+            and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+        cache.set(key, (response.content, response['Content-Type']), page_cache_timeout())
+
+
+def cache_public_page(name):
+    """Serve the view from the page cache for anonymous visitors
+
+    The namespace is ``name``, or ``name:<slug>`` for views taking a slug.
+    Only plain 200 responses that set no cookies are stored. Works for sync
+    and async views.
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped(request, *args, **kwargs):
+                await aresolve_user(request)
+                if not is_cacheable(request):
+                    return await view_func(request, *args, **kwargs)
+                key = page_key(request_namespace(name, kwargs), request.GET.get('cursor', ''))
+                response = _cached_response(key)
+                if response is None:
+                    response = await view_func(request, *args, **kwargs)
+                    _store_response(request, key, response)
+                return response
+            return async_wrapped
+
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            if not is_cacheable(request):
+                return view_func(request, *args, **kwargs)
+            key = page_key(request_namespace(name, kwargs), request.GET.get('cursor', ''))
+            response = _cached_response(key)
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+                _store_response(request, key, response)
+            return response
+        return wrapped
+    return decorator
+
+
+def _last_modified(namespace, version, last_modified_func, args, kwargs):
+    """Newest content timestamp for a namespace version, computed once per version"""
+    key = f'{KEY_PREFIX}:modified:{namespace}:{version}'
+    last_modified = cache.get(key)
+    if last_modified is None:
+        last_modified = last_modified_func(*args, **kwargs)
+        if last_modified is not None:
+            cache.set(key, last_modified, page_cache_timeout())
+    return last_modified
+
+
+def _etag(request, namespace, version, last_modified):
+    viewer = request.user.pk or 'anonymous'
+    cursor = request.GET.get('cursor', '')
+    digest = hashlib.md5(
+        f'{namespace}|{version}|{last_modified.isoformat()}|{cursor}|{viewer}'.encode(),
+        usedforsecurity=False,
+    ).hexdigest()
+    return quote_etag(digest)
+
+
+def _patch_cache_headers(request, response, etag, last_modified):
+    response.headers.setdefault('ETag', etag)
+    response.headers.setdefault('Last-Modified', http_date(last_modified.timestamp()))
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        # Browsers revalidate every time; a shared cache in front may serve it for a while
+        patch_cache_control(response, public=True, max_age=0,
+                            s_maxage=getattr(settings, 'BLOG_CDN_MAX_AGE', 60))
+
+
+def _skips_validation(request):
+    # A 304 would swallow pending flash messages
+    return request.method not in ('GET', 'HEAD') or len(messages.get_messages(request))
+
+
+def conditional_page(name, last_modified_func):
+    """Answer conditional GETs with 304 before the view queries or renders anything
+
+    ``last_modified_func`` receives the view's URL kwargs and returns the
+    newest timestamp shown on the page, or ``None`` to skip validation. It
+    stays synchronous for async views and runs in a worker thread there.
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped(request, *args, **kwargs):
+                await aresolve_user(request)
+                if _skips_validation(request):
+                    return await view_func(request, *args, **kwargs)
+
+                namespace = request_namespace(name, kwargs)
+                version = namespace_version(namespace)
+                last_modified = await sync_to_async(_last_modified)(
+                    namespace, version, last_modified_func, args, kwargs
+                )
+                if last_modified is None:
+                    return await view_func(request, *args, **kwargs)
+
+                etag = _etag(request, namespace, version, last_modified)
+                response = get_conditional_response(
+                    request, etag=etag, last_modified=int(last_modified.timestamp())
+                )
+                if response is None:
+                    response = await view_func(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                _patch_cache_headers(request, response, etag, last_modified)
+                return response
+            return async_wrapped
+
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            if _skips_validation(request):
+                return view_func(request, *args, **kwargs)
+
+            namespace = request_namespace(name, kwargs)
+            version = namespace_version(namespace)
+            last_modified = _last_modified(namespace, version, last_modified_func, args, kwargs)
+            if last_modified is None:
+                return view_func(request, *args, **kwargs)
+
+            etag = _etag(request, namespace, version, last_modified)
+            response = get_conditional_response(
+                request, etag=etag, last_modified=int(last_modified.timestamp())
+            )
+            if response is None:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            _patch_cache_headers(request, response, etag, last_modified)
+            return response
+        return wrapped
+    return decorator
@@ -0,0 +1,150 @@
+"""
+Comment ingestion: per-user and per-IP rate limiting, and optional batched writes.
+
+``allow`` is a token bucket per signed-in user and one per client IP (see
+``utils.client_ip`` for deployments behind proxies), kept in the cache so
+all worker processes share them. Each bucket holds up to
+``BLOG_COMMENT_BURST`` tokens and regains ``BLOG_COMMENT_RATE`` tokens per
+minute; posting a comment takes one token from both. A check is one
+``get_many`` and one ``set_many`` whatever the traffic. The read and the
+write are not atomic, so concurrent requests of one client may overdraw its
+bucket by a token or two, which is fine for throttling spam.
+
+``submit`` saves a comment, held back when the spam rules of
+``blog.moderation`` say so. With ``BLOG_COMMENT_BUFFER_SIZE`` set, comments
+are instead queued in process memory and written in one transaction once
+that many are queued or ``BLOG_COMMENT_FLUSH_INTERVAL`` seconds after the
+first one, so a burst of comments takes the write lock (and recounts the
+comment counters) once rather than per comment. Buffered comments appear on
+the post with that delay, and those still queued when a process is killed
+are lost; the buffer is flushed when the interpreter exits normally.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connections, transaction
+
+from . import moderation
+from .utils import client_ip
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'blog:comment-bucket'
+
+
+def _buckets(request):
+    keys = [f'{KEY_PREFIX}:ip:{client_ip(request)}']
+    if request.user.is_authenticated:
+        keys.append(f'{KEY_PREFIX}:user:{request.user.pk}')
+    return keys
+
+
+def allow(request, now=None):
+    """Take a token from the client's buckets; False when one of them is empty"""
+    burst = getattr(settings, 'BLOG_COMMENT_BURST', 5)
+    per_second = getattr(settings, 'BLOG_COMMENT_RATE', 6) / 60
+    now = time.time() if now is None else now
+    keys = _buckets(request)
+    stored = cache.get_many(keys)
+    buckets = {}
+    for key in keys:
+        tokens, updated = stored.get(key, (burst, now))
+        buckets[key] = min(burst, tokens + (now - updated) * per_second)
+    if any(tokens < 1 for tokens in buckets.values()):
+        return False
+    # A bucket left alone until it is full again is not worth keeping
+    cache.set_many({key: (tokens - 1, now) for key, tokens in buckets.items()}, int(burst / per_second) + 1)
+    return True
+
+
+class CommentBuffer:
+    """Unsaved comments, kept in process memory until flushed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._comments = []
+        self._timer = None
+
+    def add(self, comment):
+        """Queue a comment and return whether the buffer is due for a flush"""
+        with self._lock:
+            self._comments.append(comment)
+            self._start_timer()
+            return len(self._comments) >= getattr(settings, 'BLOG_COMMENT_BUFFER_SIZE', 0)
+
+    def _start_timer(self):
+        # Call with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(getattr(settings, 'BLOG_COMMENT_FLUSH_INTERVAL', 2), self._flush_in_thread)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def take(self):
+        """Empty the buffer and return its comments"""
+        with self._lock:
+            comments, self._comments = self._comments, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return comments
+
+    def flush(self):
+        comments = self.take()
+        if not comments:
+            return
+        try:
+            write_comments(comments)
+        except IntegrityError:
+            _unsave(comments)
+            # A post or user deleted meanwhile; save the others on their own
+            for comment in comments:
+                try:
+                    write_comments([comment])
+                except IntegrityError:
+                    logger.warning('Dropped a buffered comment on post %s', comment.post_id, exc_info=True)
+        except DatabaseError:
+            logger.exception('Could not write %d buffered comments', len(comments))
+            _unsave(comments)
+            with self._lock:
+                self._comments[:0] = comments
+                self._start_timer()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread ends here; do not leave its connection open
+            connections.close_all()
+
+
+buffer = CommentBuffer()
+atexit.register(buffer.flush)
+
+
+def _unsave(comments):
+    # The rolled back transaction had given them primary keys
+    for comment in comments:
+        comment.pk = None
+        comment._state.adding = True
+
+
+def write_comments(comments):
+    """Score and save comments in one transaction; their signals update the counters once, on commit"""
+    moderation.screen(comments)
+    with transaction.atomic():
+        for comment in comments:
+            comment.save()
+
+
+def submit(comment):
+    """Save or queue a new comment; True when it is saved already"""
+    if not getattr(settings, 'BLOG_COMMENT_BUFFER_SIZE', 0):
+        write_comments([comment])
+        return True
+    if buffer.add(comment):
+        buffer.flush()
+    return False
@@ -0,0 +1,125 @@
+"""
+Denormalized counter columns.
+
+``Post.comment_count`` (approved comments), ``Category.post_count``,
+``Tag.post_count`` (published posts) and ``UserProfile.post_count`` /
+``UserProfile.comment_count`` are recomputed with one ``UPDATE ... SET n =
+(SELECT COUNT(*) ...)`` per kind of counter, so concurrent writers can never
+drift them apart. Refreshes requested from signals are collected and run once
+when the surrounding transaction commits.
+"""
+import threading
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+class CounterFieldsMixin:
+    """Leave maintained counter columns out of regular ``save()`` updates
+
+    Counters are written by ``UPDATE`` statements from this module, so saving
+    an instance loaded earlier must not overwrite them with stale values.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (self.counter_fields and not self._state.adding
+                and kwargs.get('update_fields') is None and not kwargs.get('force_insert')):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+
+def _count(queryset, outer_field, outer_ref='pk'):
+    """Correlated ``COUNT(*)`` subquery usable in ``update()``"""
+    subquery = queryset.filter(**{outer_field: OuterRef(outer_ref)}).order_by().values(
+        outer_field
+    ).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(subquery), 0)
+
+
+def _restrict(queryset, ids, field='pk'):
+    return queryset if ids is None else queryset.filter(**{f'{field}__in': ids})
+
+
+def refresh_post_comment_counts(post_ids=None):
+    """Recount approved comments for the given posts (all posts when ``None``)"""
+    Post = apps.get_model('blog', 'Post')
+    Comment = apps.get_model('blog', 'Comment')
+    return _restrict(Post.objects, post_ids).update(
+        comment_count=_count(Comment.objects.filter(is_approved=True), 'post')
+    )
+
+
+def refresh_category_post_counts(category_ids=None):
+    """Recount published posts for the given categories"""
+    Category = apps.get_model('blog', 'Category')
+    Post = apps.get_model('blog', 'Post')
+    return _restrict(Category.objects, category_ids).update(
+        post_count=_count(Post.objects.filter(status='published'), 'category')
+    )
+
+
+def refresh_tag_post_counts(tag_ids=None):
+    """Recount published posts for the given tags"""
+    Tag = apps.get_model('blog', 'Tag')
+    Post = apps.get_model('blog', 'Post')
+    return _restrict(Tag.objects, tag_ids).update(
+        post_count=_count(Post.tags.through.objects.filter(post__status='published'), 'tag')
+    )
+
+
+def refresh_profile_counts(user_ids=None):
+    """Recount published posts and comments for the given users' profiles"""
+    UserProfile = apps.get_model('accounts', 'UserProfile')
+    Post = apps.get_model('blog', 'Post')
+    Comment = apps.get_model('blog', 'Comment')
+    return _restrict(UserProfile.objects, user_ids, 'user').update(
+        post_count=_count(Post.objects.filter(status='published'), 'author', 'user'),
+        comment_count=_count(Comment.objects.all(), 'user', 'user'),
+    )
+
+
+REFRESHERS = {
+    'post': refresh_post_comment_counts,
+    'category': refresh_category_post_counts,
+    'tag': refresh_tag_post_counts,
+    'profile': refresh_profile_counts,
+}
+
+_pending = threading.local()
+
+
+def schedule_refresh(kind, ids):
+    """Queue a refresh of ``kind`` counters for ``ids`` until the transaction commits
+
+    Cascading deletes fire one signal per row; queuing lets a post with
+    thousands of comments be removed with a single recount per counter.
+    """
+    ids = {pk for pk in ids if pk is not None}
+    if not ids:
+        return
+    if getattr(_pending, 'ids', None) is None:
+        _pending.ids = defaultdict(set)
+    _pending.ids[kind].update(ids)
+    transaction.on_commit(flush_pending)
+
+
+def flush_pending():
+    """Run the queued counter refreshes"""
+    pending, _pending.ids = getattr(_pending, 'ids', None), None
+    for kind, ids in (pending or {}).items():
+        REFRESHERS[kind](ids)
+
+
+def reconcile_all():
+    """Recompute every counter from scratch and return the rows touched per kind"""
+    return {kind: refresh() for kind, refresh in REFRESHERS.items()}
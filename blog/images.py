@@ -0,0 +1,240 @@
+"""
+Resized variants of uploaded images, for ``srcset``.
+
+Featured images and avatars are displayed far smaller than they are
+uploaded. For every width of ``IMAGE_FIELDS`` below the original's (and the
+original width, capped at the largest), a WebP and a JPEG variant are written
+to the media storage as ``derived/<content hash>-<width>.<ext>``. Identical
+uploads share their variants, and a variant already on disk is not encoded
+again. The variants of an image are recorded in the ``<field>_variants``
+JSON field of its model, together with the name of the file they were made
+from, so templates build ``srcset`` without touching the disk. Images
+uploaded into a post's body get the same variants, recorded in
+``Post.content_images``; the body is then rendered again with their
+``srcset`` (see ``blog.rendering``).
+
+Variants are generated on a thread pool of ``BLOG_IMAGE_WORKERS`` threads,
+never in the request: after an upload commits, and when a template asks for
+the variants of an image that has none yet. Until they exist the original is
+served. ``generate_image_variants`` backfills existing media.
+"""
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connections
+from django.db.models import Q
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .caching import category_namespace, invalidate, post_namespace, tag_namespace
+from .rendering import render_content
+
+logger = logging.getLogger(__name__)
+
+# Widths per image field; cards and the post column are at most ~850px wide,
+# avatars 150px, and the larger widths serve high-density screens
+IMAGE_FIELDS = {
+    'blog.Post': ('featured_image', (400, 800, 1200, 1600)),
+    'accounts.UserProfile': ('avatar', (150, 300)),
+}
+FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+DERIVED_DIR = 'derived'
+
+
+def variants_field(model):
+    return f'{IMAGE_FIELDS[model._meta.label][0]}_variants'
+
+
+def image_field(model):
+    return IMAGE_FIELDS[model._meta.label][0]
+
+
+def _image_current(instance):
+    """Whether the recorded variants were made from the instance's current image"""
+    image = getattr(instance, image_field(type(instance)))
+    return not image or getattr(instance, variants_field(type(instance))).get('name') == image.name
+
+
+def pending_content_images(instance):
+    """Media images in a post's content whose variants are not made yet"""
+    return [name for name, manifest in getattr(instance, 'content_images', {}).items() if not manifest]
+
+
+def is_current(instance):
+    """Whether every image of the instance has its variants"""
+    return _image_current(instance) and not pending_content_images(instance)
+
+
+def _digest(image):
+    digest = hashlib.sha256()
+    image.open('rb')
+    try:
+        for chunk in image.chunks():
+            digest.update(chunk)
+    finally:
+        image.close()
+    return digest.hexdigest()[:32]
+
+
+def _encode(picture, width, fmt, options):
+    height = max(1, round(picture.height * width / picture.width))
+    resized = picture.resize((width, height), Image.Resampling.LANCZOS)
+    if fmt == 'JPEG' and resized.mode != 'RGB':
+        # JPEG has no alpha channel; flatten transparent areas onto white
+        rgba = resized.convert('RGBA')
+        resized = Image.new('RGB', rgba.size, 'white')
+        resized.paste(rgba, mask=rgba.getchannel('A'))
+    output = io.BytesIO()
+    resized.save(output, fmt, **options)
+    return output.getvalue()
+
+
+def make_variants(image, widths):
+    """Write the variants of an image file that are not on disk yet and return its manifest"""
+    manifest = {'name': image.name}
+    try:
+        digest = _digest(image)
+        with image.open('rb'), Image.open(image) as picture:
+            picture = ImageOps.exif_transpose(picture)
+            targets = sorted({width for width in widths if width < picture.width} | {min(picture.width, max(widths))})
+            manifest.update(width=picture.width, height=picture.height)
+            for extension, fmt, options in FORMATS:
+                manifest[extension] = []
+                for width in targets:
+                    name = f'{DERIVED_DIR}/{digest}-{width}.{extension}'
+                    if not default_storage.exists(name):
+                        name = default_storage.save(name, ContentFile(_encode(picture, width, fmt, options)))
+                    manifest[extension].append([width, name])
+    except (OSError, UnidentifiedImageError):
+        # Recorded without variants, so the original keeps being served and nobody retries
+        logger.warning('Could not make variants of %s', image.name, exc_info=True)
+        return {'name': image.name}
+    return manifest
+
+
+def _invalidate_post_pages(post):
+    namespaces = [post_namespace(post.slug)]
+    if post.status == 'published':
+        namespaces += ['home', 'trending', category_namespace(post.category.slug if post.category_id else None)]
+        namespaces += [tag_namespace(slug) for slug in post.tags.values_list('slug', flat=True)]
+    invalidate(*namespaces)
+
+
+def _content_image_variants(name, widths):
+    try:
+        stored = default_storage.open(name)
+    except OSError:
+        logger.warning('Image %s of a post is missing', name)
+        return {'name': name}
+    return {**make_variants(stored, widths), 'name': name}
+
+
+def generate(instance):
+    """Make and record the missing variants of the instance's images; False when there were none"""
+    if is_current(instance):
+        return False
+    model = type(instance)
+    field, widths = IMAGE_FIELDS[model._meta.label]
+    changes, unchanged = {}, {}
+    if not _image_current(instance):
+        image = getattr(instance, field)
+        changes[variants_field(model)] = make_variants(image, widths)
+        unchanged[field] = image.name
+
+    pending = pending_content_images(instance)
+    if pending:
+        # The body is rendered again to add the srcset of its images
+        instance.content_images = {
+            **instance.content_images, **{name: _content_image_variants(name, widths) for name in pending}
+        }
+        changes.update(content_images=instance.content_images,
+                       rendered_content=render_content(instance.content, instance.content_images).html)
+        unchanged['content'] = instance.content
+
+    # Unless the images were replaced meanwhile; the save that did it scheduled its own job.
+    # Purging the post's pages retires its cached card too.
+    if model.objects.filter(pk=instance.pk, **unchanged).update(**changes) and model._meta.label == 'blog.Post':
+        _invalidate_post_pages(instance)
+    return True
+
+
+_lock = threading.Lock()
+_queued = set()
+_executor = None
+
+
+def _run(label, pk):
+    close_old_connections()
+    try:
+        model = apps.get_model(label)
+        instance = model.objects.filter(pk=pk).first()
+        if instance is not None:
+            generate(instance)
+    except Exception:
+        logger.exception('Generating image variants of %s %s failed', label, pk)
+    finally:
+        with _lock:
+            _queued.discard((label, pk))
+        # The pool's threads outlive the job; do not leave a connection open in them
+        connections.close_all()
+
+
+def schedule(instance):
+    """Generate the variants of the instance's image on the thread pool, once per instance at a time"""
+    global _executor
+    key = (instance._meta.label, instance.pk)
+    workers = getattr(settings, 'BLOG_IMAGE_WORKERS', 2)
+    if not workers:
+        generate(instance)
+        return
+    with _lock:
+        if key in _queued:
+            return
+        _queued.add(key)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix='image-variants')
+    _executor.submit(_run, *key)
+
+
+def srcsets(instance):
+    """``{'webp': srcset, 'jpeg': srcset}`` for the instance's image, or None while it has no variants"""
+    if _image_current(instance):
+        manifest = getattr(instance, variants_field(type(instance)))
+        if manifest.get('webp'):
+            return {
+                extension: ', '.join(f'{default_storage.url(name)} {width}w' for width, name in manifest[extension])
+                for extension, _, _ in FORMATS
+            }
+    elif instance.pk:
+        schedule(instance)
+    return None
+
+
+def backfill(force=False):
+    """Make the variants of every stored image that has none; return how many objects were updated
+
+    ``force`` rebuilds every manifest, for new widths or formats; variants
+    already on disk are reused.
+    """
+    processed = 0
+    for label, (field, _) in IMAGE_FIELDS.items():
+        model = apps.get_model(label)
+        with_images = Q(**{f'{field}__gt': ''})
+        if label == 'blog.Post':
+            with_images |= ~Q(content_images={})
+        for instance in model.objects.filter(with_images).order_by('pk').iterator(chunk_size=200):
+            if force:
+                setattr(instance, variants_field(model), {})
+                if label == 'blog.Post':
+                    instance.content_images = dict.fromkeys(instance.content_images, {})
+            processed += generate(instance)
+    return processed
@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from blog.benchmarks import run_index_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Compare query plans and latency of the listing queries with and without their indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Timed executions per query and variant')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        # Dropping the indexes is rolled back together with the benchmark users
+        with transaction.atomic():
+            try:
+                report = run_index_benchmark(options['iterations'])
+            except ValueError as exc:
+                raise CommandError(exc)
+            transaction.set_rollback(True)
+
+        dataset = report['dataset']
+        self.stdout.write(
+            f"{dataset['posts']} posts, {dataset['comments']} comments on {report['database']} "
+            f"at {report['commit'] or 'unknown commit'}"
+        )
+        for result in report['results']:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{result['name']}: {result['ms_without']:.2f} ms -> {result['ms_with']:.2f} ms"
+                f" ({result['speedup'] or '-'}x)"
+            ))
+            self.stdout.write('  without indexes:\n' + self.indent(result['plan_without']))
+            self.stdout.write('  with indexes:\n' + self.indent(result['plan_with']))
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(report, handle, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+    def indent(self, plan):
+        return '\n'.join(f'    {line}' for line in plan.splitlines())
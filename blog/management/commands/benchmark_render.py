@@ -0,0 +1,66 @@
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from blog.models import Category, Tag
+
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                           'LOCATION': 'benchmark-render'}}
+
+
+class Command(BaseCommand):
+    help = 'Time listing page renders without and with fragment caching'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Requests per page and configuration')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+
+        # A signed-in reader skips the anonymous page cache, so every request renders
+        with transaction.atomic():
+            reader = User.objects.create_user('benchmark-render-reader')
+            client = Client(SERVER_NAME='localhost')
+            client.force_login(reader)
+            pages = self.listing_pages()
+
+            with override_settings(CACHES=NO_CACHE):
+                before = self.measure(client, pages, iterations)
+            with override_settings(CACHES=LOCAL_CACHE):
+                after = self.measure(client, pages, iterations)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{"page":<12}{"before ms":>12}{"after ms":>12}{"speedup":>10}')
+        for name in pages:
+            speedup = before[name] / after[name] if after[name] else 0
+            self.stdout.write(f'{name:<12}{before[name]:>12.2f}{after[name]:>12.2f}{speedup:>9.1f}x')
+
+    def listing_pages(self):
+        pages = {'home': reverse('blog:home'), 'search': reverse('blog:search') + '?query=the'}
+        category = Category.objects.order_by('-post_count').first()
+        if category:
+            pages['category'] = category.get_absolute_url()
+        tag = Tag.objects.order_by('-post_count').first()
+        if tag:
+            pages['tag'] = tag.get_absolute_url()
+        return pages
+
+    def measure(self, client, pages, iterations):
+        """Median milliseconds per request after one warm-up request per page"""
+        results = {}
+        for name, url in pages.items():
+            client.get(url)
+            timings = []
+            for _ in range(iterations):
+                start = time.perf_counter()
+                client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(timings)
+        return results
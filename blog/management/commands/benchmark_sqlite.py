@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from blog.benchmarks import run_sqlite_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Compare throughput of concurrent readers and comment writers on SQLite, default against tuned settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Concurrent worker processes')
+        parser.add_argument('--seconds', type=float, default=5.0, help='Duration of each run')
+        parser.add_argument('--write-share', type=float, default=0.2,
+                            help='Share of operations that post a comment')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        try:
+            report = run_sqlite_benchmark(options['processes'], options['seconds'], options['write_share'])
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        dataset = report['dataset']
+        self.stdout.write(
+            f"{dataset['posts']} posts, {dataset['comments']} comments; {report['processes']} processes "
+            f"for {report['seconds']}s each, {report['write_share']:.0%} writes"
+        )
+        for result in report['results']:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{result['mode']}: {result['ops_per_second']} ops/s, {result['errors']} locked"
+            ))
+            self.stdout.write(
+                f"  {result['reads']} reads (p50 {result['read_p50_ms']} ms, p95 {result['read_p95_ms']} ms), "
+                f"{result['writes']} writes (p50 {result['write_p50_ms']} ms, p95 {result['write_p95_ms']} ms)"
+            )
+        self.stdout.write(f"Tuned throughput: {report['speedup'] or '-'}x the default")
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(report, handle, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
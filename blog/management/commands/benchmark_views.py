@@ -0,0 +1,63 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from blog.benchmarks import failures, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every blog and accounts view and enforce their query budgets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10,
+                            help='Timed requests per view')
+        parser.add_argument('--warmup', type=int, default=1,
+                            help='Untimed requests per view before measuring')
+        parser.add_argument('--with-cache', action='store_true',
+                            help='Keep the configured cache instead of measuring uncached renders')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--compare', help='JSON report of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        # Benchmark users, sessions and comments are rolled back afterwards
+        with transaction.atomic():
+            try:
+                report = run_benchmarks(options['iterations'], options['warmup'], options['with_cache'])
+            except ValueError as exc:
+                raise CommandError(exc)
+            transaction.set_rollback(True)
+
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as handle:
+                baseline = {result['name']: result for result in json.load(handle)['results']}
+        self.print_results(report, baseline)
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(report, handle, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+
+        problems = failures(report)
+        if problems:
+            raise CommandError('Benchmark failed:\n  ' + '\n  '.join(problems))
+        self.stdout.write(self.style.SUCCESS('All views within their query budgets.'))
+
+    def print_results(self, report, baseline):
+        dataset = report['dataset']
+        self.stdout.write(
+            f"{dataset['users']} users, {dataset['posts']} posts, {dataset['comments']} comments "
+            f"on {report['database']} at {report['commit'] or 'unknown commit'}"
+        )
+        self.stdout.write(f'{"view":<28}{"median ms":>11}{"queries":>9}{"query ms":>10}{"budget":>8}  change')
+        for result in report['results']:
+            previous = baseline.get(result['name'])
+            change = ''
+            if previous:
+                before = previous['wall_ms']['median']
+                delta = (result['wall_ms']['median'] - before) / before * 100 if before else 0
+                change = f"{delta:+.0f}% time, {result['queries'] - previous['queries']:+d} queries"
+            line = (f"{result['name']:<28}{result['wall_ms']['median']:>11.2f}{result['queries']:>9}"
+                    f"{result['query_ms']:>10.2f}{result['budget']:>8}  {change}")
+            self.stdout.write(self.style.ERROR(line) if result['over_budget'] else line)
@@ -0,0 +1,301 @@
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as day_start, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from accounts.models import UserProfile
+from blog import related, search
+from blog.caching import invalidate
+from blog.counters import reconcile_all
+from blog.models import Category, Tag, Post, Comment
+from blog.utils import text_hash
+
+CATEGORY_NAMES = [
+    'Technology', 'Lifestyle', 'Travel', 'Food', 'Health', 'Science', 'Business',
+    'Culture', 'Sports', 'Education', 'Finance', 'Design', 'Music', 'Gaming', 'Parenting',
+]
+
+TAG_NAMES = [
+    'Python', 'Django', 'Web Development', 'Tutorial', 'Tips', 'Review', 'Guide', 'News',
+    'Opinion', 'How-to', 'JavaScript', 'Databases', 'Performance', 'Security', 'DevOps',
+    'Career', 'Productivity', 'Recipes', 'Fitness', 'Budget Travel', 'Photography',
+    'Open Source', 'Testing', 'Architecture', 'Machine Learning', 'Cloud', 'Mobile',
+    'Accessibility', 'UX', 'Startups', 'Interviews', 'Books', 'Podcasts', 'Events',
+    'Beginners', 'Advanced', 'Case Study', 'Checklist', 'Deep Dive', 'Announcement',
+]
+
+WORDS = (
+    'the of and to in is that for it with as was on be by this are from at or an have not '
+    'but they which one you were all we when there can more use each time data would been '
+    'code page server query cache model view template request response database index user '
+    'post comment author reader design build deploy test review write read learn simple fast '
+    'slow better small large system network memory process thread value result change update '
+    'project team product market travel city food recipe health sleep habit morning weekend '
+    'story journey idea plan goal habit step guide example pattern problem solution approach'
+).split()
+
+SENTENCE_POOL = 5000
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn']
+LAST_NAMES = ['Smith', 'Khan', 'Garcia', 'Chen', 'Okafor', 'Novak', 'Silva', 'Ali', 'Brown', 'Ivanova']
+
+
+def zipf_weights(n, exponent=1.1):
+    """Cumulative weights giving item ``i`` a share proportional to ``1 / (i + 1) ** exponent``"""
+    return list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(n)))
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Let ``bulk_create`` keep the ``created_at`` / ``updated_at`` values we set"""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Bulk-load a large, reproducible synthetic data set for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=10000)
+        parser.add_argument('--comments', type=int, default=50000)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed; the same seed and counts produce the same data')
+        parser.add_argument('--author-ratio', type=float, default=0.1,
+                            help='Share of generated users with the author role')
+        parser.add_argument('--draft-ratio', type=float, default=0.1,
+                            help='Share of generated posts left as drafts')
+        parser.add_argument('--days', type=int, default=730,
+                            help='Spread post dates over this many days before today')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per INSERT statement and transaction')
+        parser.add_argument('--prefix', default='load',
+                            help='Username and slug prefix, so several fixtures can coexist')
+        parser.add_argument('--skip-search-index', action='store_true',
+                            help='Do not rebuild the full-text search index afterwards')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = options['prefix']
+        # Midnight today rather than now, so reruns with the same seed match
+        self.until = timezone.make_aware(datetime.combine(timezone.localdate(), day_start.min))
+        self.since = self.until - timedelta(days=options['days'])
+        # Bodies are stitched from a fixed pool of sentences, which is far cheaper than
+        # generating every sentence word by word
+        self.sentences = [
+            ' '.join(self.rng.choices(WORDS, k=self.rng.randint(6, 22))).capitalize() + '.'
+            for _ in range(SENTENCE_POOL)
+        ]
+
+        if User.objects.filter(username__startswith=f'{self.prefix}-').exists():
+            raise CommandError(f'Users prefixed "{self.prefix}-" already exist; pass another --prefix.')
+        if options['users'] < 1:
+            raise CommandError('At least one user is needed.')
+
+        started = time.perf_counter()
+        categories = self.ensure_named(Category, CATEGORY_NAMES)
+        tags = self.ensure_named(Tag, TAG_NAMES)
+        # Shuffle so the most popular category and tags differ between seeds
+        self.rng.shuffle(categories)
+        self.rng.shuffle(tags)
+
+        with explicit_timestamps(User, UserProfile, Post, Comment):
+            user_ids, author_ids = self.create_users(options['users'], options['author_ratio'])
+            posts = self.create_posts(options['posts'], author_ids, categories, options['draft_ratio'])
+            self.create_post_tags(posts, tags)
+            self.create_comments(options['comments'], posts, user_ids)
+
+        # bulk_create sends no signals: recompute what the signal handlers maintain
+        self.stdout.write('Recomputing counters...')
+        reconcile_all()
+        self.stdout.write('Rebuilding related posts...')
+        related.rebuild_related()
+        if not options['skip_search_index']:
+            self.stdout.write('Rebuilding the search index...')
+            search.rebuild_index()
+        invalidate('home', *(f'category:{c.slug}' for c in categories), *(f'tag:{t.slug}' for t in tags))
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(user_ids)} users, {len(posts)} posts and {options["comments"]} comments '
+            f'in {elapsed:.1f}s.'
+        ))
+
+    def ensure_named(self, model, names):
+        model.objects.bulk_create(
+            [model(name=name, slug=slugify(name)) for name in names], ignore_conflicts=True
+        )
+        return list(model.objects.filter(name__in=names).order_by('name'))
+
+    def batches(self, rows):
+        iterator = iter(rows)
+        while batch := list(itertools.islice(iterator, self.batch_size)):
+            yield batch
+
+    def random_datetime(self, start, end):
+        return start + timedelta(seconds=self.rng.uniform(0, (end - start).total_seconds()))
+
+    def create_users(self, count, author_ratio):
+        self.stdout.write(f'Creating {count} users...')
+        # Hashing is deliberately slow; every generated user shares one password
+        password = make_password('password123')
+        author_count = max(1, int(count * author_ratio))
+        user_ids, author_ids = [], []
+
+        def users():
+            for i in range(count):
+                first, last = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+                username = f'{self.prefix}-{i:07d}'
+                yield User(
+                    username=username, email=f'{username}@example.com', password=password,
+                    first_name=first, last_name=last,
+                    date_joined=self.random_datetime(self.since, self.until),
+                )
+
+        for batch in self.batches(users()):
+            with transaction.atomic():
+                created = User.objects.bulk_create(batch)
+                profiles = []
+                for user in created:
+                    index = len(user_ids)
+                    role = 'admin' if index == 0 else 'author' if index <= author_count else 'reader'
+                    user_ids.append(user.pk)
+                    if role != 'reader':
+                        author_ids.append(user.pk)
+                    profiles.append(UserProfile(
+                        user_id=user.pk, role=role, created_at=user.date_joined,
+                        bio=f"I'm {user.first_name}, a {role} on this blog platform.",
+                    ))
+                UserProfile.objects.bulk_create(profiles)
+        return user_ids, author_ids
+
+    def paragraph(self, sentences):
+        return ' '.join(self.rng.choices(self.sentences, k=sentences))
+
+    def html_body(self):
+        """A few sections of headings, paragraphs and the odd list, link or code block
+
+        Returns the HTML and its plain text, so the text stats need no HTML parsing.
+        """
+        html, text = [], []
+
+        def add(markup, plain):
+            html.append(markup)
+            text.append(plain)
+
+        # Log-normal section counts: most posts are short, a few are very long
+        for _ in range(max(1, min(40, int(self.rng.lognormvariate(1.2, 0.6))))):
+            heading = self.paragraph(1)[:60].rstrip('.')
+            add(f'<h2>{heading}</h2>', heading)
+            for _ in range(self.rng.randint(1, 4)):
+                paragraph = self.paragraph(self.rng.randint(2, 6))
+                add(f'<p>{paragraph}</p>', paragraph)
+            roll = self.rng.random()
+            if roll < 0.2:
+                items = [self.paragraph(1) for _ in range(self.rng.randint(3, 6))]
+                add('<ul>\n%s\n</ul>' % '\n'.join(f'<li>{item}</li>' for item in items), ' '.join(items))
+            elif roll < 0.3:
+                code = ' '.join(self.rng.choices(WORDS, k=12))
+                add(f'<pre><code>{code}</code></pre>', code)
+            elif roll < 0.4:
+                word = self.rng.choice(WORDS)
+                add(f'<p>Read more about <a href="https://example.com/{word}">{word}</a>.</p>',
+                    f'Read more about {word}.')
+
+        # Newlines between blocks keep words apart once the tags are stripped
+        return '\n'.join(html), ' '.join(text)
+
+    def create_posts(self, count, author_ids, categories, draft_ratio):
+        self.stdout.write(f'Creating {count} posts...')
+        author_weights = zipf_weights(len(author_ids))
+        category_weights = zipf_weights(len(categories))
+        posts = []
+
+        def rows():
+            for i in range(count):
+                title = self.paragraph(1)[:80].rstrip('.')
+                created_at = self.random_datetime(self.since, self.until)
+                content, text = self.html_body()
+                post = Post(
+                    title=title,
+                    slug=f'{self.prefix}-{i}-{slugify(title)}'[:200],
+                    content=content,
+                    author_id=self.rng.choices(author_ids, cum_weights=author_weights)[0],
+                    category=self.rng.choices(categories, cum_weights=category_weights)[0],
+                    status='draft' if self.rng.random() < draft_ratio else 'published',
+                    created_at=created_at,
+                    updated_at=created_at,
+                )
+                post.set_text_stats(text)
+                post.update_rendered_content()
+                yield post
+
+        for batch in self.batches(rows()):
+            with transaction.atomic():
+                created = Post.objects.bulk_create(batch)
+            # Keep only what the later steps need, not the bodies
+            posts.extend((post.pk, post.created_at, post.status) for post in created)
+        return posts
+
+    def create_post_tags(self, posts, tags):
+        self.stdout.write('Tagging posts...')
+        Through = Post.tags.through
+        tag_weights = zipf_weights(len(tags))
+
+        def rows():
+            for post_id, _, _ in posts:
+                chosen = {self.rng.choices(tags, cum_weights=tag_weights)[0].pk
+                          for _ in range(self.rng.randint(0, 5))}
+                for tag_id in chosen:
+                    yield Through(post_id=post_id, tag_id=tag_id)
+
+        for batch in self.batches(rows()):
+            with transaction.atomic():
+                Through.objects.bulk_create(batch)
+
+    def create_comments(self, count, posts, user_ids):
+        published = [post for post in posts if post[2] == 'published']
+        if not count or not published:
+            return
+        self.stdout.write(f'Creating {count} comments...')
+        # A handful of popular posts collect most of the discussion
+        post_weights = zipf_weights(len(published), exponent=0.9)
+
+        def rows():
+            for _ in range(count):
+                post_id, created_at, _ = self.rng.choices(published, cum_weights=post_weights)[0]
+                user_id = self.rng.choice(user_ids)
+                content = self.paragraph(self.rng.randint(1, 4))
+                approved = self.rng.random() < 0.95
+                yield Comment(
+                    post_id=post_id,
+                    user_id=user_id,
+                    content=content,
+                    content_hash=text_hash(content),
+                    is_approved=approved,
+                    reviewed=not approved,
+                    created_at=self.random_datetime(created_at, self.until),
+                )
+
+        for batch in self.batches(rows()):
+            with transaction.atomic():
+                Comment.objects.bulk_create(batch)
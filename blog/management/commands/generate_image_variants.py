@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.images import backfill
+
+
+class Command(BaseCommand):
+    help = 'Make the resized variants of featured images and avatars that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild every manifest, e.g. after changing widths; existing files are reused')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        processed = backfill(force=options['force'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Made variants of {processed} images in {time.perf_counter() - started:.1f}s.'
+        ))
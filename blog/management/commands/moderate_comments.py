@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from blog.moderation import moderate
+
+
+class Command(BaseCommand):
+    help = 'Score unreviewed comments with the spam rules again and hold back or approve them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of comments loaded, scored and written per chunk')
+
+    def handle(self, *args, **options):
+        result = moderate(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Scored {result['scored']} comments: {result['held']} newly held back, "
+            f"{result['approved']} newly approved."
+        ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Backfill the fields derived from post content (text stats and the rendered body)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of posts loaded and written per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        fields = [*Post.TEXT_STAT_FIELDS, *Post.RENDERED_FIELDS]
+        posts = Post.objects.only('id', 'content', 'content_images').order_by('pk')
+
+        batch = []
+        updated = 0
+        for post in posts.iterator(chunk_size=batch_size):
+            post.update_text_stats()
+            post.update_rendered_content()
+            batch.append(post)
+            if len(batch) >= batch_size:
+                Post.objects.bulk_update(batch, fields)
+                updated += len(batch)
+                batch = []
+        if batch:
+            Post.objects.bulk_update(batch, fields)
+            updated += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} posts.'))
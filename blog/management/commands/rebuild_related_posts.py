@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.related import rebuild_related
+
+
+class Command(BaseCommand):
+    help = 'Recompute the related-posts list of every published post'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        entries = rebuild_related()
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {entries} related-post entries in {time.perf_counter() - started:.1f}s.'
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from blog.counters import reconcile_all
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized post, comment, category, tag and profile counters'
+
+    def handle(self, *args, **options):
+        for kind, rows in reconcile_all().items():
+            self.stdout.write(f'{kind}: {rows} rows recounted')
+        self.stdout.write(self.style.SUCCESS('Counters reconciled.'))
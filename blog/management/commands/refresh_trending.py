@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from blog.trending import refresh_trending
+
+
+class Command(BaseCommand):
+    help = 'Recompute the materialized trending posts ranking from the buffered view counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep refreshing instead of exiting after one refresh')
+        parser.add_argument('--interval', type=float, default=300.0,
+                            help='Seconds to sleep between refreshes')
+
+    def handle(self, *args, **options):
+        while True:
+            ranked = refresh_trending()
+            self.stdout.write(f'Ranked {ranked} trending posts')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+from blog.rendering import render_content
+
+
+def render_existing_posts(apps, schema_editor):
+    # Posts would otherwise show an empty body until rebuild_post_fields runs
+    Post = apps.get_model('blog', 'Post')
+    batch = []
+    for post in Post.objects.only('id', 'content').order_by('pk').iterator(chunk_size=500):
+        rendered = render_content(post.content)
+        post.rendered_content, post.toc = rendered.html, rendered.toc
+        post.content_images = dict.fromkeys(rendered.images, {})
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, ['rendered_content', 'toc', 'content_images'])
+            batch = []
+    Post.objects.bulk_update(batch, ['rendered_content', 'toc', 'content_images'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0010_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='content_images',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='rendered_content',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='toc',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.RunPython(render_existing_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+from blog.utils import text_hash
+
+
+def hash_existing_comments(apps, schema_editor):
+    Comment = apps.get_model('blog', 'Comment')
+    batch = []
+    for comment in Comment.objects.only('id', 'content').order_by('pk').iterator(chunk_size=2000):
+        comment.content_hash = text_hash(comment.content)
+        batch.append(comment)
+        if len(batch) >= 2000:
+            Comment.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    Comment.objects.bulk_update(batch, ['content_hash'])
+    # Only moderators disapproved comments so far; keep the rules from approving them again
+    Comment.objects.filter(is_approved=False).update(reviewed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0012_comment_cursor_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reviewed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='spam_score',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(hash_existing_comments, migrations.RunPython.noop),
+    ]
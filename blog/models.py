@@ -1,17 +1,24 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.utils.text import slugify
+from django.utils import timezone
+from django.utils.text import slugify, Truncator
 from ckeditor.fields import RichTextField
+from .counters import CounterFieldsMixin
+from .rendering import render_content
+from .utils import html_to_text, text_hash
 
 
-class Category(models.Model):
+class Category(CounterFieldsMixin, models.Model):
     """Model for blog post categories"""
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, unique=True, blank=True)
     description = models.TextField(blank=True)
+    post_count = models.PositiveIntegerField(default=0, editable=False, help_text='Published posts')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    counter_fields = ('post_count',)
+    
     class Meta:
         verbose_name_plural = 'Categories'
         ordering = ['name']
@@ -28,12 +35,15 @@ class Category(models.Model):
         return reverse('blog:category_posts', kwargs={'slug': self.slug})
 
 
-class Tag(models.Model):
+class Tag(CounterFieldsMixin, models.Model):
     """Model for blog post tags"""
     name = models.CharField(max_length=50, unique=True)
     slug = models.SlugField(max_length=50, unique=True, blank=True)
+    post_count = models.PositiveIntegerField(default=0, editable=False, help_text='Published posts')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    counter_fields = ('post_count',)
+    
     class Meta:
         ordering = ['name']
     
@@ -49,32 +59,92 @@ class Tag(models.Model):
         return reverse('blog:tag_posts', kwargs={'slug': self.slug})
 
 
-class Post(models.Model):
+class Post(CounterFieldsMixin, models.Model):
     """Model for blog posts"""
     STATUS_CHOICES = (
         ('draft', 'Draft'),
         ('published', 'Published'),
     )
+    EXCERPT_WORDS = 40
+    WORDS_PER_MINUTE = 200
+    TEXT_STAT_FIELDS = ('excerpt', 'word_count', 'reading_time')
+    RENDERED_FIELDS = ('rendered_content', 'toc', 'content_images')
+    # Only post_detail shows the body; listings defer these
+    BODY_FIELDS = ('content', 'rendered_content')
     
     title = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True, blank=True)
     content = RichTextField()
+    # content sanitized and enriched on save, as post_detail serves it (see blog.rendering)
+    rendered_content = models.TextField(blank=True, editable=False)
+    toc = models.JSONField(default=list, blank=True, editable=False)
+    # Variants of the media images in content, by storage name; empty until made (see blog.images)
+    content_images = models.JSONField(default=dict, blank=True, editable=False)
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='posts')
     tags = models.ManyToManyField(Tag, blank=True, related_name='posts')
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='draft')
     featured_image = models.ImageField(upload_to='post_images/', blank=True, null=True)
+    # Resized copies of featured_image for srcset (see blog.images)
+    featured_image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    excerpt = models.TextField(blank=True, editable=False)
+    word_count = models.PositiveIntegerField(default=0, editable=False)
+    reading_time = models.PositiveSmallIntegerField(default=1, editable=False, help_text='Minutes')
+    comment_count = models.PositiveIntegerField(default=0, editable=False, help_text='Approved comments')
+    view_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    counter_fields = ('comment_count', 'view_count')
+    
     class Meta:
-        ordering = ['-created_at']
+        # The id tie-breaker keeps keyset pagination stable for equal timestamps
+        ordering = ['-created_at', '-id']
+        # One per listing access path, in listing order, so a page is an index range scan
+        # (see benchmark_indexes); the partial ones leave drafts out of the published listings
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(status='published'),
+                         name='post_published_recent_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], condition=models.Q(status='published'),
+                         name='post_category_recent_idx'),
+            models.Index(fields=['author', '-created_at', '-id'], name='post_author_recent_idx'),
+            # The Last-Modified of the home and category listings, MAX(updated_at), as one index seek
+            models.Index(fields=['-updated_at'], condition=models.Q(status='published'),
+                         name='post_published_updated_idx'),
+            models.Index(fields=['category', '-updated_at'], condition=models.Q(status='published'),
+                         name='post_category_updated_idx'),
+        ]
     
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
+        
+        # Keep the plain-text stats and the rendered body in step with the body, without loading a deferred body
+        update_fields = kwargs.get('update_fields')
+        if 'content' not in self.get_deferred_fields() and (update_fields is None or 'content' in update_fields):
+            self.update_text_stats()
+            self.update_rendered_content()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *self.TEXT_STAT_FIELDS, *self.RENDERED_FIELDS}
         super().save(*args, **kwargs)
     
+    def update_text_stats(self):
+        """Recompute excerpt, word count and reading time from the HTML content"""
+        self.set_text_stats(html_to_text(self.content))
+    
+    def update_rendered_content(self):
+        """Render the HTML content for display, keeping the known variants of its images"""
+        rendered = render_content(self.content, self.content_images)
+        self.rendered_content = rendered.html
+        self.toc = rendered.toc
+        self.content_images = {name: self.content_images.get(name, {}) for name in rendered.images}
+    
+    def set_text_stats(self, text):
+        """Set excerpt, word count and reading time from already extracted plain text"""
+        self.word_count = len(text.split())
+        self.excerpt = Truncator(text).words(self.EXCERPT_WORDS)
+        self.reading_time = max(1, round(self.word_count / self.WORDS_PER_MINUTE))
+    
     def __str__(self):
         return self.title
     
@@ -91,11 +161,110 @@ class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments')
     content = models.TextField()
+    # Normalized digest of content, to find duplicates (see blog.moderation)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
     is_approved = models.BooleanField(default=True)
+    spam_score = models.FloatField(null=True, blank=True, editable=False)
+    # Approved or disapproved by a moderator; the spam rules leave it alone
+    reviewed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            # Post.approved_comments, its cursor pages and the comment_count recount
+            models.Index(fields=['post', '-created_at', '-id'], condition=models.Q(is_approved=True),
+                         name='comment_approved_recent_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if 'content' not in self.get_deferred_fields() and (update_fields is None or 'content' in update_fields):
+            self.content_hash = text_hash(self.content)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'content_hash'}
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f'Comment by {self.user.username} on {self.post.title}'
+
+
+class RelatedPost(models.Model):
+    """One entry of a published post's materialized related-posts list (see ``blog.related``)"""
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='related_entries')
+    related = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        ordering = ['post', 'rank']
+        constraints = [
+            # Also the index post_detail reads the list through
+            models.UniqueConstraint(fields=['post', 'rank'], name='related_post_rank_unique'),
+        ]
+    
+    def __str__(self):
+        return f'{self.related_id} related to {self.post_id} (#{self.rank + 1})'
+
+
+class PostViews(models.Model):
+    """Views of a post during one hour, written in batches by ``blog.trending``"""
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='hourly_views')
+    hour = models.DateTimeField()
+    views = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        verbose_name_plural = 'Post views'
+        constraints = [
+            models.UniqueConstraint(fields=['post', 'hour'], name='post_views_hour_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['hour'], name='post_views_hour_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.views} views of {self.post_id} at {self.hour:%Y-%m-%d %H:00}'
+
+
+class TrendingPost(models.Model):
+    """A post's place in the materialized trending ranking"""
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, related_name='trending')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField(unique=True)
+    
+    class Meta:
+        ordering = ['rank']
+    
+    def __str__(self):
+        return f'#{self.rank + 1}: {self.post_id}'
+
+
+class Notification(models.Model):
+    """Outbound email waiting in the outbox for the notification worker"""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+    
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # While ``sending``, the worker that claimed it has it until then
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['next_attempt_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='notification_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.subject} to {self.recipient} ({self.status})'
@@ -0,0 +1,174 @@
+"""
+Rule-based spam scoring of comments.
+
+A comment's ``spam_score`` is the sum of these rules:
+
+* Keywords: ``KEYWORD_WEIGHT`` for each of ``BLOG_SPAM_KEYWORDS`` in the text,
+  matched as whole words in any case.
+* Links: ``LINK_WEIGHT`` for each link beyond ``BLOG_SPAM_MAX_LINKS``.
+* Duplicates: ``DUPLICATE_WEIGHT`` for each other comment with the same
+  ``content_hash``, up to ``DUPLICATE_LIMIT`` copies. Texts shorter than
+  ``DUPLICATE_MIN_LENGTH`` are exempt; replies like "Thanks!" repeat innocently.
+* History: up to ``HISTORY_WEIGHT``, by the share of the author's reviewed
+  comments that a moderator disapproved. Authors with ``TRUSTED_APPROVALS``
+  comments approved by a moderator and none disapproved get ``TRUSTED_BONUS``
+  taken off. Comments the rules held back do not count, so the rules never
+  feed on their own results and scoring the backlog again changes nothing
+  until the data does.
+
+Comments scoring ``BLOG_SPAM_THRESHOLD`` or more are held back
+(``is_approved=False``) and the others are approved. Comments a moderator
+approved or disapproved in the admin are ``reviewed``, and the rules never
+change them.
+
+New comments are scored when they are saved through ``blog.comments``.
+``moderate`` (the ``moderate_comments`` command) scores the backlog again,
+for instance after the keyword list changed. It streams the comments in
+chunks, looks up the duplicates and author histories of a chunk with two
+aggregate queries and writes its results with one ``UPDATE``, so memory
+stays bounded by the chunk size whatever the number of comments.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Q, Value, When
+
+from .caching import invalidate, post_namespace
+from .counters import refresh_post_comment_counts
+from .models import Comment, Post
+from .utils import text_hash
+
+KEYWORD_WEIGHT = 0.5
+LINK_WEIGHT = 0.4
+DUPLICATE_WEIGHT = 0.25
+DUPLICATE_LIMIT = 4
+DUPLICATE_MIN_LENGTH = 20
+HISTORY_WEIGHT = 0.8
+TRUSTED_APPROVALS = 5
+TRUSTED_BONUS = 0.5
+
+LINK_RE = re.compile(r'https?://|www\.', re.IGNORECASE)
+
+
+@lru_cache(maxsize=8)
+def _keyword_re(keywords):
+    if not keywords:
+        return None
+    return re.compile(r'\b(?:%s)\b' % '|'.join(re.escape(keyword) for keyword in keywords), re.IGNORECASE)
+
+
+def threshold():
+    return getattr(settings, 'BLOG_SPAM_THRESHOLD', 1.0)
+
+
+def _duplicates(hashes):
+    """Comments per content hash"""
+    return dict(
+        Comment.objects.filter(content_hash__in=hashes).order_by().values('content_hash').annotate(
+            n=Count('*')
+        ).values_list('content_hash', 'n')
+    )
+
+
+def _histories(user_ids):
+    """``(reviewed comments, disapproved)`` per user"""
+    return {
+        row['user']: (row['total'], row['rejected'])
+        for row in Comment.objects.filter(user__in=user_ids, reviewed=True).order_by().values('user').annotate(
+            total=Count('id'), rejected=Count('id', filter=Q(is_approved=False))
+        )
+    }
+
+
+def score(comment, duplicates, histories):
+    """The spam score of a comment, given the counts looked up for its chunk"""
+    keywords = _keyword_re(tuple(getattr(settings, 'BLOG_SPAM_KEYWORDS', ())))
+    total = 0.0
+    if keywords is not None:
+        total += KEYWORD_WEIGHT * len({match.lower() for match in keywords.findall(comment.content)})
+    links = len(LINK_RE.findall(comment.content))
+    total += LINK_WEIGHT * max(0, links - getattr(settings, 'BLOG_SPAM_MAX_LINKS', 2))
+
+    # Counts include the comment itself once it is saved
+    saved = comment.pk is not None
+    if len(' '.join(comment.content.split())) >= DUPLICATE_MIN_LENGTH:
+        copies = duplicates.get(comment.content_hash, 0) - saved
+        total += DUPLICATE_WEIGHT * min(copies, DUPLICATE_LIMIT)
+
+    # Only unreviewed comments are scored, so the history never includes the comment itself
+    comments, rejected = histories.get(comment.user_id, (0, 0))
+    if comments:
+        total += HISTORY_WEIGHT * rejected / comments
+    if comments - rejected >= TRUSTED_APPROVALS and not rejected:
+        total -= TRUSTED_BONUS
+    return round(max(total, 0.0), 2)
+
+
+def score_all(comments):
+    """Score a chunk of unreviewed comments; each needs ``content`` and ``user_id``"""
+    for comment in comments:
+        comment.content_hash = comment.content_hash or text_hash(comment.content)
+    duplicates = _duplicates({comment.content_hash for comment in comments})
+    histories = _histories({comment.user_id for comment in comments})
+    return [score(comment, duplicates, histories) for comment in comments]
+
+
+def screen(comments):
+    """Score new comments and hold back the spam among them, before they are saved"""
+    for comment, spam_score in zip(comments, score_all(comments)):
+        comment.spam_score = spam_score
+        comment.is_approved = spam_score < threshold()
+
+
+def _apply(chunk):
+    """Write the scores of a chunk with one UPDATE and return the comments whose approval changed"""
+    scores = score_all(chunk)
+    by_score = {}
+    for comment, spam_score in zip(chunk, scores):
+        by_score.setdefault(spam_score, []).append(comment.pk)
+    held = [comment.pk for comment, spam_score in zip(chunk, scores) if spam_score >= threshold()]
+    changed = [
+        comment for comment, spam_score in zip(chunk, scores)
+        if comment.is_approved != (spam_score < threshold())
+    ]
+    Comment.objects.filter(pk__in=[comment.pk for comment in chunk]).update(
+        spam_score=Case(*(When(pk__in=pks, then=Value(value)) for value, pks in by_score.items())),
+        is_approved=Case(When(pk__in=held, then=Value(False)), default=Value(True)),
+    )
+    return changed
+
+
+def moderate(queryset=None, chunk_size=1000):
+    """Score every unreviewed comment of ``queryset`` (all by default) again
+
+    Returns the number of comments scored, newly held back and newly approved.
+    """
+    comments = (Comment.objects.all() if queryset is None else queryset).filter(reviewed=False).only(
+        'id', 'post_id', 'user_id', 'content', 'content_hash', 'is_approved'
+    ).order_by('pk')
+    result = {'scored': 0, 'held': 0, 'approved': 0}
+
+    def flush(chunk):
+        with transaction.atomic():
+            changed = _apply(chunk)
+        result['scored'] += len(chunk)
+        for comment in changed:
+            result['approved' if not comment.is_approved else 'held'] += 1
+        post_ids = {comment.post_id for comment in changed}
+        if post_ids:
+            # Bulk updates skip model signals, so recount and purge the affected posts here
+            refresh_post_comment_counts(post_ids)
+            invalidate(*(post_namespace(slug) for slug in
+                         Post.objects.filter(pk__in=post_ids).values_list('slug', flat=True)))
+
+    chunk = []
+    for comment in comments.iterator(chunk_size=chunk_size):
+        chunk.append(comment)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return result
@@ -0,0 +1,146 @@
+"""
+Database-backed outbox for email notifications.
+
+Request handlers only insert ``Notification`` rows, inside the same
+transaction as the change that caused them. The ``process_notifications``
+worker drains the outbox in batches over one pooled SMTP connection and
+retries failures with exponential backoff. A batch is leased to its worker
+(``sending`` until ``locked_until``) while it is sent; when a worker dies
+mid-batch, the lease runs out and another worker sends the batch again.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+# Seconds added to a lease for opening the connection and recording the results
+LEASE_MARGIN = 60
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before retry number ``attempts``: 30s, 60s, 120s, ... up to an hour"""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def notify_post_published(post):
+    """Queue the "new post published" email for every configured recipient"""
+    recipients = getattr(settings, 'BLOG_PUBLISH_NOTIFICATION_RECIPIENTS', [])
+    subject = f'New Post Published: {post.title}'
+    body = f'{post.author.username} has published a new post: {post.title}'
+    Notification.objects.bulk_create([
+        Notification(recipient=recipient, subject=subject, body=body) for recipient in recipients
+    ])
+
+
+def lease_seconds(batch_size):
+    """How long a worker keeps the batch it claimed: every send may take the full ``EMAIL_TIMEOUT``"""
+    return (batch_size + 1) * (getattr(settings, 'EMAIL_TIMEOUT', None) or 10) + LEASE_MARGIN
+
+
+def _claim(batch_size, max_attempts, now):
+    """Lease a batch of due notifications, and those whose worker died mid-send, in a short transaction"""
+    locked_until = now + timedelta(seconds=lease_seconds(batch_size))
+    with transaction.atomic():
+        # A notification that killed or hung its worker on every attempt is not leased again
+        Notification.objects.filter(status='sending', locked_until__lte=now, attempts__gte=max_attempts).update(
+            status='failed', locked_until=None, last_error='The worker sending it did not finish'
+        )
+        # skip_locked lets several workers claim concurrently where the database supports it
+        batch = list(
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending', next_attempt_at__lte=now) | Q(status='sending', locked_until__lte=now))
+            [:batch_size]
+        )
+        if batch:
+            # A claim counts as an attempt, so a notification that keeps killing its worker gives up
+            Notification.objects.filter(pk__in=[notification.pk for notification in batch]).update(
+                status='sending', locked_until=locked_until, attempts=F('attempts') + 1
+            )
+    for notification in batch:
+        notification.locked_until = locked_until
+        notification.attempts += 1
+    return batch
+
+
+def _send(batch):
+    """Send a batch over one SMTP connection and return the ``(sent, failed)`` notifications"""
+    sent, failed = [], []
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        logger.warning('Opening the mail connection failed: %s', exc)
+        for notification in batch:
+            notification.last_error = str(exc)
+        return sent, batch
+    try:
+        for notification in batch:
+            message = EmailMessage(
+                subject=notification.subject,
+                body=notification.body,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=[notification.recipient],
+                connection=connection,
+            )
+            try:
+                message.send()
+            except Exception as exc:
+                logger.warning('Sending notification %s failed: %s', notification.pk, exc)
+                notification.last_error = str(exc)
+                failed.append(notification)
+            else:
+                sent.append(notification)
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def drain_outbox(batch_size=50, max_attempts=5):
+    """Send one batch of due notifications and return ``(sent, failed)`` counts
+
+    The batch is claimed and its results are recorded in two short
+    transactions; the sends run outside any transaction, so slow SMTP never
+    holds row locks (or, on SQLite, the database write lock).
+    """
+    batch = _claim(batch_size, max_attempts, timezone.now())
+    if not batch:
+        return 0, 0
+    lease = batch[0].locked_until
+    sent, failed = _send(batch)
+
+    now = timezone.now()
+    for notification in sent:
+        notification.status = 'sent'
+        notification.sent_at = now
+        notification.locked_until = None
+    for notification in failed:
+        notification.locked_until = None
+        if notification.attempts >= max_attempts:
+            notification.status = 'failed'
+        else:
+            notification.status = 'pending'
+            notification.next_attempt_at = now + timedelta(seconds=backoff_delay(notification.attempts))
+
+    with transaction.atomic():
+        # Skip the notifications another worker reclaimed after our lease ran out
+        owned = set(
+            Notification.objects.select_for_update()
+            .filter(pk__in=[notification.pk for notification in batch], status='sending',
+                    locked_until=lease)
+            .values_list('pk', flat=True)
+        )
+        Notification.objects.bulk_update(
+            [notification for notification in sent + failed if notification.pk in owned],
+            ['status', 'sent_at', 'next_attempt_at', 'locked_until', 'last_error'],
+        )
+    return len(sent), len(failed)
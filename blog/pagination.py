@@ -0,0 +1,197 @@
+"""
+Keyset (cursor) pagination for post listings.
+
+Pages are addressed by an opaque token holding the ``(created_at, id)`` of the
+row at the edge of the previous page, so fetching any page is one indexed
+range scan of ``per_page + 1`` rows: no ``COUNT(*)`` and no ``OFFSET``.
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import Q, aprefetch_related_objects, prefetch_related_objects
+from django.utils.functional import cached_property
+
+FORWARD = 'n'
+BACKWARD = 'p'
+
+
+class InvalidCursor(ValueError):
+    """Raised for tokens that were not produced by this module"""
+
+
+def encode_cursor(direction, created_at, pk):
+    raw = f'{direction}|{created_at.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        direction, created_at, pk = raw.split('|')
+        if direction not in (FORWARD, BACKWARD):
+            raise ValueError(direction)
+        return direction, datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise InvalidCursor(token) from exc
+
+
+class CursorPage:
+    """A page of results with opaque tokens for its neighbours"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, paginator=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def approximate_count(self):
+        return self.paginator.approximate_count if self.paginator else len(self)
+
+
+class CursorPaginator:
+    """Paginate a queryset ordered by ``(-created_at, -id)``, matching ``Post.Meta.ordering``
+
+    ``count_cache_key`` enables ``approximate_count``: a ``COUNT(*)`` that is
+    only run when a template asks for it and then cached for ``count_timeout``.
+    """
+
+    def __init__(self, queryset, per_page, count_cache_key=None, count_timeout=300):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_cache_key = count_cache_key
+        self.count_timeout = count_timeout
+
+    def _window(self, token):
+        """The query for the rows around ``token``, one more than a page, and its direction"""
+        try:
+            direction, created_at, pk = decode_cursor(token) if token else (None, None, None)
+        except InvalidCursor:
+            direction = None
+
+        # Prefetch only for the rows shown, not the look-ahead row
+        queryset = self.queryset.prefetch_related(None)
+        # The leading range on created_at alone lets the database seek into the
+        # listing index instead of scanning it from the first row
+        if direction == BACKWARD:
+            queryset = queryset.filter(
+                Q(created_at__gte=created_at), Q(created_at__gt=created_at) | Q(pk__gt=pk)
+            ).order_by('created_at', 'pk')
+        else:
+            if direction == FORWARD:
+                queryset = queryset.filter(
+                    Q(created_at__lte=created_at), Q(created_at__lt=created_at) | Q(pk__lt=pk)
+                )
+            queryset = queryset.order_by('-created_at', '-pk')
+        return queryset[:self.per_page + 1], direction
+
+    def _page(self, rows, direction):
+        if direction == BACKWARD:
+            has_next, has_previous = True, len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+        else:
+            has_next, has_previous = len(rows) > self.per_page, direction == FORWARD
+            rows = rows[:self.per_page]
+
+        if not rows:
+            return CursorPage([], paginator=self)
+        first, last = rows[0], rows[-1]
+        return CursorPage(
+            rows,
+            next_cursor=encode_cursor(FORWARD, last.created_at, last.pk) if has_next else None,
+            previous_cursor=encode_cursor(BACKWARD, first.created_at, first.pk) if has_previous else None,
+            paginator=self,
+        )
+
+    def get_page(self, token=None):
+        """Return the page for ``token``, falling back to the first page for bad tokens"""
+        queryset, direction = self._window(token)
+        page = self._page(list(queryset), direction)
+        if page.object_list and self.queryset._prefetch_related_lookups:
+            prefetch_related_objects(page.object_list, *self.queryset._prefetch_related_lookups)
+        return page
+
+    async def aget_page(self, token=None):
+        """Async ``get_page``"""
+        queryset, direction = self._window(token)
+        page = self._page([row async for row in queryset], direction)
+        if page.object_list and self.queryset._prefetch_related_lookups:
+            await aprefetch_related_objects(page.object_list, *self.queryset._prefetch_related_lookups)
+        return page
+
+    @cached_property
+    def approximate_count(self):
+        if self.count_cache_key is None:
+            return self.queryset.count()
+        return cache.get_or_set(self.count_cache_key, self.queryset.count, self.count_timeout)
+
+    async def aapproximate_count(self):
+        """Async ``approximate_count``; templates then read the stored value"""
+        if 'approximate_count' not in self.__dict__:
+            count = None if self.count_cache_key is None else await cache.aget(self.count_cache_key)
+            if count is None:
+                count = await self.queryset.acount()
+                if self.count_cache_key is not None:
+                    await cache.aset(self.count_cache_key, count, self.count_timeout)
+            self.__dict__['approximate_count'] = count
+        return self.approximate_count
+
+
+class SequencePaginator:
+    """Cursor-style pages over an already materialized, bounded sequence
+
+    Used for ranked search results, where the ranking rather than
+    ``created_at`` defines the order. Tokens encode the offset into the list.
+    """
+
+    def __init__(self, items, per_page):
+        self.items = items
+        self.per_page = per_page
+
+    def _token(self, offset):
+        return base64.urlsafe_b64encode(f'o|{offset}'.encode()).decode().rstrip('=')
+
+    def _offset(self, token):
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+            marker, offset = raw.split('|')
+            offset = int(offset)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return 0
+        if marker != 'o' or not 0 <= offset < len(self.items):
+            return 0
+        return offset - offset % self.per_page
+
+    def get_page(self, token=None):
+        offset = self._offset(token) if token else 0
+        end = offset + self.per_page
+        return CursorPage(
+            self.items[offset:end],
+            next_cursor=self._token(end) if end < len(self.items) else None,
+            previous_cursor=self._token(offset - self.per_page) if offset else None,
+            paginator=self,
+        )
+
+    @property
+    def approximate_count(self):
+        return len(self.items)
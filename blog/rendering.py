@@ -0,0 +1,296 @@
+"""
+Render pipeline for post bodies.
+
+``render_content`` turns the HTML that CKEditor stores in ``Post.content``
+into the HTML post_detail outputs. It runs when a post is saved; the result
+is stored in ``Post.rendered_content``, so showing a post parses no HTML.
+
+* Only the tags, attributes, URL schemes and style properties listed below
+  are kept; the list covers what the CKEditor toolbar writes. Scripts,
+  styles, frames, forms and their contents are dropped; other unknown tags
+  are dropped but their text is kept. Text is escaped again, and unclosed
+  tags are closed.
+* Iframes are kept when they embed an https page of a host in
+  ``BLOG_EMBED_HOSTS``, sandboxed and loading lazily.
+* Links to other sites get ``rel="nofollow noopener"``, and those opening a
+  new window also ``noreferrer``.
+* Images load lazily. Images uploaded to the media storage are listed in
+  ``images`` of the result; when their resized variants are known (see
+  ``blog.images``) they are wrapped in a ``<picture>`` with ``srcset``.
+* Headings get ``id`` attributes, and ``h1`` to ``h3`` make up the table of
+  contents, as ``{'id', 'text', 'depth'}`` entries.
+"""
+import re
+from dataclasses import dataclass, field
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import unquote, urlsplit
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http.request import validate_host
+from django.utils.text import slugify
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'col', 'colgroup', 'dd', 'del', 'div', 'dl',
+    'dt', 'em', 'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd',
+    'li', 'mark', 'ol', 'p', 'pre', 's', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody',
+    'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+# Dropped together with everything inside them
+DROPPED_TAGS = {
+    'button', 'embed', 'form', 'frame', 'frameset', 'iframe', 'input', 'math', 'noscript', 'object',
+    'script', 'select', 'style', 'svg', 'template', 'textarea', 'title',
+}
+VOID_TAGS = {'br', 'col', 'hr', 'img'}
+# Elements that never have an end tag, allowed or not
+HTML_VOID_TAGS = VOID_TAGS | {'area', 'base', 'embed', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+ALLOWED_ATTRIBUTES = {
+    '*': {'class', 'style', 'title', 'lang', 'dir'},
+    'a': {'href', 'target', 'id', 'name'},
+    'iframe': {'src', 'width', 'height', 'frameborder', 'allowfullscreen', 'scrolling'},
+    'img': {'src', 'alt', 'width', 'height'},
+    'table': {'border', 'cellpadding', 'cellspacing', 'align', 'summary'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan', 'scope'},
+    'col': {'span'},
+    'colgroup': {'span'},
+    'ol': {'start', 'type'},
+}
+URL_ATTRIBUTES = {'href', 'src'}
+NUMBER_ATTRIBUTES = {'border', 'cellpadding', 'cellspacing', 'frameborder'}
+# Targets of in-page links, like the anchors of CKEditor's Anchor dialog
+ANCHOR_ATTRIBUTES = {'id', 'name'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto', 'tel'}
+# What CKEditor's toolbar and its image, table and div dialogs write into style attributes
+ALLOWED_STYLES = {
+    'background-color', 'border', 'border-collapse', 'border-color', 'border-style', 'border-width', 'color',
+    'float', 'font-family', 'font-size', 'font-style', 'font-weight', 'height', 'list-style-type', 'margin',
+    'margin-bottom', 'margin-left', 'margin-right', 'margin-top', 'padding', 'text-align', 'text-decoration',
+    'vertical-align', 'width',
+}
+UNSAFE_STYLE_RE = re.compile(r'url\s*\(|expression\s*\(|[\\<>]|/\*', re.IGNORECASE)
+NUMBER_RE = re.compile(r'\d{1,4}')
+ANCHOR_RE = re.compile(r'[A-Za-z][\w.:-]*')
+EMBED_HOSTS = ('www.youtube.com', 'www.youtube-nocookie.com', 'player.vimeo.com')
+EMBED_SANDBOX = 'allow-scripts allow-same-origin allow-popups allow-presentation'
+TOC_TAGS = ('h1', 'h2', 'h3')
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+IMAGE_SIZES = '(min-width: 992px) 856px, 100vw'
+
+
+@dataclass
+class RenderedContent:
+    html: str
+    toc: list = field(default_factory=list)
+    # Storage names of the media images the content shows
+    images: list = field(default_factory=list)
+
+
+def _split(url):
+    """``urlsplit`` of a URL, or None when it cannot be parsed (an unclosed IPv6 bracket, say)"""
+    try:
+        return urlsplit(url)
+    except ValueError:
+        return None
+
+
+def _safe_url(value):
+    value = value.strip()
+    # Browsers ignore control characters and whitespace inside a scheme, like "java\tscript:"
+    parts = _split(re.sub(r'[\x00-\x20]', '', value))
+    return value if value and parts is not None and parts.scheme.lower() in ALLOWED_SCHEMES else None
+
+
+def _safe_style(value):
+    declarations = []
+    for declaration in value.split(';'):
+        name, _, style = declaration.partition(':')
+        name, style = name.strip().lower(), style.strip()
+        if name in ALLOWED_STYLES and style and not UNSAFE_STYLE_RE.search(style):
+            declarations.append(f'{name}: {style}')
+    return '; '.join(declarations) or None
+
+
+def _embeddable(url):
+    parts = _split(url)
+    if parts is None:
+        return False
+    hosts = getattr(settings, 'BLOG_EMBED_HOSTS', EMBED_HOSTS)
+    return parts.scheme in ('https', '') and bool(parts.hostname) and parts.hostname in hosts
+
+
+def _is_external(url):
+    parts = _split(url)
+    host = parts.hostname if parts is not None else None
+    return bool(host) and not validate_host(host, settings.ALLOWED_HOSTS)
+
+
+def media_name(src):
+    """The storage name of an image served from MEDIA_URL, or None"""
+    parts = _split(src)
+    if parts is None:
+        return None
+    path = parts.path
+    if src.startswith(('http:', 'https:', '//')) or not path.startswith(settings.MEDIA_URL):
+        return None
+    return unquote(path[len(settings.MEDIA_URL):])
+
+
+def _srcset(entries):
+    return ', '.join(f'{default_storage.url(name)} {width}w' for width, name in entries)
+
+
+class ContentRenderer(HTMLParser):
+    def __init__(self, image_variants):
+        super().__init__(convert_charrefs=True)
+        self.image_variants = image_variants
+        self.output = []
+        self.open_tags = []
+        self.dropping = []
+        self.heading = None
+        self.toc = []
+        self.images = []
+        self.ids = set()
+
+    def attributes(self, tag, attrs):
+        allowed = ALLOWED_ATTRIBUTES['*'] | ALLOWED_ATTRIBUTES.get(tag, set())
+        kept = {}
+        for name, value in attrs:
+            name = name.lower()
+            if name not in allowed:
+                continue
+            # Boolean attributes like allowfullscreen come without a value
+            value = value or ''
+            if name in URL_ATTRIBUTES:
+                value = _safe_url(value)
+            elif name == 'style':
+                value = _safe_style(value)
+            elif name in NUMBER_ATTRIBUTES:
+                value = value.strip() if NUMBER_RE.fullmatch(value.strip()) else None
+            elif name in ANCHOR_ATTRIBUTES:
+                value = value if ANCHOR_RE.fullmatch(value) else None
+            # Other values may be empty, like alt="" on decorative images
+            if value is not None:
+                kept[name] = value
+        if 'id' in kept:
+            self.ids.add(kept['id'])
+        return kept
+
+    def emit(self, tag, attrs, void=False):
+        rendered = ''.join(f' {name}="{escape(value)}"' for name, value in attrs.items())
+        self.output.append(f'<{tag}{rendered}>')
+        if not void:
+            self.open_tags.append(tag)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS or self.dropping:
+            if tag == 'iframe' and not self.dropping:
+                self.embed(self.attributes(tag, attrs))
+            if tag in DROPPED_TAGS and tag not in HTML_VOID_TAGS:
+                self.dropping.append(tag)
+            return
+        if tag not in ALLOWED_TAGS:
+            return
+        attrs = self.attributes(tag, attrs)
+        if tag == 'a':
+            self.link(attrs)
+        elif tag == 'img':
+            self.image(attrs)
+            return
+        elif tag in HEADING_TAGS and self.heading is None:
+            self.heading = (tag, len(self.output), [])
+        self.emit(tag, attrs, void=tag in VOID_TAGS)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in HTML_VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.dropping:
+            if tag == self.dropping[-1]:
+                self.dropping.pop()
+            return
+        if tag not in self.open_tags:
+            return
+        while self.open_tags:
+            current = self.open_tags.pop()
+            self.output.append(f'</{current}>')
+            if self.heading and current == self.heading[0]:
+                self.close_heading()
+            if current == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        if self.heading:
+            self.heading[2].append(data)
+        self.output.append(escape(data, quote=False))
+
+    def link(self, attrs):
+        rel = []
+        if _is_external(attrs.get('href', '')):
+            rel += ['nofollow', 'noopener']
+        if attrs.get('target') == '_blank':
+            rel += [value for value in ('noopener', 'noreferrer') if value not in rel]
+        elif 'target' in attrs:
+            del attrs['target']
+        if rel:
+            attrs['rel'] = ' '.join(rel)
+
+    def image(self, attrs):
+        if 'src' not in attrs:
+            return
+        attrs.update(loading='lazy', decoding='async')
+        name = media_name(attrs['src'])
+        manifest = self.image_variants.get(name) if name else None
+        if name and name not in self.images:
+            self.images.append(name)
+        if manifest and manifest.get('webp'):
+            self.output.append(f'<picture><source type="image/webp" srcset="{escape(_srcset(manifest["webp"]))}" '
+                               f'sizes="{IMAGE_SIZES}">')
+            self.emit('img', {**attrs, 'srcset': _srcset(manifest['jpeg']), 'sizes': IMAGE_SIZES}, void=True)
+            self.output.append('</picture>')
+        else:
+            self.emit('img', attrs, void=True)
+
+    def embed(self, attrs):
+        if not _embeddable(attrs.get('src', '')):
+            return
+        attrs.update(sandbox=EMBED_SANDBOX, loading='lazy')
+        # The fallback content inside the iframe is dropped
+        self.emit('iframe', attrs, void=True)
+        self.output.append('</iframe>')
+
+    def close_heading(self):
+        tag, position, text = self.heading
+        self.heading = None
+        text = ' '.join(''.join(text).split())
+        base = slugify(text) or 'section'
+        anchor, number = base, 1
+        while anchor in self.ids:
+            number += 1
+            anchor = f'{base}-{number}'
+        self.ids.add(anchor)
+        # The start tag was emitted before its text was known
+        self.output[position] = self.output[position][:-1] + f' id="{anchor}">'
+        if tag in TOC_TAGS and text:
+            self.toc.append({'id': anchor, 'text': text, 'level': int(tag[1])})
+
+    def close(self):
+        super().close()
+        self.dropping = []
+        while self.open_tags:
+            self.handle_endtag(self.open_tags[-1])
+
+
+def render_content(html, image_variants=None):
+    """Sanitize and enrich post HTML; ``image_variants`` maps media image names to their manifests"""
+    renderer = ContentRenderer(image_variants or {})
+    renderer.feed(html or '')
+    renderer.close()
+    top = min((entry['level'] for entry in renderer.toc), default=1)
+    toc = [{'id': entry['id'], 'text': entry['text'], 'depth': entry['level'] - top} for entry in renderer.toc]
+    return RenderedContent(''.join(renderer.output), toc, renderer.images)
@@ -0,0 +1,146 @@
+"""
+Full-text search index for published posts.
+
+SQLite keeps an FTS5 virtual table (``blog_post_fts``) keyed by post id and
+PostgreSQL keeps a weighted ``search_vector`` tsvector column on ``blog_post``
+backed by a GIN index. Both are created by migration 0002 and kept current
+from the Post save/delete signals. Other databases fall back to ``icontains``.
+"""
+import re
+
+from django.db import connections, router, transaction
+from django.db.models import Q
+
+from .models import Post
+from .utils import html_to_text
+
+FTS_TABLE = 'blog_post_fts'
+SEARCH_CONFIG = 'english'
+MAX_RESULTS = 500
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def _connection(write=False):
+    alias = router.db_for_write(Post) if write else router.db_for_read(Post)
+    return connections[alias or 'default']
+
+
+def _document(post):
+    return html_to_text(post.title), html_to_text(post.content)
+
+
+def fts_match_expression(query):
+    """Build a safe FTS5 MATCH expression: every term quoted, the last one as a prefix"""
+    tokens = TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return ''
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def index_post(post):
+    """Add, refresh or drop a single post in the search index"""
+    connection = _connection(write=True)
+    published = post.status == 'published'
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [post.pk])
+            if published:
+                cursor.execute(
+                    f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (%s, %s, %s)',
+                    [post.pk, *_document(post)],
+                )
+    elif connection.vendor == 'postgresql':
+        title, body = _document(post) if published else ('', '')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE blog_post SET search_vector = CASE WHEN %s THEN '
+                'setweight(to_tsvector(%s, %s), \'A\') || setweight(to_tsvector(%s, %s), \'B\') '
+                'ELSE NULL END WHERE id = %s',
+                [published, SEARCH_CONFIG, title, SEARCH_CONFIG, body, post.pk],
+            )
+
+
+def remove_post(post_id):
+    """Drop a deleted post from the search index"""
+    connection = _connection(write=True)
+
+    # PostgreSQL keeps the vector on the post row itself, so it goes with it
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [post_id])
+
+
+def rebuild_index(chunk_size=500):
+    """Rebuild the whole index from the posts table and return the number of indexed posts"""
+    connection = _connection(write=True)
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return 0
+
+    posts = Post.objects.filter(status='published').only('id', 'title', 'content', 'status')
+    indexed = 0
+    # One transaction for the whole rebuild instead of a commit per post
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            insert = f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (%s, %s, %s)'
+            rows = []
+            for post in posts.iterator(chunk_size=chunk_size):
+                rows.append((post.pk, *_document(post)))
+                if len(rows) >= chunk_size:
+                    cursor.executemany(insert, rows)
+                    indexed += len(rows)
+                    rows = []
+            cursor.executemany(insert, rows)
+            indexed += len(rows)
+        else:
+            cursor.execute('UPDATE blog_post SET search_vector = NULL')
+            for post in posts.iterator(chunk_size=chunk_size):
+                index_post(post)
+                indexed += 1
+    return indexed
+
+
+def search_post_ids(query, limit=MAX_RESULTS):
+    """Return ids of published posts matching ``query``, best match first"""
+    connection = _connection()
+
+    if connection.vendor == 'sqlite':
+        expression = fts_match_expression(query)
+        if not expression:
+            return []
+        # Title matches weigh ten times as much as body matches
+        sql = (
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+            f'ORDER BY bm25({FTS_TABLE}, 10.0, 1.0) LIMIT %s'
+        )
+        params = [expression, limit]
+    elif connection.vendor == 'postgresql':
+        sql = (
+            'SELECT id FROM blog_post, websearch_to_tsquery(%s, %s) query '
+            'WHERE status = \'published\' AND search_vector @@ query '
+            'ORDER BY ts_rank_cd(search_vector, query) DESC, created_at DESC LIMIT %s'
+        )
+        params = [SEARCH_CONFIG, query, limit]
+    else:
+        return list(
+            Post.objects.filter(
+                Q(title__icontains=query) | Q(content__icontains=query),
+                status='published'
+            ).values_list('id', flat=True)[:limit]
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def posts_in_order(post_ids):
+    """Load the posts for ``post_ids`` keeping the ranking order"""
+    posts = Post.objects.filter(
+        pk__in=post_ids, status='published'
+    ).select_related('author', 'category').prefetch_related('tags').defer(*Post.BODY_FIELDS).in_bulk()
+    return [posts[pk] for pk in post_ids if pk in posts]
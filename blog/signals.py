@@ -1,25 +1,248 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.db import transaction
 from django.dispatch import receiver
-from django.core.mail import send_mail
-from django.conf import settings
-from .models import Post
+from accounts.models import UserProfile
+from advanced_blog import metrics
+from .models import Post, Comment, Category, Tag, RelatedPost
+from . import images, notifications, related, search
+from .caching import invalidate, post_namespace, category_namespace, tag_namespace
+from .counters import schedule_refresh
+
+COMMENTS_POSTED = metrics.Counter('blog_comments_posted_total', 'Comments posted')
+
+
+@receiver(post_save, sender=Post)
+def notify_on_publish(sender, instance, raw=False, **kwargs):
+    """Queue publish notifications in the outbox; the process_notifications worker sends them"""
+    if raw or instance.status != 'published':
+        return
+    previous = getattr(instance, '_previous_state', None)
+    if previous is None or previous['status'] != 'published':
+        notifications.notify_post_published(instance)
+
+
+@receiver(post_save, sender=Post)
+def update_search_index(sender, instance, **kwargs):
+    """Keep the full-text search index in step with the post"""
+    search.index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def remove_from_search_index(sender, instance, **kwargs):
+    """Drop deleted posts from the full-text search index"""
+    search.remove_post(instance.pk)
+
+
+@receiver(pre_save, sender=Post)
+def remember_previous_state(sender, instance, raw=False, **kwargs):
+    """Keep the stored status and category so post_save handlers can see what changed"""
+    instance._previous_state = None
+    if instance.pk and not raw:
+        instance._previous_state = Post.objects.filter(pk=instance.pk).values(
+            'status', 'slug', 'category_id', 'category__slug'
+        ).first()
+
+
+@receiver(post_save, sender=Post)
+def update_post_counters(sender, instance, created, **kwargs):
+    """Recount published posts when a post appears, is (un)published or moves category"""
+    previous = getattr(instance, '_previous_state', None)
+    if previous is None:
+        status_changed = instance.status == 'published'
+    else:
+        status_changed = previous['status'] != instance.status
+    category_changed = previous is not None and previous['category_id'] != instance.category_id
+    if not (status_changed or category_changed):
+        return
+
+    schedule_refresh('category', [instance.category_id, previous and previous['category_id']])
+    if status_changed:
+        schedule_refresh('profile', [instance.author_id])
+        if not created:
+            schedule_refresh('tag', instance.tags.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Post)
+def remember_post_tags(sender, instance, **kwargs):
+    """Tag links are gone by post_delete, so note them beforehand"""
+    instance._tags = list(instance.tags.values_list('id', 'slug'))
+
+
+@receiver(post_delete, sender=Post)
+def update_counters_on_post_delete(sender, instance, **kwargs):
+    """Recount the category, tags and author of a deleted post"""
+    schedule_refresh('category', [instance.category_id])
+    schedule_refresh('tag', [pk for pk, slug in getattr(instance, '_tags', [])])
+    schedule_refresh('profile', [instance.author_id])
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_tag_counters(sender, instance, action, reverse, pk_set, **kwargs):
+    """Recount tags whose post links changed"""
+    if not reverse and instance.status != 'published':
+        return
+    if action == 'pre_clear':
+        instance._cleared_ids = set(
+            instance.posts.values_list('id', flat=True) if reverse
+            else instance.tags.values_list('id', flat=True)
+        )
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_ids', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+
+    if reverse:
+        schedule_refresh('tag', [instance.pk])
+    else:
+        schedule_refresh('tag', pk_set or [])
+
+
+@receiver(post_save, sender=Post)
+def update_related_posts(sender, instance, raw=False, **kwargs):
+    """Refresh related-posts lists when a post is (un)published or moves category"""
+    if raw:
+        return
+    previous = getattr(instance, '_previous_state', None)
+    if previous is None:
+        changed = instance.status == 'published'
+    else:
+        changed = previous['status'] != instance.status or (
+            instance.status == 'published' and previous['category_id'] != instance.category_id
+        )
+    if changed:
+        related.schedule_update([instance.pk])
+
+
+@receiver(pre_delete, sender=Post)
+def remember_related_lists(sender, instance, **kwargs):
+    """The lists showing a deleted post lose their rows with it, so note them beforehand"""
+    instance._listed_in = list(RelatedPost.objects.filter(related=instance).values_list('post_id', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def update_related_on_delete(sender, instance, **kwargs):
+    related.schedule_update([], stale=getattr(instance, '_listed_in', []))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_related_on_retag(sender, instance, action, reverse, pk_set, **kwargs):
+    """Refresh related-posts lists of posts whose tag links changed"""
+    if action == 'pre_clear' and reverse:
+        instance._related_cleared = list(instance.posts.values_list('id', flat=True))
+    elif action == 'post_clear':
+        related.schedule_update(getattr(instance, '_related_cleared', []) if reverse else [instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        related.schedule_update(pk_set if reverse else [instance.pk])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def update_comment_counters(sender, instance, **kwargs):
+    """Recount the post's approved comments and the commenter's comments"""
+    schedule_refresh('post', [instance.post_id])
+    schedule_refresh('profile', [instance.user_id])
+
+
+@receiver(post_save, sender=Comment)
+def count_posted_comment(sender, instance, created, raw=False, **kwargs):
+    """Count new comments for the metrics endpoint"""
+    if created and not raw:
+        COMMENTS_POSTED.inc()
+
+
+@receiver(post_save, sender=Post)
+def invalidate_post_pages(sender, instance, **kwargs):
+    """Purge the post's detail page and, when it is or was listed, its listings"""
+    previous = getattr(instance, '_previous_state', None) or {}
+    namespaces = [post_namespace(instance.slug), post_namespace(previous.get('slug'))]
+    if 'published' in (instance.status, previous.get('status')):
+        namespaces += ['home', 'trending', category_namespace(previous.get('category__slug'))]
+        if instance.category_id:
+            namespaces.append(category_namespace(instance.category.slug))
+        namespaces += [tag_namespace(slug) for slug in instance.tags.values_list('slug', flat=True)]
+    invalidate(*namespaces)
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_deleted_post_pages(sender, instance, **kwargs):
+    """Purge every page that showed a deleted post"""
+    namespaces = ['home', 'trending', post_namespace(instance.slug)]
+    if instance.category_id:
+        namespaces.append(category_namespace(
+            Category.objects.filter(pk=instance.category_id).values_list('slug', flat=True).first()
+        ))
+    namespaces += [tag_namespace(slug) for pk, slug in getattr(instance, '_tags', [])]
+    invalidate(*namespaces)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def invalidate_tagged_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    """Purge the post and tag pages whose tag links changed"""
+    if action == 'pre_clear':
+        # Collect before the links disappear; post_clear has no pk_set
+        if reverse:
+            slugs = instance.posts.values_list('slug', flat=True)
+            instance._cleared_namespaces = [post_namespace(slug) for slug in slugs]
+        else:
+            slugs = instance.tags.values_list('slug', flat=True)
+            instance._cleared_namespaces = [tag_namespace(slug) for slug in slugs]
+        return
+    if action == 'post_clear':
+        namespaces = getattr(instance, '_cleared_namespaces', [])
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            slugs = Post.objects.filter(pk__in=pk_set).values_list('slug', flat=True)
+            namespaces = [post_namespace(slug) for slug in slugs]
+        else:
+            slugs = Tag.objects.filter(pk__in=pk_set).values_list('slug', flat=True)
+            namespaces = [tag_namespace(slug) for slug in slugs]
+    else:
+        return
+
+    if reverse:
+        namespaces.append(tag_namespace(instance.slug))
+    else:
+        namespaces.append(post_namespace(instance.slug))
+    invalidate('home', *namespaces)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance, origin=None, **kwargs):
+    """Purge the detail page of the commented post"""
+    if isinstance(origin, Post):
+        # Deleted along with its post, whose pages are purged already
+        return
+    slug = Post.objects.filter(pk=instance.post_id).values_list('slug', flat=True).first()
+    invalidate(post_namespace(slug))
+
+
+def _classified_pages(namespace, posts):
+    return ['home', namespace, *(post_namespace(slug) for slug in posts.values_list('slug', flat=True))]
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def invalidate_category_pages(sender, instance, created=False, **kwargs):
+    """Purge the category listing, home and the detail pages showing the category"""
+    if created:
+        return
+    invalidate(*_classified_pages(category_namespace(instance.slug), instance.posts.all()))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def invalidate_tag_pages(sender, instance, created=False, **kwargs):
+    """Purge the tag listing, home and the detail pages showing the tag"""
+    if created:
+        return
+    invalidate(*_classified_pages(tag_namespace(instance.slug), instance.posts.all()))
 
 
 @receiver(post_save, sender=Post)
-def notify_on_publish(sender, instance, created, **kwargs):
-    """Send notification when a post is published"""
-    if not created and instance.status == 'published':
-        # Check if status was changed to published
-        old_instance = Post.objects.filter(pk=instance.pk).first()
-        if old_instance and old_instance.status != 'published':
-            # Send notification (in production, you would send actual emails)
-            print(f"Notification: Post '{instance.title}' by {instance.author.username} has been published!")
-            
-            # Example email notification (configure email settings in production)
-            # send_mail(
-            #     subject=f'New Post Published: {instance.title}',
-            #     message=f'{instance.author.username} has published a new post: {instance.title}',
-            #     from_email=settings.DEFAULT_FROM_EMAIL,
-            #     recipient_list=['admin@example.com'],
-            #     fail_silently=True,
-            # )
+@receiver(post_save, sender=UserProfile)
+def schedule_image_variants(sender, instance, raw=False, **kwargs):
+    """Have the resized variants of a new image made once it is committed"""
+    if not raw and not images.is_current(instance):
+        transaction.on_commit(lambda: images.schedule(instance))
@@ -0,0 +1,57 @@
+from django import template
+
+from blog import images
+from blog.caching import namespace_version, post_namespace
+
+register = template.Library()
+
+# Part of the key of every cached template fragment. Bump it with any change to
+# the markup inside a {% cache %} block: production keeps fragments in a
+# persistent cache, which would serve the old markup for a day after a deploy.
+FRAGMENT_VERSION = 2
+
+CARD_GRADIENTS = (
+    '#667eea, #764ba2',
+    '#f093fb, #f5576c',
+    '#4facfe, #00f2fe',
+    '#43e97b, #38f9d7',
+    '#fa709a, #fee140',
+    '#30cfd0, #330867',
+)
+
+
+@register.filter
+def card_gradient(post):
+    """Placeholder gradient for a post card, stable per post so the card can be cached"""
+    return CARD_GRADIENTS[post.pk % len(CARD_GRADIENTS)]
+
+
+@register.simple_tag
+def fragment_version():
+    """``FRAGMENT_VERSION``, to vary ``{% cache %}`` fragments on"""
+    return FRAGMENT_VERSION
+
+
+@register.filter
+def card_version(post):
+    """Version of a post's cached card; it changes whenever the post's pages are purged"""
+    return namespace_version(post_namespace(post.slug))
+
+
+@register.filter
+def nav_role(user):
+    """Navbar variant for a user: 'anonymous', 'reader' or 'author'"""
+    if not user.is_authenticated:
+        return 'anonymous'
+    return 'author' if user.profile.is_author else 'reader'
+
+
+@register.inclusion_tag('blog/includes/responsive_image.html')
+def responsive_image(instance, sizes='100vw', **attrs):
+    """A <picture> of the instance's image: WebP and JPEG variants when made, else the original"""
+    return {
+        'image': getattr(instance, images.image_field(type(instance))),
+        'srcset': images.srcsets(instance),
+        'sizes': sizes,
+        'attrs': attrs.items(),
+    }
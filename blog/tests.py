@@ -1,3 +1,1247 @@
-from django.test import TestCase
+import importlib
+import json
+import multiprocessing
+import os
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import clear_url_caches, reverse
+from PIL import Image
+
+import advanced_blog.urls
+from advanced_blog import metrics
+from advanced_blog.instrumentation import RequestMetrics
+from advanced_blog.routers import STICKY_COOKIE, PrimaryReplicaMiddleware
+
+from . import comments, images, urls as blog_urls
+from .admin import CommentAdmin
+from .benchmarks import failures, run_benchmarks, run_index_benchmark, run_sqlite_benchmark
+from .models import Post, Category, Tag, Comment, Notification, PostViews, RelatedPost, TrendingPost
+from .moderation import moderate
+from .notifications import drain_outbox
+from .pagination import CursorPaginator, SequencePaginator
+from .related import rebuild_related
+from .rendering import render_content
+from .trending import buffer as view_buffer, refresh_trending, write_views
+from .search import fts_match_expression, search_post_ids
+
+
+class SearchIndexTests(TestCase):
+    """Tests for the full-text search index"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='secret123')
+
+    def create_post(self, title, content, status='published'):
+        return Post.objects.create(title=title, content=content, author=self.author, status=status)
+
+    def test_match_expression_quotes_terms(self):
+        self.assertEqual(fts_match_expression('Django "tips" OR'), '"django" "tips" "or"*')
+        self.assertEqual(fts_match_expression('  ?! '), '')
+
+    def test_title_matches_rank_first(self):
+        body_match = self.create_post('Weekend notes', '<p>Some <b>django</b> thoughts</p>')
+        title_match = self.create_post('Django deployment', '<p>Gunicorn and friends</p>')
+        self.assertEqual(search_post_ids('django'), [title_match.pk, body_match.pk])
+
+    def test_html_is_not_indexed(self):
+        self.create_post('Styling', '<p class="lead">Plain words</p>')
+        self.assertEqual(search_post_ids('lead'), [])
+
+    def test_index_follows_status_and_delete(self):
+        post = self.create_post('Upcoming features', '<p>Roadmap</p>', status='draft')
+        self.assertEqual(search_post_ids('roadmap'), [])
+
+        post.status = 'published'
+        post.save()
+        self.assertEqual(search_post_ids('roadmap'), [post.pk])
+
+        post.delete()
+        self.assertEqual(search_post_ids('roadmap'), [])
+
+    def test_rebuild_command(self):
+        post = self.create_post('Healthy living', '<p>Sleep well</p>')
+        Post.objects.filter(pk=post.pk).update(title='Healthy eating')
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(search_post_ids('eating'), [post.pk])
+
+    def test_search_view(self):
+        post = self.create_post('Django tips', '<p>Use select_related</p>')
+        response = self.client.get(reverse('blog:search'), {'query': 'tip'})
+        self.assertEqual(list(response.context['page_obj']), [post])
+
+
+class PostTextStatsTests(TestCase):
+    """Tests for the denormalized excerpt and reading stats"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='secret123')
+
+    def test_stats_filled_on_save(self):
+        words = ' '.join(['word'] * 450)
+        post = Post.objects.create(title='Long read', content=f'<p>{words}</p>', author=self.author)
+        self.assertEqual(post.word_count, 450)
+        self.assertEqual(post.reading_time, 2)
+        self.assertTrue(post.excerpt.startswith('word word'))
+        self.assertNotIn('<p>', post.excerpt)
+
+    def test_update_fields_includes_stats(self):
+        post = Post.objects.create(title='Short', content='<p>one two</p>', author=self.author)
+        post.content = '<p>one two three</p>'
+        post.save(update_fields=['content'])
+        post.refresh_from_db()
+        self.assertEqual(post.word_count, 3)
+
+    def test_backfill_command(self):
+        post = Post.objects.create(title='Backfill', content='<p>a b c d</p>', author=self.author)
+        Post.objects.filter(pk=post.pk).update(excerpt='', word_count=0)
+        call_command('rebuild_post_fields', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual((post.excerpt, post.word_count), ('a b c d', 4))
+
+    def test_home_does_not_load_content(self):
+        cache.clear()
+        Post.objects.create(title='Listed', content='<p>Body</p>', author=self.author, status='published')
+        response = self.client.get(reverse('blog:home'))
+        post = response.context['page_obj'][0]
+        self.assertIn('content', post.get_deferred_fields())
+        self.assertContains(response, 'Body')
+
+
+class RenderedContentTests(TestCase):
+    """Tests for the sanitized, pre-rendered post body"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='secret123')
+
+    def test_unsafe_markup_is_removed(self):
+        html = render_content(
+            '<p onclick="steal()" style="color: red; background: url(x)">Hi<script>alert(1)</script></p>'
+            '<a href="javascript:alert(1)">one</a><a href=" JaVa\tscript:alert(1)">two</a>'
+            '<form><input name="q">hidden</form><iframe src="https://example.com">gone</iframe><p>open <b>tags'
+        ).html
+        self.assertEqual(html, '<p style="color: red">Hi</p><a>one</a><a>two</a><p>open <b>tags</b></p>')
+
+    def test_links_images_and_text_are_rewritten(self):
+        html = render_content(
+            '<a href="https://example.com/x" target="_blank">out</a><a href="/post/" target="_self">in</a>'
+            '<img src="/media/uploads/a.png" alt="A &amp; B">&lt;not a tag&gt;'
+        ).html
+        self.assertIn('<a href="https://example.com/x" target="_blank" rel="nofollow noopener noreferrer">out</a>', html)
+        self.assertIn('<a href="/post/">in</a>', html)
+        self.assertIn('<img src="/media/uploads/a.png" alt="A &amp; B" loading="lazy" decoding="async">', html)
+        self.assertIn('&lt;not a tag&gt;', html)
+
+    def test_malformed_urls_are_dropped(self):
+        post = Post.objects.create(title='Legacy', author=self.author, content=(
+            '<p><a href="http://[oops">x</a><img src="http://[x" alt="Chart">'
+            '<iframe src="https://[www.youtube.com/embed/x"></iframe></p>'
+        ))
+        self.assertEqual(post.rendered_content, '<p><a>x</a></p>')
+
+    def test_ckeditor_dialog_markup_is_kept(self):
+        html = render_content(
+            '<table border="1" cellpadding="1" cellspacing="1" style="width:500px"><tr><td>x</td></tr></table>'
+            '<p><a id="intro" name="intro"></a>Intro</p><a href="#intro">top</a>'
+            '<img alt="" src="/media/uploads/rule.png" style="border-style:solid; border-width:1px; float:left">'
+        ).html
+        self.assertIn('<table border="1" cellpadding="1" cellspacing="1" style="width: 500px">', html)
+        self.assertIn('<a id="intro" name="intro"></a>', html)
+        self.assertIn('<img alt="" src="/media/uploads/rule.png" '
+                      'style="border-style: solid; border-width: 1px; float: left"', html)
+
+    def test_only_allowed_hosts_are_embedded(self):
+        html = render_content(
+            '<iframe allowfullscreen frameborder="0" src="https://www.youtube.com/embed/x">fallback</iframe>'
+            '<iframe src="http://www.youtube.com/embed/x"></iframe><iframe src="https://example.com/x"></iframe>'
+            '<table border="1 onload=x" cellpadding="-1"></table>'
+        ).html
+        self.assertEqual(html, (
+            '<iframe allowfullscreen="" frameborder="0" src="https://www.youtube.com/embed/x" '
+            'sandbox="allow-scripts allow-same-origin allow-popups allow-presentation" loading="lazy"></iframe>'
+            '<table></table>'
+        ))
+
+    def test_headings_get_ids_and_toc(self):
+        post = Post.objects.create(title='Guide', author=self.author, status='published', content=(
+            '<h2>Setup</h2><p>a</p><h3>Install <em>it</em></h3><h2>Setup</h2><h4>Detail</h4>'
+        ))
+        self.assertIn('<h3 id="install-it">Install <em>it</em></h3>', post.rendered_content)
+        self.assertEqual(post.toc, [
+            {'id': 'setup', 'text': 'Setup', 'depth': 0},
+            {'id': 'install-it', 'text': 'Install it', 'depth': 1},
+            {'id': 'setup-2', 'text': 'Setup', 'depth': 0},
+        ])
+        response = self.client.get(reverse('blog:post_detail', args=[post.slug]))
+        self.assertContains(response, '<a href="#setup-2" class="text-decoration-none">Setup</a>', html=True)
+
+    def test_post_page_serves_rendered_content(self):
+        post = Post.objects.create(title='Unsafe', content='<p>Body</p><script>alert(1)</script>',
+                                   author=self.author, status='published')
+        Post.objects.filter(pk=post.pk).update(rendered_content='<p>Stored</p>')
+        response = self.client.get(reverse('blog:post_detail', args=[post.slug]))
+        self.assertContains(response, '<p>Stored</p>')
+        self.assertIn('content', response.context['post'].get_deferred_fields())
+
+        call_command('rebuild_post_fields', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual(post.rendered_content, '<p>Body</p>')
+
+
+class CounterTests(TestCase):
+    """Tests for the denormalized counter columns"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='secret123')
+        self.reader = User.objects.create_user('reader', password='secret123')
+        self.category = Category.objects.create(name='Technology')
+        self.tag = Tag.objects.create(name='Django')
+
+    def publish(self, title='Counted'):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(title=title, content='<p>Body</p>', author=self.author,
+                                       category=self.category, status='published')
+            post.tags.add(self.tag)
+        return post
+
+    def assertCounts(self, post=None, category=0, tag=0, posts=0, comments=0, approved=0):
+        self.category.refresh_from_db()
+        self.tag.refresh_from_db()
+        self.author.profile.refresh_from_db()
+        self.reader.profile.refresh_from_db()
+        self.assertEqual(self.category.post_count, category)
+        self.assertEqual(self.tag.post_count, tag)
+        self.assertEqual(self.author.profile.post_count, posts)
+        self.assertEqual(self.reader.profile.comment_count, comments)
+        if post is not None:
+            post.refresh_from_db()
+            self.assertEqual(post.comment_count, approved)
+
+    def test_publish_unpublish_and_delete(self):
+        post = self.publish()
+        self.assertCounts(post, category=1, tag=1, posts=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.status = 'draft'
+            post.save()
+        self.assertCounts(post)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.status = 'published'
+            post.save()
+            post.tags.clear()
+        self.assertCounts(post, category=1, posts=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        self.assertCounts()
+
+    def test_comments_and_bulk_moderation(self):
+        post = self.publish()
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=post, user=self.reader, content='First')
+            Comment.objects.create(post=post, user=self.reader, content='Second')
+        self.assertCounts(post, category=1, tag=1, posts=1, comments=2, approved=2)
+
+        admin = CommentAdmin(Comment, None)
+        admin.disapprove_comments(None, Comment.objects.filter(content='First'))
+        self.assertCounts(post, category=1, tag=1, posts=1, comments=2, approved=1)
+        admin.approve_comments(None, Comment.objects.all())
+        self.assertCounts(post, category=1, tag=1, posts=1, comments=2, approved=2)
+
+    def test_save_does_not_overwrite_counters(self):
+        post = self.publish()
+        stale = Post.objects.get(pk=post.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=post, user=self.reader, content='Hello')
+        stale.title = 'Renamed'
+        stale.save()
+        self.assertCounts(post, category=1, tag=1, posts=1, comments=1, approved=1)
+
+    def test_reconcile_command(self):
+        post = self.publish()
+        Category.objects.update(post_count=42)
+        Post.objects.update(comment_count=7)
+        call_command('reconcile_counters', stdout=StringIO())
+        self.assertCounts(post, category=1, tag=1, posts=1)
+
+    def test_dashboard_query_count_is_constant(self):
+        for number in range(5):
+            self.publish(f'Counted {number}')
+        self.client.force_login(self.author)
+        self.author.profile.role = 'author'
+        self.author.profile.save()
+        with self.assertNumQueries(3):
+            # The session, the user joined with their profile, and the posts
+            self.client.get(reverse('blog:dashboard'))
+
+
+class RelatedPostTests(TestCase):
+    """Tests for the materialized related-posts lists"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='secret123')
+        self.tech = Category.objects.create(name='Technology')
+        self.travel = Category.objects.create(name='Travel')
+        self.tags = {name: Tag.objects.create(name=name) for name in ('Python', 'Django', 'Cloud')}
+
+    def publish(self, title, tags, category=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(title=title, content='<p>Body</p>', author=self.author,
+                                       category=category, status='published')
+            post.tags.add(*(self.tags[name] for name in tags))
+        return post
+
+    def related(self, post):
+        return [(entry.related.title, entry.score) for entry in RelatedPost.objects.filter(post=post)]
+
+    def snapshot(self):
+        return sorted(RelatedPost.objects.values_list('post', 'rank', 'related', 'score'))
+
+    @override_settings(BLOG_RELATED_POSTS=5)
+    def test_scored_by_tags_then_category_then_recency(self):
+        self.publish('Both tags', ['Python', 'Django'], self.travel)
+        self.publish('One tag, same category', ['Django'], self.tech)
+        self.publish('One tag', ['Python'], self.travel)
+        self.publish('Same category', [], self.tech)
+        self.publish('Newer one tag', ['Python'])
+        self.publish('Unrelated', ['Cloud'], self.travel)
+        post = self.publish('Post', ['Python', 'Django'], self.tech)
+
+        expected = [('Both tags', 2.0), ('One tag, same category', 1.5), ('Newer one tag', 1.0),
+                    ('One tag', 1.0), ('Same category', 0.5)]
+        self.assertEqual(self.related(post), expected)
+
+        incremental = self.snapshot()
+        rebuild_related()
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_incremental_updates_match_rebuild(self):
+        posts = [self.publish(f'Post {number}', names, category) for number, (names, category) in enumerate([
+            (['Python'], self.tech), (['Python', 'Django'], None), (['Django'], self.tech),
+            (['Cloud'], self.travel), (['Python', 'Cloud'], self.travel), ([], self.tech),
+        ])]
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[0].tags.set([self.tags['Cloud']])
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[1].status = 'draft'
+            posts[1].save()
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[2].category = self.travel
+            posts[2].save()
+        with self.captureOnCommitCallbacks(execute=True):
+            posts[3].delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tags['Python'].posts.clear()
+
+        incremental = self.snapshot()
+        self.assertNotIn(posts[1].pk, [related for _, _, related, _ in incremental])
+        call_command('rebuild_related_posts', stdout=StringIO())
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_post_detail_lists_related_posts(self):
+        post = self.publish('Post', ['Python'], self.tech)
+        self.publish('Sibling', ['Python'])
+        response = self.client.get(reverse('blog:post_detail', args=[post.slug]))
+        self.assertContains(response, 'Related Posts')
+        self.assertContains(response, reverse('blog:post_detail', args=['sibling']))
+
+
+def _png(width, height):
+    output = BytesIO()
+    Image.new('RGBA', (width, height), (200, 40, 40, 128)).save(output, 'PNG')
+    return SimpleUploadedFile('photo.png', output.getvalue(), content_type='image/png')
+
+
+@override_settings(BLOG_IMAGE_WORKERS=0)
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = override_settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media = media.name
+        self.author = User.objects.create_user('author', password='pass12345')
+        cache.clear()
+
+    def create_post(self, image, title='Photo essay'):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(title=title, content='<p>Body</p>', author=self.author,
+                                       status='published', featured_image=image)
+        post.refresh_from_db()
+        return post
+
+    def test_upload_makes_variants_below_original_width(self):
+        post = self.create_post(_png(1000, 500))
+        manifest = post.featured_image_variants
+        self.assertEqual(manifest['name'], post.featured_image.name)
+        self.assertEqual([width for width, _ in manifest['webp']], [400, 800, 1000])
+        for extension in ('webp', 'jpeg'):
+            for width, name in manifest[extension]:
+                with Image.open(os.path.join(self.media, name)) as variant:
+                    self.assertEqual(variant.size, (width, width // 2))
+                    self.assertEqual(variant.format, extension.upper())
+
+        response = self.client.get(reverse('blog:home'))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, f"{manifest['jpeg'][0][1]} 400w")
+
+    def test_identical_uploads_share_variants(self):
+        first = self.create_post(_png(500, 500))
+        second = self.create_post(_png(500, 500), title='Same photo')
+        self.assertNotEqual(first.featured_image.name, second.featured_image.name)
+        self.assertEqual(first.featured_image_variants['webp'], second.featured_image_variants['webp'])
+
+    def test_backfill_covers_images_saved_without_signals(self):
+        post = self.create_post(None)
+        upload = self.create_post(_png(300, 200), title='Uploaded').featured_image.name
+        Post.objects.filter(pk=post.pk).update(featured_image=upload)
+        Post.objects.filter(title='Uploaded').update(status='draft')
+        post.refresh_from_db()
+        self.assertFalse(images.is_current(post))
+        self.client.force_login(self.author)
+        with mock.patch.object(images, 'schedule'):
+            self.assertNotContains(self.client.get(reverse('blog:home')), '300w')
+
+        call_command('generate_image_variants', stdout=StringIO())
+        updated_at = post.updated_at
+        post.refresh_from_db()
+        self.assertEqual([width for width, _ in post.featured_image_variants['jpeg']], [300])
+        # The cached card shows the variants, and the post does not look edited
+        self.assertContains(self.client.get(reverse('blog:home')), '300w')
+        self.assertEqual(post.updated_at, updated_at)
+
+    def test_content_images_get_srcset(self):
+        upload = self.create_post(_png(900, 300), title='Uploaded').featured_image.name
+        post = self.create_post(None)
+        with self.captureOnCommitCallbacks(execute=True):
+            post.content = f'<p>Look:</p><img src="/media/{upload}" alt="Chart">'
+            post.save()
+        post.refresh_from_db()
+        self.assertEqual([width for width, _ in post.content_images[upload]['webp']], [400, 800, 900])
+        self.assertIn('<picture><source type="image/webp"', post.rendered_content)
+        self.assertIn(f"{post.content_images[upload]['jpeg'][0][1]} 400w", post.rendered_content)
+
+    def test_unreadable_image_keeps_the_original(self):
+        with self.assertLogs('blog.images', 'WARNING'):
+            post = self.create_post(SimpleUploadedFile('broken.png', b'not an image', content_type='image/png'))
+        self.assertEqual(post.featured_image_variants, {'name': post.featured_image.name})
+        self.assertIsNone(images.srcsets(post))
+
+
+class TrendingTests(TestCase):
+    """Tests for buffered view counting and the trending ranking"""
+
+    def setUp(self):
+        cache.clear()
+        view_buffer.take()
+        self.author = User.objects.create_user('author', password='secret123')
+        self.old, self.new = [
+            Post.objects.create(title=title, content='<p>Body</p>', author=self.author, status='published')
+            for title in ('Old favourite', 'New hit')
+        ]
+
+    @override_settings(BLOG_VIEW_FLUSH_THRESHOLD=3, BLOG_VIEW_FLUSH_INTERVAL=3600)
+    def test_views_are_buffered_and_written_in_one_batch(self):
+        url = reverse('blog:post_detail', args=[self.new.slug])
+        self.client.get(url)
+        # Answered from the page cache, and still counted
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.view_count, 0)
+
+        self.client.get(url)
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.view_count, 3)
+        self.assertEqual(PostViews.objects.get(post=self.new).views, 3)
+
+        write_views({self.new.slug: 2, 'no-such-post': 1})
+        self.assertEqual(PostViews.objects.get(post=self.new).views, 5)
+
+    def test_ranking_decays_with_age(self):
+        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        write_views({self.old.slug: 10}, now=now - timezone.timedelta(hours=48))
+        write_views({self.new.slug: 4}, now=now)
+        write_views({self.old.slug: 1}, now=now - timezone.timedelta(days=30))
+        self.assertEqual(refresh_trending(now=now), 2)
+
+        ranking = list(TrendingPost.objects.values_list('post', flat=True))
+        self.assertEqual(ranking, [self.new.pk, self.old.pk])
+        self.assertAlmostEqual(TrendingPost.objects.get(post=self.old).score, 2.5)
+        # Buckets older than the window are pruned
+        self.assertEqual(PostViews.objects.count(), 2)
+
+        response = self.client.get(reverse('blog:trending'))
+        titles = [post.title for post in response.context['posts']]
+        self.assertEqual(titles, ['New hit', 'Old favourite'])
+
+    def test_cached_page_drops_unpublished_and_deleted_posts(self):
+        write_views({self.old.slug: 3, self.new.slug: 5})
+        refresh_trending()
+        url = reverse('blog:trending')
+        self.assertContains(self.client.get(url), 'Old favourite')
+
+        self.old.status = 'draft'
+        self.old.save()
+        response = self.client.get(url)
+        self.assertNotContains(response, 'Old favourite')
+        self.assertContains(response, self.new.get_absolute_url())
+        self.new.delete()
+        self.assertNotContains(self.client.get(url), self.new.get_absolute_url())
+
+
+class CursorPaginationTests(TestCase):
+    """Tests for keyset pagination of post listings"""
+
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create_user('author', password='secret123')
+        for number in range(14):
+            Post.objects.create(title=f'Post {number}', content='<p>Body</p>', author=author, status='published')
+        # Equal timestamps must still page deterministically through the id tie-breaker
+        Post.objects.filter(title__in=['Post 5', 'Post 6', 'Post 7']).update(created_at=timezone.now())
+        self.expected = list(Post.objects.values_list('pk', flat=True))
+
+    def walk(self, paginator):
+        page = paginator.get_page()
+        pages = [[post.pk for post in page]]
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            pages.append([post.pk for post in page])
+        return page, pages
+
+    def test_forward_and_backward(self):
+        paginator = CursorPaginator(Post.objects.all(), 6)
+        last, pages = self.walk(paginator)
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual([len(page) for page in pages], [6, 6, 2])
+
+        page = paginator.get_page(last.previous_cursor)
+        self.assertEqual([post.pk for post in page], pages[1])
+        page = paginator.get_page(page.previous_cursor)
+        self.assertEqual([post.pk for post in page], pages[0])
+        self.assertFalse(page.has_previous())
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        page = CursorPaginator(Post.objects.all(), 6).get_page('not-a-cursor')
+        self.assertEqual([post.pk for post in page], self.expected[:6])
+
+    def test_sequence_paginator(self):
+        paginator = SequencePaginator(list(range(10)), 4)
+        page = paginator.get_page(paginator.get_page().next_cursor)
+        self.assertEqual(list(page), [4, 5, 6, 7])
+        self.assertEqual(list(paginator.get_page(page.previous_cursor)), [0, 1, 2, 3])
+
+    def test_listing_runs_no_count_query(self):
+        response = self.client.get(reverse('blog:home'))
+        cursor = response.context['page_obj'].next_cursor
+        with self.assertNumQueries(2):
+            # The page rows and their tags; the approximate total comes from the cache
+            response = self.client.get(reverse('blog:home'), {'cursor': cursor})
+        self.assertEqual([post.pk for post in response.context['page_obj']], self.expected[6:12])
+
+
+@override_settings(BLOG_COMMENTS_PER_PAGE=5)
+class CommentPaginationTests(TestCase):
+    """Tests for the inlined first page of comments and the post_comments fragments"""
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='secret123')
+        self.post = Post.objects.create(title='Discussed', content='<p>Body</p>', author=self.author,
+                                        status='published')
+
+    def add_comments(self, count):
+        start = Comment.objects.count()
+        # A user per comment, so a query per author would show in the counts
+        users = [User.objects.create_user(f'reader{start + number}') for number in range(count)]
+        Comment.objects.bulk_create(
+            Comment(post=self.post, user=user, content=f'Comment {start + number:03d}')
+            for number, user in enumerate(users)
+        )
+
+    def queries(self, url, data=None):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_pages_cover_every_comment_once(self):
+        self.add_comments(12)
+        expected = list(self.post.approved_comments.values_list('content', flat=True))
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertEqual([comment.content for comment in response.context['comments']], expected[:5])
+
+        url, shown = response.context['comments'].next_cursor, expected[:5]
+        url = f"{reverse('blog:post_comments', args=[self.post.slug])}?cursor={url}"
+        while url:
+            page = self.client.get(url).json()
+            shown += [content for content in expected if content in page['html']]
+            url = page['next']
+        self.assertEqual(shown, expected)
+
+    def test_query_count_does_not_grow_with_comments(self):
+        fragment_url = reverse('blog:post_comments', args=[self.post.slug])
+        counts = []
+        for added in (8, 40):
+            self.add_comments(added)
+            detail_queries, response = self.queries(self.post.get_absolute_url())
+            cursor = response.context['comments'].next_cursor
+            fragment_queries, _ = self.queries(fragment_url, {'cursor': cursor})
+            counts.append((detail_queries, fragment_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_draft_comments_are_hidden(self):
+        self.post.status = 'draft'
+        self.post.save()
+        response = self.client.get(reverse('blog:post_comments', args=[self.post.slug]))
+        self.assertEqual(response.status_code, 404)
+        self.client.force_login(self.author)
+        response = self.client.get(reverse('blog:post_comments', args=[self.post.slug]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['next'])
+
+
+@override_settings(BLOG_COMMENT_BURST=2, BLOG_COMMENT_RATE=6)
+class CommentIngestionTests(TestCase):
+    """Tests for comment rate limiting and buffered comment writes"""
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user('reader', password='secret123')
+        author = User.objects.create_user('author', password='secret123')
+        self.post = Post.objects.create(title='Popular', content='<p>Body</p>', author=author, status='published')
+        self.client.force_login(self.reader)
+
+    def comment(self, content='Hello'):
+        return self.client.post(self.post.get_absolute_url(), {'content': content})
+
+    def test_user_bucket_limits_bursts_and_refills(self):
+        self.assertEqual(self.comment().status_code, 302)
+        self.assertEqual(self.comment().status_code, 302)
+        response = self.comment('Third')
+        self.assertEqual(response.status_code, 429)
+        self.assertContains(response, 'Third', status_code=429)
+        self.assertEqual(Comment.objects.count(), 2)
+
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.9')
+        request.user = self.reader
+        now = timezone.now().timestamp()
+        self.assertFalse(comments.allow(request, now=now))
+        # Six tokens a minute: one is back after ten seconds
+        self.assertTrue(comments.allow(request, now=now + 10))
+        self.assertFalse(comments.allow(request, now=now + 10))
+
+    def test_ip_bucket_is_shared_by_users(self):
+        self.comment()
+        self.comment()
+        self.client.force_login(User.objects.create_user('second', password='secret123'))
+        self.assertEqual(self.comment().status_code, 429)
+
+    @override_settings(BLOG_TRUSTED_PROXIES=1)
+    def test_clients_behind_a_proxy_get_their_own_bucket(self):
+        proxy = {'REMOTE_ADDR': '10.0.0.1'}
+        self.client.post(self.post.get_absolute_url(), {'content': 'One'}, HTTP_X_FORWARDED_FOR='203.0.113.5', **proxy)
+        self.client.post(self.post.get_absolute_url(), {'content': 'Two'}, HTTP_X_FORWARDED_FOR='203.0.113.5', **proxy)
+        self.client.force_login(User.objects.create_user('second', password='secret123'))
+        response = self.client.post(self.post.get_absolute_url(), {'content': 'Three'},
+                                    HTTP_X_FORWARDED_FOR='198.51.100.7', **proxy)
+        self.assertEqual(response.status_code, 302)
+        # A forged header does not get around the limit: the proxy appends the real address
+        response = self.client.post(self.post.get_absolute_url(), {'content': 'Four'},
+                                    HTTP_X_FORWARDED_FOR='192.0.2.1, 203.0.113.5', **proxy)
+        self.assertEqual(response.status_code, 429)
+
+    @override_settings(BLOG_COMMENT_BURST=10, BLOG_COMMENT_BUFFER_SIZE=3, BLOG_COMMENT_FLUSH_INTERVAL=60)
+    def test_buffered_comments_are_saved_together(self):
+        self.addCleanup(comments.buffer.take)
+        self.comment('One')
+        response = self.comment('Two')
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertContains(self.client.get(response.url), 'will appear in a moment')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.comment('Three')
+        self.assertEqual(list(Comment.objects.order_by('id').values_list('content', flat=True)),
+                         ['One', 'Two', 'Three'])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 3)
+
+
+class ModerationTests(TestCase):
+    """Tests for the comment spam rules"""
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user('reader', password='secret123')
+        self.spammer = User.objects.create_user('spammer', password='secret123')
+        self.post = Post.objects.create(title='Popular', content='<p>Body</p>', author=self.reader,
+                                        status='published')
+
+    def test_new_spam_is_held_back(self):
+        self.client.force_login(self.spammer)
+        response = self.client.post(self.post.get_absolute_url(), {
+            'content': 'Click here to BUY NOW at https://a.example https://b.example https://c.example',
+        }, follow=True)
+        self.assertContains(response, 'awaiting moderation')
+        comment = Comment.objects.get()
+        self.assertFalse(comment.is_approved)
+        self.assertEqual(comment.spam_score, 1.4)
+
+        self.client.force_login(self.reader)
+        self.client.post(self.post.get_absolute_url(), {'content': 'A thoughtful reply'})
+        self.assertTrue(Comment.objects.get(user=self.reader).is_approved)
+
+    def test_backlog_rescoring(self):
+        text = 'Great post, visit my profile for more great posts'
+        copies = [Comment.objects.create(post=self.post, user=self.spammer, content=f'{text}  ') for _ in range(5)]
+        clean = Comment.objects.create(post=self.post, user=self.reader, content='Thanks!')
+        # A moderator let this one through; the rules must not overrule them
+        CommentAdmin(Comment, None).approve_comments(None, Comment.objects.filter(pk=copies[0].pk))
+
+        result = moderate(chunk_size=2)
+        self.assertEqual(result, {'scored': 5, 'held': 4, 'approved': 0})
+        self.assertEqual(set(Comment.objects.filter(is_approved=False)), set(copies[1:]))
+        self.assertEqual(Comment.objects.get(pk=clean.pk).spam_score, 0)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 2)
+
+        # With the other copies deleted, the one left next to the approved copy is let through
+        Comment.objects.filter(pk__in=[comment.pk for comment in copies[2:]]).delete()
+        result = moderate()
+        self.assertEqual(result, {'scored': 2, 'held': 0, 'approved': 1})
+        self.assertEqual(Comment.objects.get(pk=copies[1].pk).spam_score, 0.25)
+
+    @override_settings(BLOG_SPAM_KEYWORDS=['casino'])
+    def test_rescoring_is_idempotent(self):
+        links = ' '.join(f'https://{n}.example' for n in range(5))
+        held = Comment.objects.create(post=self.post, user=self.spammer, content=f'See {links}')
+        borderline = Comment.objects.create(post=self.post, user=self.spammer, content='Won at the casino today')
+        self.assertEqual(moderate(), {'scored': 2, 'held': 1, 'approved': 0})
+        self.assertTrue(Comment.objects.get(pk=borderline.pk).is_approved)
+        # The comment the rules held back is not held against its author
+        self.assertEqual(moderate(), {'scored': 2, 'held': 0, 'approved': 0})
+        self.assertEqual(Comment.objects.get(pk=borderline.pk).spam_score, 0.5)
+
+        # A moderator's decision does count
+        CommentAdmin(Comment, None).disapprove_comments(None, Comment.objects.filter(pk=held.pk))
+        self.assertEqual(moderate(), {'scored': 1, 'held': 1, 'approved': 0})
+        self.assertEqual(Comment.objects.get(pk=borderline.pk).spam_score, 1.3)
+
+
+class PageCacheTests(TestCase):
+    """Tests for the anonymous page cache and its invalidation"""
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='secret123')
+        self.category = Category.objects.create(name='Travel')
+        self.tag = Tag.objects.create(name='Guide')
+        self.post = Post.objects.create(title='Lisbon', content='<p>Trams</p>', author=self.author,
+                                        category=self.category, status='published')
+        self.post.tags.add(self.tag)
+        self.urls = {
+            'home': reverse('blog:home'),
+            'detail': self.post.get_absolute_url(),
+            'category': self.category.get_absolute_url(),
+            'tag': self.tag.get_absolute_url(),
+        }
+        for url in self.urls.values():
+            self.client.get(url)
+
+    def cached(self):
+        """Names of the pages currently served without touching the database"""
+        names = set()
+        for name, url in self.urls.items():
+            response = self.client.get(url)
+            if response.context is None:
+                names.add(name)
+        return names
+
+    def test_anonymous_hits_need_no_queries(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(self.urls['detail'])
+        self.assertContains(response, 'Trams')
+
+    def test_authenticated_users_bypass_cache(self):
+        self.client.force_login(self.author)
+        response = self.client.get(self.urls['home'])
+        self.assertIsNotNone(response.context)
+
+    def test_post_edit_purges_its_pages(self):
+        self.post.title = 'Lisbon and Porto'
+        self.post.save()
+        self.assertEqual(self.cached(), set())
+        self.assertContains(self.client.get(self.urls['home']), 'Lisbon and Porto')
+
+    def test_comment_purges_only_detail(self):
+        Comment.objects.create(post=self.post, user=self.author, content='Lovely')
+        self.assertEqual(self.cached(), {'home', 'category', 'tag'})
+
+    def test_disapproved_comment_leaves_cached_detail(self):
+        comment = Comment.objects.create(post=self.post, user=self.author, content='Buy followers here')
+        response = self.client.get(self.urls['detail'])
+        self.assertContains(response, 'Buy followers here')
+        CommentAdmin(Comment, None).disapprove_comments(None, Comment.objects.filter(pk=comment.pk))
+        self.assertNotContains(self.client.get(self.urls['detail']), 'Buy followers here')
+        # Browsers and the CDN holding the old page get the new one too
+        revalidated = self.client.get(self.urls['detail'], HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 200)
+
+    def test_other_category_is_untouched(self):
+        Category.objects.create(name='Food')
+        self.assertEqual(self.cached(), {'home', 'detail', 'category', 'tag'})
+
+    def test_category_rename_purges_its_pages(self):
+        self.category.name = 'Trips'
+        self.category.save()
+        self.assertEqual(self.cached(), {'tag'})
+
+    def test_tag_removal_purges_tag_listing(self):
+        self.post.tags.remove(self.tag)
+        self.assertEqual(self.cached(), {'category'})
+
+    def test_renames_rerender_cards_without_touching_posts(self):
+        updated_at = self.post.updated_at
+        self.client.force_login(self.author)
+        self.tag.name = 'Handbook'
+        self.tag.save()
+        self.assertContains(self.client.get(self.urls['category']), 'HANDBOOK')
+        self.post.tags.add(Tag.objects.create(name='Trains'))
+        self.category.name = 'Trips'
+        self.category.save()
+        response = self.client.get(self.urls['home'])
+        self.assertContains(response, 'TRAINS')
+        self.assertContains(response, 'TRIPS')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.updated_at, updated_at)
+
+
+class ConditionalGetTests(TestCase):
+    """Tests for ETag/Last-Modified handling on public pages"""
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user('author', password='secret123')
+        self.post = Post.objects.create(title='Porto', content='<p>Bridges</p>', author=self.author,
+                                        status='published')
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_not_modified_without_rendering(self):
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        with self.assertNumQueries(0):
+            revalidated = self.revalidate(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_new_comment_changes_validators(self):
+        url = self.post.get_absolute_url()
+        response = self.client.get(url)
+        Comment.objects.create(post=self.post, user=self.author, content='Nice')
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_listing_changes_on_delete(self):
+        url = reverse('blog:home')
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        self.post.delete()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_validators_are_per_user(self):
+        url = reverse('blog:home')
+        anonymous = self.client.get(url)
+        self.client.force_login(self.author)
+        response = self.revalidate(url, anonymous)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server unavailable')
+
+
+class RecordingEmailBackend(BaseEmailBackend):
+    """Notes the outbox state and open transactions while each message is sent"""
+    seen = []
+
+    def send_messages(self, email_messages):
+        RecordingEmailBackend.seen.append(
+            (connection.in_atomic_block, list(Notification.objects.values_list('status', flat=True)))
+        )
+        return len(email_messages)
+
+
+@override_settings(BLOG_PUBLISH_NOTIFICATION_RECIPIENTS=['admin@example.com', 'editor@example.com'])
+class NotificationOutboxTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass12345')
+        self.post = Post.objects.create(title='Draft', content='Body', author=self.author)
+
+    def publish(self):
+        self.post.status = 'published'
+        self.post.save()
+
+    def test_publishing_queues_without_sending(self):
+        self.publish()
+        self.assertEqual(Notification.objects.filter(status='pending').count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Saving an already published post does not notify again
+        self.post.save()
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_drain_sends_pending(self):
+        self.publish()
+        self.assertEqual(drain_outbox(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(Notification.objects.filter(status='sent').count(), 2)
+        self.assertEqual(drain_outbox(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='blog.tests.FailingEmailBackend')
+    def test_failures_back_off_then_give_up(self):
+        self.publish()
+        self.assertEqual(drain_outbox(max_attempts=2), (0, 2))
+        notification = Notification.objects.first()
+        self.assertEqual(notification.status, 'pending')
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.next_attempt_at, timezone.now())
+        self.assertIn('unavailable', notification.last_error)
+
+        # Not due yet
+        self.assertEqual(drain_outbox(max_attempts=2), (0, 0))
+
+        Notification.objects.update(next_attempt_at=timezone.now())
+        drain_outbox(max_attempts=2)
+        self.assertEqual(Notification.objects.filter(status='failed').count(), 2)
+
+    def test_expired_leases_are_reclaimed(self):
+        self.publish()
+        # A worker that died mid-batch: one lease still running, one run out
+        Notification.objects.filter(recipient='admin@example.com').update(
+            status='sending', attempts=1, locked_until=timezone.now() + timezone.timedelta(minutes=5)
+        )
+        Notification.objects.filter(recipient='editor@example.com').update(
+            status='sending', attempts=1, locked_until=timezone.now() - timezone.timedelta(seconds=1)
+        )
+        self.assertEqual(drain_outbox(), (1, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['editor@example.com']])
+        notification = Notification.objects.get(recipient='editor@example.com')
+        self.assertEqual((notification.status, notification.attempts), ('sent', 2))
+        self.assertIsNone(notification.locked_until)
+        self.assertEqual(Notification.objects.get(recipient='admin@example.com').status, 'sending')
+
+    def test_expired_leases_out_of_attempts_fail(self):
+        self.publish()
+        # Killed its worker on each of its attempts
+        Notification.objects.filter(recipient='admin@example.com').update(
+            status='sending', attempts=2, locked_until=timezone.now() - timezone.timedelta(seconds=1)
+        )
+        self.assertEqual(drain_outbox(max_attempts=2), (1, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['editor@example.com']])
+        notification = Notification.objects.get(recipient='admin@example.com')
+        self.assertEqual((notification.status, notification.attempts), ('failed', 2))
+        self.assertIsNone(notification.locked_until)
+        self.assertEqual(drain_outbox(max_attempts=2), (0, 0))
+
+
+@override_settings(BLOG_PUBLISH_NOTIFICATION_RECIPIENTS=['admin@example.com', 'editor@example.com'],
+                   EMAIL_BACKEND='blog.tests.RecordingEmailBackend')
+class NotificationLeaseTests(TransactionTestCase):
+    def test_sends_outside_a_transaction(self):
+        author = User.objects.create_user('author', password='pass12345')
+        Post.objects.create(title='News', content='Body', author=author, status='published')
+        RecordingEmailBackend.seen = []
+        self.assertEqual(drain_outbox(), (2, 0))
+        # The claim is committed before the first send, and no transaction is open during the sends
+        self.assertEqual(RecordingEmailBackend.seen, [(False, ['sending', 'sending'])] * 2)
+        self.assertEqual(set(Notification.objects.values_list('status', flat=True)), {'sent'})
+
+
+class GenerateFixtureTests(TestCase):
+    def generate(self, prefix):
+        call_command('generate_fixture', users=20, posts=60, comments=200, seed=7,
+                     prefix=prefix, stdout=StringIO())
+        return Post.objects.filter(slug__startswith=f'{prefix}-').order_by('slug')
+
+    def test_counts_and_derived_fields(self):
+        posts = self.generate('a')
+        self.assertEqual(posts.count(), 60)
+        self.assertEqual(Comment.objects.count(), 200)
+        self.assertEqual(User.objects.filter(profile__isnull=False).count(), 20)
+
+        # Signals were bypassed, so counters and the search index were rebuilt afterwards
+        post = posts.filter(comment_count__gt=0).first()
+        self.assertEqual(post.comment_count, post.comments.filter(is_approved=True).count())
+        published = posts.filter(status='published').first()
+        self.assertIn(published.pk, search_post_ids(published.title.split()[0]))
+
+        word_count = published.word_count
+        published.update_text_stats()
+        self.assertEqual(published.word_count, word_count)
+
+    def test_same_seed_is_reproducible(self):
+        first = [(p.title, p.word_count, p.status) for p in self.generate('a')]
+        second = [(p.title, p.word_count, p.status) for p in self.generate('b')]
+        self.assertEqual(first, second)
+
+
+class BenchmarkTests(TestCase):
+    def test_every_view_within_budget(self):
+        call_command('generate_fixture', users=10, posts=40, comments=120, stdout=StringIO())
+        report = run_benchmarks(iterations=1, warmup=0)
+        self.assertEqual(report['uncovered_urls'], [])
+        self.assertEqual(failures(report), [])
+        self.assertEqual(len(report['results']), 22)
+
+    def test_index_benchmark_compares_plans(self):
+        call_command('generate_fixture', users=10, posts=40, comments=120, stdout=StringIO())
+        report = run_index_benchmark(iterations=1)
+        self.assertIn('post_published_recent_idx', report['indexes'])
+        home = next(result for result in report['results'] if result['name'] == 'home')
+        self.assertIn('post_published_recent_idx', home['plan_with'])
+        self.assertNotIn('post_published_recent_idx', home['plan_without'])
+        last_modified = next(result for result in report['results'] if result['name'] == 'home (last modified)')
+        self.assertIn('post_published_updated_idx', last_modified['plan_with'])
+
+
+class SQLiteBenchmarkTests(TransactionTestCase):
+    """The benchmark copies the database, which it cannot do inside the transaction of a TestCase"""
+
+    def test_sqlite_benchmark_loads_both_modes(self):
+        call_command('generate_fixture', users=10, posts=40, comments=120, stdout=StringIO())
+        report = run_sqlite_benchmark(processes=2, seconds=0.5, write_share=0.5)
+        self.assertEqual([result['mode'] for result in report['results']], ['default', 'tuned'])
+        for result in report['results']:
+            self.assertGreater(result['reads'], 0)
+            self.assertGreater(result['writes'], 0)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        author = User.objects.create_user('author', password='pass12345')
+        Post.objects.create(title='Hello', content='<p>Body</p>', author=author, status='published')
+        cache.clear()
+
+    def test_logs_and_server_timing(self):
+        with self.assertLogs('advanced_blog.requests', 'INFO') as logs:
+            response = self.client.get(reverse('blog:home'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'blog:home')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['render_ms'], 0)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn(f'desc="{record["queries"]} queries"', response['Server-Timing'])
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_untouched(self):
+        response = self.client.get(reverse('blog:home'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_repeated_sql_is_flagged(self):
+        metrics = RequestMetrics()
+        with connection.execute_wrapper(metrics):
+            list(Post.objects.all())
+            for pk in range(3):
+                list(Post.objects.filter(pk=pk))
+        self.assertEqual(metrics.query_count, 4)
+        [(sql, count)] = metrics.duplicates(threshold=3)
+        self.assertEqual(count, 3)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class DatabaseRoutingTests(TestCase):
+    """Reads are routed by alias only; the test database has no replica to query"""
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass12345')
+        self.post = Post.objects.create(title='Hello', content='<p>Body</p>', author=self.author, status='published')
+
+    def route(self, request):
+        """Run a request through the middleware, recording the read alias before and after a write"""
+        seen = {}
+
+        def view(request):
+            seen['read'] = Post.objects.all().db
+            Post.objects.filter(pk=self.post.pk).update(title='Hello again')
+            seen['after_write'] = Post.objects.all().db
+            return HttpResponse()
+
+        return PrimaryReplicaMiddleware(view)(request), seen
+
+    def test_safe_requests_read_from_a_replica_until_they_write(self):
+        response, seen = self.route(RequestFactory().get('/'))
+        self.assertEqual(seen, {'read': 'replica', 'after_write': 'default'})
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(Post.objects.all().db, 'default')
+
+    def test_writers_stick_to_the_primary(self):
+        response, seen = self.route(RequestFactory().post('/'))
+        self.assertEqual(seen['read'], 'default')
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
+        request = RequestFactory().get('/')
+        request.COOKIES[STICKY_COOKIE] = '1'
+        _, seen = self.route(request)
+        self.assertEqual(seen['read'], 'default')
+
+    def test_author_sees_edit_after_redirect(self):
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('blog:edit_post', args=[self.post.slug]), {
+            'title': 'Edited title', 'content': '<p>Body</p>', 'status': 'published',
+        }, follow=True)
+        # The dashboard would fail on the unconfigured replica if it did not read from the primary
+        self.assertContains(response, 'Edited title')
+        self.assertIn(STICKY_COOKIE, self.client.cookies)
+
+
+def _count_in_child(directory):
+    with override_settings(METRICS_DIR=directory):
+        metrics.REQUESTS.inc(view='blog:home', method='GET', status=200)
+
+
+@override_settings(METRICS_TOKEN=None, METRICS_PUBLIC=True)
+class MetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        override = override_settings(METRICS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+
+    def test_processes_are_summed(self):
+        metrics.REQUESTS.inc(view='blog:home', method='GET', status=200)
+        child = multiprocessing.get_context('fork').Process(target=_count_in_child, args=(self.directory,))
+        child.start()
+        child.join()
+        samples = metrics.collect()
+        key = ('http_requests_total', (('method', 'GET'), ('status', '200'), ('view', 'blog:home')))
+        self.assertEqual(samples[key], 2)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_latency_seconds', 'Test', ['view'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value, view='x')
+        output = metrics.render()
+        self.assertIn('# TYPE test_latency_seconds histogram', output)
+        self.assertIn('test_latency_seconds_bucket{view="x",le="0.1"} 1', output)
+        self.assertIn('test_latency_seconds_bucket{view="x",le="1"} 3', output)
+        self.assertIn('test_latency_seconds_bucket{view="x",le="+Inf"} 4', output)
+        self.assertIn('test_latency_seconds_count{view="x"} 4', output)
+
+    def test_endpoint_reports_views_cache_and_comments(self):
+        author = User.objects.create_user('author', password='pass12345')
+        post = Post.objects.create(title='Hello', content='Body', author=author, status='published')
+        self.client.get(reverse('blog:home'))
+        self.client.get(reverse('blog:home'))
+        Comment.objects.create(post=post, user=author, content='Hi')
+
+        output = self.client.get('/metrics/').content.decode()
+        self.assertIn('http_requests_total{method="GET",status="200",view="blog:home"} 2.0', output)
+        self.assertIn('http_request_db_queries_bucket{view="blog:home",le="+Inf"} 2.0', output)
+        self.assertIn('blog_page_cache_requests_total{result="hit"} 1.0', output)
+        self.assertIn('blog_page_cache_requests_total{result="miss"} 1.0', output)
+        self.assertIn('blog_comments_posted_total 1.0', output)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_required_when_set(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_PUBLIC=False)
+    def test_closed_without_token_in_production(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+
+def _load_urls(async_views):
+    with override_settings(BLOG_ASYNC_VIEWS=async_views):
+        importlib.reload(blog_urls)
+        importlib.reload(advanced_blog.urls)
+    clear_url_caches()
+
+
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        _load_urls(async_views=True)
+        cls.addClassCleanup(_load_urls, async_views=False)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass12345')
+        cls.author.profile.role = 'author'
+        cls.author.profile.save()
+        cls.category = Category.objects.create(name='Tech')
+        cls.tag = Tag.objects.create(name='Django')
+        cls.post = Post.objects.create(title='Async Views', content='<p>Concurrency explained</p>',
+                                       author=cls.author, category=cls.category, status='published')
+        cls.post.tags.add(cls.tag)
+        Comment.objects.create(post=cls.post, user=cls.author, content='First comment')
+        write_views({cls.post.slug: 1})
+        refresh_trending()
+
+    def setUp(self):
+        cache.clear()
+        self.async_client = AsyncClient()
+
+    def test_urls_use_async_views(self):
+        from . import async_views
+        self.assertIs(blog_urls.read_views, async_views)
+
+    async def test_read_only_pages(self):
+        pages = [
+            reverse('blog:home'),
+            self.post.get_absolute_url(),
+            self.category.get_absolute_url(),
+            self.tag.get_absolute_url(),
+            reverse('blog:search') + '?query=concurrency',
+            reverse('blog:trending'),
+        ]
+        for url in pages:
+            response = await self.async_client.get(url)
+            self.assertContains(response, 'Async Views', msg_prefix=url)
+        response = await self.async_client.get(self.post.get_absolute_url())
+        self.assertContains(response, 'First comment')
+        response = await self.async_client.get(reverse('blog:post_comments', args=[self.post.slug]))
+        self.assertIn('First comment', response.json()['html'])
+        self.assertIn('queries', response['Server-Timing'])
+
+    async def test_signed_in_reader_and_comment(self):
+        await self.async_client.aforce_login(self.author)
+        url = self.post.get_absolute_url()
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'author')
+        self.assertIn('private', response['Cache-Control'])
+
+        response = await self.async_client.post(url, {'content': 'Posted asynchronously'})
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        self.assertTrue(await Comment.objects.filter(content='Posted asynchronously').aexists())
+
+    async def test_missing_pages_404(self):
+        for url in ('/post/missing/', '/category/missing/', '/tag/missing/'):
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 404, url)
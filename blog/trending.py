@@ -0,0 +1,166 @@
+"""
+View counting and the trending ranking.
+
+Counting a view must not write to the database on every hit, which would
+serialize requests on SQLite's single writer and bloat PostgreSQL with dead
+row versions. ``count_views`` adds each post page view to a buffer in process
+memory; once ``BLOG_VIEW_FLUSH_THRESHOLD`` views are buffered, or
+``BLOG_VIEW_FLUSH_INTERVAL`` seconds have passed, the process writes them as
+one ``UPDATE`` of ``Post.view_count`` and one upsert into the hourly
+``PostViews`` buckets. Views still buffered when a process is killed are
+lost, which a popularity signal can afford.
+
+``refresh_trending`` (the ``refresh_trending --loop`` worker) materializes the
+ranking into ``TrendingPost``: every view of the last
+``BLOG_TRENDING_WINDOW_DAYS`` counts, its weight halving every
+``BLOG_TRENDING_HALF_LIFE`` hours. The /trending/ page reads only that table.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Case, F, FloatField, Sum, Value, When
+from django.utils import timezone
+
+from .caching import invalidate
+from .models import Post, PostViews, TrendingPost
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 250
+
+
+class ViewBuffer:
+    """Views per post slug, kept in process memory until flushed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, slug):
+        """Count a view and return whether the buffer is due for a flush"""
+        with self._lock:
+            self._counts[slug] += 1
+            self._pending += 1
+            return (self._pending >= getattr(settings, 'BLOG_VIEW_FLUSH_THRESHOLD', 500)
+                    or time.monotonic() - self._last_flush >= getattr(settings, 'BLOG_VIEW_FLUSH_INTERVAL', 30))
+
+    def take(self):
+        """Empty the buffer and return its counts"""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        return counts
+
+    def flush(self):
+        counts = self.take()
+        if not counts:
+            return
+        try:
+            write_views(counts)
+        except DatabaseError:
+            # Keep the views for the next flush rather than failing the request
+            logger.exception('Could not write %d buffered post views', sum(counts.values()))
+            with self._lock:
+                self._counts.update(counts)
+                self._pending += sum(counts.values())
+
+
+buffer = ViewBuffer()
+
+
+def _chunks(items):
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, CHUNK_SIZE)):
+        yield chunk
+
+
+def write_views(counts, now=None):
+    """Add ``{slug: views}`` to the view counters and to the current hour's bucket"""
+    hour = (now or timezone.now()).replace(minute=0, second=0, microsecond=0)
+    connection = connections[router.db_for_write(PostViews)]
+    table = connection.ops.quote_name(PostViews._meta.db_table)
+    # Both backends support this upsert; it adds to a bucket another process may have created
+    upsert = (
+        f'INSERT INTO {table} (post_id, hour, views) VALUES (%s, %s, %s) '
+        f'ON CONFLICT (post_id, hour) DO UPDATE SET views = {table}.views + excluded.views'
+    )
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        for chunk in _chunks(counts):
+            views = {
+                pk: counts[slug] for slug, pk in
+                Post.objects.filter(slug__in=chunk, status='published').order_by().values_list('slug', 'id')
+            }
+            if not views:
+                continue
+            Post.objects.filter(pk__in=views).update(view_count=F('view_count') + Case(
+                *(When(pk=pk, then=Value(count)) for pk, count in views.items()), default=Value(0)
+            ))
+            cursor.executemany(upsert, [
+                (pk, connection.ops.adapt_datetimefield_value(hour), count) for pk, count in views.items()
+            ])
+
+
+def count_views(view_func):
+    """Count successful GETs of a post page, including those answered from the cache or with 304
+
+    Goes outside the caching decorators. Works for sync and async views.
+    """
+    def counted(request, response, slug):
+        return request.method == 'GET' and response.status_code in (200, 304) and buffer.add(slug)
+
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapped(request, *args, **kwargs):
+            response = await view_func(request, *args, **kwargs)
+            if counted(request, response, kwargs['slug']):
+                await sync_to_async(buffer.flush)()
+            return response
+        return async_wrapped
+
+    @wraps(view_func)
+    def wrapped(request, *args, **kwargs):
+        response = view_func(request, *args, **kwargs)
+        if counted(request, response, kwargs['slug']):
+            buffer.flush()
+        return response
+    return wrapped
+
+
+def refresh_trending(now=None):
+    """Recompute the materialized trending ranking and return the number of posts in it"""
+    now = now or timezone.now()
+    half_life = getattr(settings, 'BLOG_TRENDING_HALF_LIFE', 24)
+    since = (now - timedelta(days=getattr(settings, 'BLOG_TRENDING_WINDOW_DAYS', 7))).replace(
+        minute=0, second=0, microsecond=0
+    )
+    # One weight per hourly bucket, so the database sums the decayed views itself
+    buckets = [since + timedelta(hours=offset) for offset in range(int((now - since).total_seconds() // 3600) + 1)]
+    weights = [
+        When(hour=hour, then=Value(0.5 ** ((now - hour).total_seconds() / 3600 / half_life)))
+        for hour in buckets
+    ]
+    ranking = PostViews.objects.filter(hour__gte=since, post__status='published').values('post').annotate(
+        score=Sum(F('views') * Case(*weights, default=Value(0.0), output_field=FloatField()))
+    ).order_by('-score', '-post')[:getattr(settings, 'BLOG_TRENDING_SIZE', 24)]
+
+    entries = [
+        TrendingPost(post_id=row['post'], score=row['score'], rank=rank)
+        for rank, row in enumerate(ranking)
+    ]
+    with transaction.atomic():
+        TrendingPost.objects.all().delete()
+        TrendingPost.objects.bulk_create(entries)
+        PostViews.objects.filter(hour__lt=since).delete()
+    invalidate('trending')
+    return len(entries)
@@ -1,18 +1,24 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
 
 app_name = 'blog'
 
+# The read-only pages can be served by their async versions under ASGI
+read_views = async_views if getattr(settings, 'BLOG_ASYNC_VIEWS', False) else views
+
 urlpatterns = [
-    path('', views.home, name='home'),
-    path('search/', views.search, name='search'),
+    path('', read_views.home, name='home'),
+    path('search/', read_views.search, name='search'),
+    path('trending/', read_views.trending, name='trending'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('post/create/', views.create_post, name='create_post'),
-    path('post/<slug:slug>/', views.post_detail, name='post_detail'),
+    path('post/<slug:slug>/', read_views.post_detail, name='post_detail'),
+    path('post/<slug:slug>/comments/', read_views.post_comments, name='post_comments'),
     path('post/<slug:slug>/edit/', views.edit_post, name='edit_post'),
     path('post/<slug:slug>/delete/', views.delete_post, name='delete_post'),
-    path('category/<slug:slug>/', views.category_posts, name='category_posts'),
-    path('tag/<slug:slug>/', views.tag_posts, name='tag_posts'),
+    path('category/<slug:slug>/', read_views.category_posts, name='category_posts'),
+    path('tag/<slug:slug>/', read_views.tag_posts, name='tag_posts'),
     path('comment/<int:comment_id>/delete/', views.delete_comment, name='delete_comment'),
     
     # Category management
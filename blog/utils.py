@@ -0,0 +1,33 @@
+import hashlib
+from html import unescape
+
+from django.conf import settings
+from django.utils.html import strip_tags
+
+
+def html_to_text(html):
+    """Return the plain text of an HTML fragment with whitespace collapsed"""
+    text = unescape(strip_tags(html or ''))
+    return ' '.join(text.split())
+
+
+def text_hash(text):
+    """Digest of a text ignoring case and whitespace, so reposted copies of a comment match"""
+    return hashlib.sha256(' '.join((text or '').lower().split()).encode()).hexdigest()
+
+
+def client_ip(request):
+    """The client's address, read from ``X-Forwarded-For`` behind ``BLOG_TRUSTED_PROXIES`` proxies
+
+    Each proxy appends the address it received the request from, so with N
+    trusted proxies the client is the N-th entry from the right; the entries
+    before it are whatever the client sent. Requests that did not pass
+    through the proxies fall back to ``REMOTE_ADDR``.
+    """
+    proxies = getattr(settings, 'BLOG_TRUSTED_PROXIES', 0)
+    if proxies:
+        forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        forwarded = [part for part in forwarded if part]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
@@ -1,20 +1,73 @@
+from django.conf import settings
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.core.paginator import Paginator
-from django.db.models import Q
-from .models import Post, Category, Tag, Comment
+from django.db.models import Max, Q
+from accounts.decorators import author_required
+from .models import Post, Category, Tag, Comment, RelatedPost
 from .forms import PostForm, CommentForm, SearchForm, CategoryForm, TagForm
+from . import comments
+from .search import search_post_ids, posts_in_order
+from .pagination import CursorPaginator, SequencePaginator
+from .caching import cache_public_page, conditional_page
+from .trending import count_views
 
 
+COMMENT_ADDED = 'Your comment has been added!'
+COMMENT_HELD = 'Your comment is awaiting moderation.'
+COMMENT_QUEUED = 'Your comment has been received and will appear in a moment.'
+COMMENT_RATE_LIMITED = 'You are commenting too quickly. Please wait a minute and try again.'
+
+
+def _per_page():
+    return getattr(settings, 'BLOG_POSTS_PER_PAGE', 6)
+
+
+def _comments_per_page():
+    return getattr(settings, 'BLOG_COMMENTS_PER_PAGE', 20)
+
+
+def _comment_paginator(comments):
+    """Pages of approved comments, newest first, with their authors joined in"""
+    return CursorPaginator(comments.select_related('user__profile'), _comments_per_page())
+
+
+def _comment_fragment(request, post, page_obj):
+    """A page of comments as the JSON the post page appends: its HTML and the URL of the next page"""
+    next_url = None
+    if page_obj.has_next():
+        next_url = f"{reverse('blog:post_comments', args=[post.slug])}?cursor={page_obj.next_cursor}"
+    html = render_to_string('blog/includes/comments.html', {'comments': page_obj}, request=request)
+    return {'html': html, 'next': next_url}
+
+
+def _listing_last_modified(**filters):
+    return Post.objects.filter(status='published', **filters).aggregate(Max('updated_at'))['updated_at__max']
+
+
+def _post_last_modified(slug):
+    """Newest of the post itself and its latest approved comment"""
+    timestamps = Post.objects.filter(slug=slug).aggregate(
+        updated=Max('updated_at'),
+        last_comment=Max('comments__created_at', filter=Q(comments__is_approved=True)),
+    )
+    return max((value for value in timestamps.values() if value is not None), default=None)
+
+
+@conditional_page('home', _listing_last_modified)
+@cache_public_page('home')
 def home(request):
     """Display list of published posts with pagination"""
-    posts = Post.objects.filter(status='published').select_related('author', 'category').prefetch_related('tags')
+    posts = Post.objects.filter(status='published').select_related(
+        'author', 'category'
+    ).prefetch_related('tags').defer(*Post.BODY_FIELDS)
     
-    # Pagination
-    paginator = Paginator(posts, 6)  # 6 posts per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset pagination
+    paginator = CursorPaginator(posts, _per_page(), count_cache_key='blog:count:home')
+    page_obj = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'page_obj': page_obj,
@@ -23,9 +76,15 @@ def home(request):
     return render(request, 'blog/home.html', context)
 
 
+@count_views
+@conditional_page('post', _post_last_modified)
+@cache_public_page('post')
 def post_detail(request, slug):
     """Display single post with comments"""
-    post = get_object_or_404(Post, slug=slug)
+    # The page shows rendered_content; the editor's HTML is not needed
+    post = get_object_or_404(
+        Post.objects.select_related('author__profile', 'category').defer('content', 'content_images'), slug=slug
+    )
     
     # Check if user can view the post
     if post.status == 'draft' and (not request.user.is_authenticated or 
@@ -33,37 +92,79 @@ def post_detail(request, slug):
         messages.error(request, 'This post is not available.')
         return redirect('blog:home')
     
-    comments = post.approved_comments
+    related_posts = RelatedPost.objects.filter(post=post).select_related('related').defer(
+        *(f'related__{name}' for name in Post.BODY_FIELDS)
+    )
     comment_form = CommentForm()
+    status = 200
     
     # Handle comment submission
     if request.method == 'POST' and request.user.is_authenticated:
         comment_form = CommentForm(request.POST)
         if comment_form.is_valid():
-            comment = comment_form.save(commit=False)
-            comment.post = post
-            comment.user = request.user
-            comment.save()
-            messages.success(request, 'Your comment has been added!')
-            return redirect('blog:post_detail', slug=slug)
+            if not comments.allow(request):
+                messages.error(request, COMMENT_RATE_LIMITED)
+                status = 429
+            else:
+                comment = comment_form.save(commit=False)
+                comment.post = post
+                comment.user = request.user
+                saved = comments.submit(comment)
+                if not saved:
+                    messages.success(request, COMMENT_QUEUED)
+                elif comment.is_approved:
+                    messages.success(request, COMMENT_ADDED)
+                else:
+                    messages.info(request, COMMENT_HELD)
+                return redirect('blog:post_detail', slug=slug)
     
     context = {
         'post': post,
-        'comments': comments,
+        # Only the first page is inlined; the rest is loaded from post_comments
+        'comments': _comment_paginator(post.approved_comments).get_page(),
+        'related_posts': related_posts,
         'comment_form': comment_form,
         'title': post.title
     }
-    return render(request, 'blog/post_detail.html', context)
+    return render(request, 'blog/post_detail.html', context, status=status)
+
+
+@conditional_page('post', _post_last_modified)
+def post_comments(request, slug):
+    """Return the page of a post's approved comments after ``cursor``, for the post page to append"""
+    post = get_object_or_404(Post.objects.only('slug', 'status', 'author'), slug=slug)
+    if post.status == 'draft' and (not request.user.is_authenticated or
+                                   (request.user.pk != post.author_id and not request.user.is_staff)):
+        raise Http404('No Post matches the given query.')
+    
+    page_obj = _comment_paginator(post.approved_comments).get_page(request.GET.get('cursor'))
+    return JsonResponse(_comment_fragment(request, post, page_obj))
+
+
+@cache_public_page('trending')
+def trending(request):
+    """Display the most viewed posts of recent days, as last materialized by refresh_trending"""
+    posts = Post.objects.filter(status='published', trending__isnull=False).select_related(
+        'author', 'category'
+    ).prefetch_related('tags').defer(*Post.BODY_FIELDS).order_by('trending__rank')
+    
+    context = {
+        'posts': posts,
+        'title': 'Trending'
+    }
+    return render(request, 'blog/trending.html', context)
 
 
+@conditional_page('category', lambda slug: _listing_last_modified(category__slug=slug))
+@cache_public_page('category')
 def category_posts(request, slug):
     """Display posts by category"""
     category = get_object_or_404(Category, slug=slug)
-    posts = Post.objects.filter(category=category, status='published')
+    posts = Post.objects.filter(category=category, status='published').select_related(
+        'author', 'category'
+    ).prefetch_related('tags').defer(*Post.BODY_FIELDS)
     
-    paginator = Paginator(posts, 6)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = CursorPaginator(posts, _per_page()).get_page(request.GET.get('cursor'))
     
     context = {
         'page_obj': page_obj,
@@ -73,14 +174,16 @@ def category_posts(request, slug):
     return render(request, 'blog/category_posts.html', context)
 
 
+@conditional_page('tag', lambda slug: _listing_last_modified(tags__slug=slug))
+@cache_public_page('tag')
 def tag_posts(request, slug):
     """Display posts by tag"""
     tag = get_object_or_404(Tag, slug=slug)
-    posts = Post.objects.filter(tags=tag, status='published')
+    posts = Post.objects.filter(tags=tag, status='published').select_related(
+        'author', 'category'
+    ).prefetch_related('tags').defer(*Post.BODY_FIELDS)
     
-    paginator = Paginator(posts, 6)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = CursorPaginator(posts, _per_page()).get_page(request.GET.get('cursor'))
     
     context = {
         'page_obj': page_obj,
@@ -91,22 +194,19 @@ def tag_posts(request, slug):
 
 
 def search(request):
-    """Search posts by title and content"""
+    """Search published posts through the full-text index, best match first"""
     form = SearchForm(request.GET)
-    posts = []
+    post_ids = []
     query = ''
     
     if form.is_valid():
         query = form.cleaned_data['query']
         if query:
-            posts = Post.objects.filter(
-                Q(title__icontains=query) | Q(content__icontains=query),
-                status='published'
-            ).distinct()
+            post_ids = search_post_ids(query)
     
-    paginator = Paginator(posts, 6)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Paginate the ranked ids and only load the posts shown on this page
+    page_obj = SequencePaginator(post_ids, _per_page()).get_page(request.GET.get('cursor'))
+    page_obj.object_list = posts_in_order(page_obj.object_list)
     
     context = {
         'page_obj': page_obj,
@@ -117,14 +217,10 @@ def search(request):
     return render(request, 'blog/search.html', context)
 
 
-@login_required
+@author_required('You need author privileges to access the dashboard.')
 def dashboard(request):
     """Author dashboard for managing posts"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to access the dashboard.')
-        return redirect('blog:home')
-    
-    posts = Post.objects.filter(author=request.user)
+    posts = Post.objects.filter(author=request.user).select_related('category').defer(*Post.BODY_FIELDS)
     
     context = {
         'posts': posts,
@@ -133,13 +229,9 @@ def dashboard(request):
     return render(request, 'blog/dashboard.html', context)
 
 
-@login_required
+@author_required('You need author privileges to create posts.')
 def create_post(request):
     """Create a new post"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to create posts.')
-        return redirect('blog:home')
-    
     if request.method == 'POST':
         form = PostForm(request.POST, request.FILES)
         if form.is_valid():
@@ -224,13 +316,9 @@ def delete_comment(request, comment_id):
     return redirect('blog:post_detail', slug=post_slug)
 
 
-@login_required
+@author_required('You need author privileges to manage categories.')
 def manage_categories(request):
     """Manage categories (view and create)"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to manage categories.')
-        return redirect('blog:home')
-    
     categories = Category.objects.all()
     
     if request.method == 'POST':
@@ -250,13 +338,9 @@ def manage_categories(request):
     return render(request, 'blog/manage_categories.html', context)
 
 
-@login_required
+@author_required('You need author privileges to edit categories.')
 def edit_category(request, pk):
     """Edit a category"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to edit categories.')
-        return redirect('blog:home')
-    
     category = get_object_or_404(Category, pk=pk)
     
     if request.method == 'POST':
@@ -276,13 +360,9 @@ def edit_category(request, pk):
     return render(request, 'blog/edit_category.html', context)
 
 
-@login_required
+@author_required('You need author privileges to delete categories.')
 def delete_category(request, pk):
     """Delete a category"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to delete categories.')
-        return redirect('blog:home')
-    
     category = get_object_or_404(Category, pk=pk)
     
     if request.method == 'POST':
@@ -297,13 +377,9 @@ def delete_category(request, pk):
     return render(request, 'blog/delete_category.html', context)
 
 
-@login_required
+@author_required('You need author privileges to manage tags.')
 def manage_tags(request):
     """Manage tags (view and create)"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to manage tags.')
-        return redirect('blog:home')
-    
     tags = Tag.objects.all()
     
     if request.method == 'POST':
@@ -323,13 +399,9 @@ def manage_tags(request):
     return render(request, 'blog/manage_tags.html', context)
 
 
-@login_required
+@author_required('You need author privileges to delete tags.')
 def delete_tag(request, pk):
     """Delete a tag"""
-    if not request.user.profile.is_author:
-        messages.error(request, 'You need author privileges to delete tags.')
-        return redirect('blog:home')
-    
     tag = get_object_or_404(Tag, pk=pk)
     
     if request.method == 'POST':